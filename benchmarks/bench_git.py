@@ -0,0 +1,208 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+"""Time git_mirror with many branches, tags and pull request refs
+
+  PYTHONPATH=. python benchmarks/bench_git.py 10000 100000
+
+A local bare "github" repository is created with --branches branches,
+--tags tags and a refs/pull/N/head and refs/pull/N/merge commit per
+pull request. It is mirrored to an empty local bare "gitlab"
+repository three times: cold (nothing cloned yet), warm (nothing
+changed) and churn (the head of --churn of the pull requests moved).
+Each --mode is measured in a new pair of repositories:
+
+* default : fetch +refs/pull/*, push --prune
+* delta : --delta-push
+* targeted : --targeted-fetch, the pull requests are listed from the
+  refs, one in --open-every is open
+* optimize : --skip-pull-requests, which runs git_mirror_optimize
+
+The number of commands, their time and the bytes they transferred are
+reported per git subcommand (clone, fetch, push, ...).
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from github2gitlab.main import GitHub2GitLab
+from github2gitlab.records import PullRequest
+
+REPO = 'user/repo'
+
+MODES = {
+    'default': [],
+    'delta': ['--delta-push'],
+    'targeted': ['--targeted-fetch'],
+    'optimize': ['--skip-pull-requests'],
+}
+
+COMMITTER = 'committer bench <bench@example.com> 1500000000 +0000\n'
+
+
+def data(message):
+    return "data " + str(len(message)) + "\n" + message + "\n"
+
+
+def fast_import(path, commands):
+    "Feed commands to git fast-import, refs may be rewound (churn)"
+    p = subprocess.Popen(['git', 'fast-import', '--quiet', '--force'],
+                         cwd=path, stdin=subprocess.PIPE)
+    p.communicate("".join(commands).encode('utf-8'))
+    if p.returncode != 0:
+        raise ValueError("git fast-import failed in " + path)
+
+
+def pull(n, base, churn=0):
+    "The fast-import commands of the head and merge of pull request n"
+    head = ':' + str(2 * n + 10)
+    return [
+        "commit refs/pull/%d/head\n" % n,
+        "mark " + head + "\n",
+        COMMITTER,
+        data("head of %d, %d" % (n, churn)),
+        "from " + base + "\n",
+        "commit refs/pull/%d/merge\n" % n,
+        COMMITTER,
+        data("merge %d" % n),
+        "from refs/heads/master^0\n",
+        "merge " + head + "\n",
+    ]
+
+
+def origin(path, args, count):
+    "Create the bare GitHub repository"
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+    commands = [
+        "commit refs/heads/master\n",
+        "mark :1\n",
+        COMMITTER,
+        data("master"),
+    ]
+    for i in range(args.branches):
+        commands += [
+            "commit refs/heads/branch-%d\n" % i,
+            COMMITTER,
+            data("branch %d" % i),
+            "from :1\n",
+        ]
+    for i in range(args.tags):
+        commands += ["reset refs/tags/v%d\n" % i, "from :1\n"]
+    fast_import(path, commands)
+    commands = []
+    for n in range(1, count + 1):
+        commands += pull(n, 'refs/heads/master^0')
+    fast_import(path, commands)
+    subprocess.check_call(['git', 'pack-refs', '--all'], cwd=path)
+
+
+def churn(path, args, count):
+    "Move the head of --churn of the pull requests"
+    moved = max(int(count * args.churn), 1)
+    commands = []
+    for n in range(1, count + 1, max(count // moved, 1)):
+        commands += pull(n, 'refs/pull/%d/head^0' % n, churn=1)
+    fast_import(path, commands)
+
+
+def pull_requests(path, args):
+    "Return the pull requests listed by --targeted-fetch"
+    output = subprocess.check_output(
+        ['git', 'for-each-ref', '--format=%(objectname) %(refname)',
+         'refs/pull/'], cwd=path).decode('utf-8')
+    pulls = {}
+    for line in output.splitlines():
+        (sha, ref) = line.split()
+        (_, _, number, kind) = ref.split('/')
+        if kind != 'head':
+            continue
+        state = 'open' if int(number) % args.open_every == 0 else 'closed'
+        pulls[number] = PullRequest(number=int(number), state=state,
+                                    base_ref='master', head_sha=sha)
+    return pulls
+
+
+def mirror(d, args, mode):
+    "Run git_mirror once, return the time and commands per git subcommand"
+    g = GitHub2GitLab.factory([
+        '--gitlab-url', 'http://gitlab.invalid',
+        '--gitlab-token', 'token',
+        '--github-repo', REPO,
+        '--workdir', os.path.join(d, 'work'),
+        '--cache-dir', os.path.join(d, 'cache'),
+    ] + MODES[mode])
+    logging.getLogger('github2gitlab').setLevel(logging.WARNING)
+    g.github['git'] = os.path.join(d, 'github')
+    # the remote added by gitlab_create_remote is git@HOST:REPO.git
+    g.gitlab['git'] = 'file://' + os.path.join(d, 'gitlab')
+    if mode == 'targeted':
+        g.pull_requests = pull_requests(os.path.join(d, 'github', REPO),
+                                        args)
+    start = time.time()
+    g.git_mirror()
+    return (time.time() - start, g.metrics.report()['git'])
+
+
+def measure(args, count, mode):
+    d = tempfile.mkdtemp()
+    try:
+        path = os.path.join(d, 'github', REPO)
+        origin(path, args, count)
+        subprocess.check_call(['git', 'init', '--quiet', '--bare',
+                               os.path.join(d, 'gitlab:' + REPO + '.git')])
+        for run in ('cold', 'warm', 'churn'):
+            if run == 'churn':
+                churn(path, args, count)
+            (seconds, commands) = mirror(d, args, mode)
+            yield (run, seconds, commands)
+    finally:
+        shutil.rmtree(d)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('counts', type=int, nargs='*', default=[10000],
+                        help='numbers of pull requests')
+    parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                        help='git_mirror options measured (default all)')
+    parser.add_argument('--branches', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='fraction of pull requests moved before '
+                        'the churn run')
+    parser.add_argument('--open-every', type=int, default=10,
+                        help='with --mode targeted, one pull request in '
+                        'that many is open')
+    args = parser.parse_args()
+    print("%8s %9s %5s %8s %9s  %s" % ('pulls', 'mode', 'run', 'seconds',
+                                       'commands', 'per subcommand'))
+    for count in args.counts:
+        for mode in args.mode or sorted(MODES):
+            for (run, seconds, commands) in measure(args, count, mode):
+                detail = " ".join([
+                    "%s=%d/%.2fs/%dKiB" % (name, c['count'], c['seconds'],
+                                           c['bytes'] // 1024)
+                    for (name, c) in sorted(commands.items())])
+                print("%8d %9s %5s %8.2f %9d  %s" % (
+                    count, mode, run, seconds,
+                    sum([c['count'] for c in commands.values()]), detail))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+"""Bytes and requests needed to list pull requests with REST and GraphQL
+
+Offline, with synthetic payloads shaped like the GitHub answers::
+
+  PYTHONPATH=. python benchmarks/bench_graphql.py --count 10000
+
+Against GitHub, listing the first --count pull requests of a repository::
+
+  PYTHONPATH=. python benchmarks/bench_graphql.py --count 1000 \\
+     --github-repo ceph/ceph --github-token XXXXXXXX
+"""
+import argparse
+import itertools
+import json
+
+from bench_records import pull
+from github2gitlab.main import GitHub2GitLab, PER_PAGE
+
+
+def node(payload):
+    "The GraphQL PullRequest queried by get_pull_requests_graphql"
+    if payload['state'] == 'open':
+        state = 'OPEN'
+    elif payload['merged_at']:
+        state = 'MERGED'
+    else:
+        state = 'CLOSED'
+    return {
+        'number': payload['number'],
+        'title': payload['title'],
+        'body': payload['body'],
+        'state': state,
+        'mergedAt': payload['merged_at'],
+        'updatedAt': payload['updated_at'],
+        'baseRefName': payload['base']['ref'],
+        'headRefOid': payload['head']['sha'],
+    }
+
+
+def synthetic(count):
+    rest = {'requests': 0, 'bytes': 0}
+    graphql = {'requests': 0, 'bytes': 0}
+    for first in range(1, count + 1, PER_PAGE):
+        page = [pull(n) for n in range(first,
+                                       min(first + PER_PAGE, count + 1))]
+        rest['requests'] += 1
+        rest['bytes'] += len(json.dumps(page))
+        graphql['requests'] += 1
+        graphql['bytes'] += len(json.dumps({'data': {'repository': {
+            'pullRequests': {
+                'pageInfo': {'hasNextPage': True,
+                             'endCursor': 'Y3Vyc29yOnYyOpK5MjAxNi0wMS0w'},
+                'nodes': [node(payload) for payload in page],
+            }}}}))
+    return (rest, graphql)
+
+
+def live(args, count):
+    g = GitHub2GitLab.factory([
+        '--gitlab-url', 'http://gitlab.invalid',
+        '--gitlab-token', 'unused',
+        '--github-repo', args.github_repo,
+        '--github-token', args.github_token,
+    ])
+    counters = {}
+
+    def count_response(response, *args, **kwargs):
+        counters['requests'] += 1
+        counters['bytes'] += len(response.content)
+    g.github['client'].session.hooks['response'].append(count_response)
+
+    results = []
+    for listing in (
+            lambda: g.get(g.github['url'] + "/repos/" + g.github['repo'] +
+                          "/pulls", {'state': 'all'}, cache=False,
+                          stop=lambda item: False),
+            lambda: g.get_pull_requests_graphql()):
+        counters.update({'requests': 0, 'bytes': 0})
+        for item in itertools.islice(listing(), count):
+            pass
+        results.append(dict(counters))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--count', type=int, default=10000,
+                        help='number of pull requests listed')
+    parser.add_argument('--github-repo')
+    parser.add_argument('--github-token')
+    args = parser.parse_args()
+    if args.github_repo:
+        (rest, graphql) = live(args, args.count)
+    else:
+        (rest, graphql) = synthetic(args.count)
+    for (name, result) in (('REST', rest), ('GraphQL', graphql)):
+        print("%-8s %6d requests %10.1f MB" %
+              (name, result['requests'], result['bytes'] / 1e6))
+    print("GraphQL transfers %.1fx less" %
+          (float(rest['bytes']) / graphql['bytes']))
+
+
+if __name__ == '__main__':
+    main()
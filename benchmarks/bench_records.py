@@ -0,0 +1,110 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+"""Memory used by the pull requests kept by get_pull_requests
+
+  PYTHONPATH=. python benchmarks/bench_records.py 10000 100000
+
+compares raw GitHub payloads with the PullRequest records they are
+projected into.
+"""
+import json
+import sys
+import tracemalloc
+
+from github2gitlab.main import DESCRIPTION_MAX
+from github2gitlab.records import PullRequest
+
+
+def user(n):
+    return {
+        'login': 'user' + str(n),
+        'id': n,
+        'avatar_url': 'https://avatars.githubusercontent.com/u/' + str(n),
+        'url': 'https://api.github.com/users/user' + str(n),
+        'html_url': 'https://github.com/user' + str(n),
+        'type': 'User',
+        'site_admin': False,
+    }
+
+
+def repo(n):
+    return {
+        'id': n,
+        'name': 'repo',
+        'full_name': 'user' + str(n) + '/repo',
+        'owner': user(n),
+        'private': False,
+        'description': 'a repository',
+        'fork': True,
+        'url': 'https://api.github.com/repos/user' + str(n) + '/repo',
+    }
+
+
+def pull(n):
+    "A payload shaped like https://api.github.com/repos/o/r/pulls items"
+    url = 'https://api.github.com/repos/owner/repo/pulls/' + str(n)
+    return {
+        'url': url,
+        'id': 1000000 + n,
+        'number': n,
+        'state': 'closed' if n % 3 else 'open',
+        'title': 'Fix the thing number ' + str(n),
+        'body': 'A description of the change. ' * (n % 40),
+        'user': user(n),
+        'created_at': '2016-01-01T00:00:00Z',
+        'updated_at': '2016-01-02T00:00:00Z',
+        'closed_at': None,
+        'merged_at': '2016-01-03T00:00:00Z' if n % 2 else None,
+        'merge_commit_sha': '%040x' % n,
+        'assignees': [user(n + 1)],
+        'labels': [{'name': 'bug', 'color': 'f29513'}],
+        'head': {'label': 'user:branch', 'ref': 'branch',
+                 'sha': '%040x' % (n * 7), 'user': user(n),
+                 'repo': repo(n)},
+        'base': {'label': 'owner:master', 'ref': 'master',
+                 'sha': '%040x' % (n * 11), 'user': user(0),
+                 'repo': repo(0)},
+        '_links': dict([(rel, {'href': url + '/' + rel})
+                        for rel in ('self', 'html', 'issue', 'comments',
+                                    'review_comments', 'commits',
+                                    'statuses')]),
+    }
+
+
+def measure(count, project):
+    tracemalloc.start()
+    pulls = {}
+    for n in range(1, count + 1):
+        # decode a fresh payload, as get() does, so that nothing is shared
+        payload = json.loads(json.dumps(pull(n)))
+        pulls[str(n)] = project(payload)
+        del payload
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def main(argv):
+    for count in [int(arg) for arg in argv] or [10000]:
+        raw = measure(count, lambda payload: payload)
+        records = measure(count, lambda payload: PullRequest.from_api(
+            payload, DESCRIPTION_MAX))
+        print("%7d pull requests: raw %8.1f MB, records %6.1f MB (%.0fx)" %
+              (count, raw / 1e6, records / 1e6, float(raw) / records))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
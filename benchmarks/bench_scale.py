@@ -0,0 +1,189 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+"""Time GitHub2GitLab.run() against fake_api.py with many pull requests
+
+  PYTHONPATH=. python benchmarks/bench_scale.py 1000 10000 100000
+
+For each number of pull requests, a repository with a refs/pull/N/head
+and refs/pull/N/merge per pull request is created and mirrored twice
+to an empty GitLab project: the cold run creates all merge requests,
+the warm run finds nothing to do. The wall time, the API requests and
+the peak RSS of each run are reported. The github2gitlab options
+after -- are added to both runs, for instance::
+
+  PYTHONPATH=. python benchmarks/bench_scale.py --latency 0.05 10000 \\
+     -- --concurrency 8 --gitlab-keyset
+
+Each number of pull requests is measured in a separate process so
+that the peak RSS of one does not hide the others.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_api import FakeAPI, Server
+from github2gitlab.main import GitHub2GitLab
+
+REPO = 'user/repo'
+
+
+def git(*args, **kwargs):
+    return subprocess.check_output(('git',) + args, **kwargs).decode(
+        'utf-8').strip()
+
+
+def origin(path, count):
+    "Create the GitHub repository, return the sha of the pull requests"
+    git('init', '--quiet', '--bare', path)
+    tree = git('hash-object', '-t', 'tree', '-w', '--stdin', cwd=path,
+               stdin=open(os.devnull))
+    env = dict(os.environ,
+               GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+               GIT_COMMITTER_NAME='bench',
+               GIT_COMMITTER_EMAIL='bench@example.com')
+    master = git('commit-tree', tree, '-m', 'master', cwd=path, env=env)
+    head = git('commit-tree', tree, '-p', master, '-m', 'head', cwd=path,
+               env=env)
+    merge = git('commit-tree', tree, '-p', master, '-p', head,
+                '-m', 'merge', cwd=path, env=env)
+    updates = ["update refs/heads/master " + master + "\n"]
+    for n in range(1, count + 1):
+        updates.append("update refs/pull/%d/head %s\n" % (n, head))
+        updates.append("update refs/pull/%d/merge %s\n" % (n, merge))
+    update = subprocess.Popen(['git', 'update-ref', '--stdin'], cwd=path,
+                              stdin=subprocess.PIPE)
+    update.communicate("".join(updates).encode('utf-8'))
+    assert update.returncode == 0
+    git('pack-refs', '--all', cwd=path)
+    return head
+
+
+def serve(urls, count, **kwargs):
+    server = Server(FakeAPI(count, **kwargs))
+    urls.put(server.url())
+    server.serve_forever()
+
+
+def mirror(d, url, options):
+    "Run github2gitlab once, return its measures"
+    g = GitHub2GitLab.factory([
+        '--gitlab-url', url,
+        '--gitlab-token', 'token',
+        '--github-repo', REPO,
+        '--github-token', 'token',
+        '--ssh-public-key', os.path.join(d, 'id_rsa.pub'),
+        '--workdir', os.path.join(d, 'work'),
+        '--cache-dir', os.path.join(d, 'cache'),
+    ] + options)
+    if '--verbose' not in options:
+        logging.getLogger('github2gitlab').setLevel(logging.WARNING)
+    g.github['url'] = url + '/github'
+    g.github['graphql'] = url + '/github/graphql'
+    g.github['git'] = os.path.join(d, 'github')
+    # the remote added by gitlab_create_remote is git@HOST:REPO.git
+    g.gitlab['git'] = 'file://' + os.path.join(d, 'gitlab')
+    start = time.time()
+    g.run()
+    elapsed = time.time() - start
+    report = g.metrics.report()
+    return {
+        'seconds': elapsed,
+        'requests': sum([r['count'] for r in report['requests']]),
+        'phases': report['phases'],
+    }
+
+
+def measure(count, latency, rate_limit, options):
+    d = tempfile.mkdtemp()
+    try:
+        head = origin(os.path.join(d, 'github', REPO), count)
+        git('init', '--quiet', '--bare',
+            os.path.join(d, 'gitlab:' + REPO + '.git'))
+        with open(os.path.join(d, 'id_rsa.pub'), 'w') as f:
+            f.write('ssh-rsa AAAA bench@example.com\n')
+        urls = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(urls, count),
+                                         kwargs={'repo': REPO,
+                                                 'head': head,
+                                                 'latency': latency,
+                                                 'rate_limit': rate_limit})
+        server.daemon = True
+        server.start()
+        try:
+            url = urls.get()
+            cold = mirror(d, url, options)
+            warm = mirror(d, url, options)
+        finally:
+            server.terminate()
+        # kilobytes on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'count': count, 'cold': cold, 'warm': warm,
+                'max_rss_mb': rss / 1024.0}
+    finally:
+        shutil.rmtree(d)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('counts', type=int, nargs='*',
+                        default=[1000, 10000],
+                        help='numbers of pull requests')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds fake_api.py waits before answering')
+    parser.add_argument('--rate-limit', type=int,
+                        help='requests per hour allowed by fake_api.py')
+    parser.add_argument('--json', help='also write the results to JSON')
+    parser.add_argument('--one', type=int, help=argparse.SUPPRESS)
+    argv = sys.argv[1:]
+    options = []
+    if '--' in argv:
+        options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    if args.one:
+        print(json.dumps(measure(args.one, args.latency, args.rate_limit,
+                                 options)))
+        return
+    results = []
+    print("%8s %5s %9s %9s %11s" % ('pulls', 'run', 'seconds',
+                                    'requests', 'max RSS MB'))
+    for count in args.counts:
+        command = [sys.executable, __file__, '--one', str(count),
+                   '--latency', str(args.latency)]
+        if args.rate_limit:
+            command += ['--rate-limit', str(args.rate_limit)]
+        output = subprocess.check_output(command + ['--'] + options)
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+        results.append(result)
+        for run in ('cold', 'warm'):
+            print("%8d %5s %9.2f %9d %11.1f" % (
+                count, run, result[run]['seconds'], result[run]['requests'],
+                result['max_rss_mb']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+"""A local stand-in for the GitHub and GitLab APIs used by github2gitlab
+
+It serves the GitHub API under /github and the GitLab API under
+/api/v4 with --count synthetic pull requests::
+
+  PYTHONPATH=. python benchmarks/fake_api.py --count 1000 --port 8000
+
+  github2gitlab ... --gitlab-url http://127.0.0.1:8000
+
+(the GitHub URL is not an option, see bench_scale.py). Each answer is
+delayed by --latency seconds and each API allows --rate-limit requests
+per --rate-window seconds.
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib import parse
+
+from bench_records import pull
+
+PER_PAGE = 30
+
+MAX_PER_PAGE = 100
+
+
+class RateLimit(object):
+    "The request budget of an API, reset every window seconds"
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset = time.time() + window
+        self.remaining = limit
+
+    def take(self):
+        "Return (allowed, remaining, reset)"
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.reset = now + self.window
+                self.remaining = self.limit
+            if self.remaining <= 0:
+                return (False, 0, int(self.reset))
+            self.remaining -= 1
+            return (True, self.remaining, int(self.reset))
+
+
+class FakeAPI(object):
+    """The state of the repository mirrored and the handlers of the API
+
+    The pull requests are built with bench_records.pull and point to
+    the head commit; the merge requests, keys and projects created
+    are kept in memory.
+    """
+
+    def __init__(self, count, repo='user/repo', head=None,
+                 latency=0, rate_limit=None, rate_window=3600):
+        self.repo = repo
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.pulls = []
+        for n in range(count, 0, -1):
+            p = pull(n)
+            if head:
+                p['head']['sha'] = head
+            self.pulls.append(p)
+        self.pull_index = dict([(p['number'], p) for p in self.pulls])
+        self.merges = []
+        self.keys = []
+        self.projects = {}
+        self.branches = [{'name': 'master', 'protected': True}]
+        self.limits = {}
+        if rate_limit:
+            self.limits = {
+                'github': RateLimit(rate_limit, rate_window),
+                'gitlab': RateLimit(rate_limit, rate_window),
+            }
+        self.requests = 0
+        self.routes = (
+            ('github', 'GET', r'/github/repos/([^/]+/[^/]+)/pulls',
+             self.list_pulls),
+            ('github', 'GET', r'/github/repos/([^/]+/[^/]+)/pulls/(\d+)',
+             self.get_pull),
+            ('github', 'POST', r'/github/graphql', self.graphql),
+            ('gitlab', 'GET', r'/api/v4/user/keys', self.list_keys),
+            ('gitlab', 'POST', r'/api/v4/user/keys', self.add_key),
+            ('gitlab', 'GET', r'/api/v4/projects/([^/]+)', self.get_project),
+            ('gitlab', 'POST', r'/api/v4/projects', self.add_project),
+            ('gitlab', 'GET', r'/api/v4/projects/[^/]+/repository/branches',
+             self.list_branches),
+            ('gitlab', 'PUT',
+             r'/api/v4/projects/[^/]+/repository/branches/(.+)/unprotect',
+             self.unprotect),
+            ('gitlab', 'GET', r'/api/v4/projects/[^/]+/merge_requests',
+             self.list_merges),
+            ('gitlab', 'POST', r'/api/v4/projects/[^/]+/merge_requests',
+             self.add_merge),
+            ('gitlab', 'PUT', r'/api/v4/projects/[^/]+/merge_requests/(\d+)',
+             self.update_merge),
+        )
+
+    def handle(self, method, url, body):
+        "Return (status, headers, payload) of the request"
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        url = parse.urlparse(url)
+        query = dict(parse.parse_qsl(url.query))
+        if body.startswith(b'{'):
+            query['json'] = json.loads(body.decode('utf-8'))
+        elif body:
+            # application/x-www-form-urlencoded
+            query.update(parse.parse_qsl(body.decode('utf-8')))
+        for (api, route_method, pattern, handler) in self.routes:
+            m = re.match(pattern + '$', url.path)
+            if not m or route_method != method:
+                continue
+            headers = {}
+            if api in self.limits:
+                (allowed, remaining, reset) = self.limits[api].take()
+                prefix = 'X-' if api == 'github' else ''
+                headers[prefix + 'RateLimit-Limit'] = str(
+                    self.limits[api].limit)
+                headers[prefix + 'RateLimit-Remaining'] = str(remaining)
+                headers[prefix + 'RateLimit-Reset'] = str(reset)
+                if not allowed:
+                    headers['Retry-After'] = str(max(reset - time.time(), 1))
+                    return (429, headers, {'message': 'rate limited'})
+            with self.lock:
+                (status, extra, payload) = handler(url, query, *m.groups())
+            headers.update(extra)
+            return (status, headers, payload)
+        return (404, {}, {'message': '404 Not Found'})
+
+    @staticmethod
+    def paginate(url, query, items):
+        "Return the page of items and the Link header of the query"
+        per_page = min(int(query.get('per_page', PER_PAGE)), MAX_PER_PAGE)
+        page = int(query.get('page', 1))
+        last = max((len(items) + per_page - 1) // per_page, 1)
+        links = []
+        for (rel, number) in (('next', page + 1), ('last', last)):
+            if page < last:
+                q = dict(query)
+                q['page'] = str(number)
+                links.append('<http://' + url.netloc + url.path + '?' +
+                             parse.urlencode(sorted(q.items())) +
+                             '>; rel="' + rel + '"')
+        headers = {}
+        if links:
+            headers['Link'] = ', '.join(links)
+        start = (page - 1) * per_page
+        return (items[start:start + per_page], headers)
+
+    def list_pulls(self, url, query, repo):
+        "https://developer.github.com/v3/pulls/#list-pull-requests"
+        pulls = self.pulls
+        if query.get('state', 'open') != 'all':
+            pulls = [p for p in pulls if p['state'] == query['state']]
+        if query.get('sort') == 'updated':
+            pulls = sorted(pulls, key=lambda p: p['updated_at'],
+                           reverse=query.get('direction') != 'asc')
+        (page, headers) = self.paginate(url, query, pulls)
+        return (200, headers, page)
+
+    def get_pull(self, url, query, repo, number):
+        if int(number) not in self.pull_index:
+            return (404, {}, {'message': 'Not Found'})
+        return (200, {}, self.pull_index[int(number)])
+
+    def graphql(self, url, query, *args):
+        "The pullRequests connection of GRAPHQL_PULL_REQUESTS"
+        variables = query['json']['variables']
+        first = variables['first']
+        start = int(variables['cursor'] or 0)
+        pulls = sorted(self.pulls, key=lambda p: p['updated_at'],
+                       reverse=True)
+        nodes = []
+        for p in pulls[start:start + first]:
+            if p['state'] == 'open':
+                state = 'OPEN'
+            elif p['merged_at']:
+                state = 'MERGED'
+            else:
+                state = 'CLOSED'
+            nodes.append({
+                'number': p['number'],
+                'title': p['title'],
+                'body': p['body'],
+                'state': state,
+                'mergedAt': p['merged_at'],
+                'updatedAt': p['updated_at'],
+                'baseRefName': p['base']['ref'],
+                'headRefOid': p['head']['sha'],
+            })
+        return (200, {}, {'data': {'repository': {'pullRequests': {
+            'pageInfo': {'hasNextPage': start + first < len(pulls),
+                         'endCursor': str(start + first)},
+            'nodes': nodes,
+        }}}})
+
+    def list_keys(self, url, query):
+        return (200, {}, self.keys)
+
+    def add_key(self, url, query):
+        self.keys.append({'id': len(self.keys) + 1, 'title': query['title'],
+                          'key': query['key']})
+        return (201, {}, self.keys[-1])
+
+    def get_project(self, url, query, project):
+        if parse.unquote(project) not in self.projects:
+            return (404, {}, {'message': '404 Project Not Found'})
+        return (200, {}, self.projects[parse.unquote(project)])
+
+    def add_project(self, url, query):
+        path = query['namespace'] + '/' + query['name']
+        self.projects[path] = {'id': len(self.projects) + 1,
+                               'path_with_namespace': path}
+        return (201, {}, self.projects[path])
+
+    def list_branches(self, url, query):
+        return (200, {}, self.branches)
+
+    def unprotect(self, url, query, name):
+        for branch in self.branches:
+            if branch['name'] == parse.unquote(name):
+                branch['protected'] = False
+                return (200, {}, branch)
+        return (404, {}, {'message': '404 Branch Not Found'})
+
+    def list_merges(self, url, query):
+        "https://docs.gitlab.com/ee/api/merge_requests.html"
+        merges = self.merges
+        if 'source_branch' in query:
+            merges = [m for m in merges
+                      if m['source_branch'] == query['source_branch']]
+        if 'updated_after' in query:
+            merges = [m for m in merges
+                      if m['updated_at'] > query['updated_after']]
+        if 'iids[]' in query:
+            merges = [m for m in merges
+                      if str(m['iid']) == query['iids[]']]
+        if query.get('pagination') != 'keyset':
+            (page, headers) = self.paginate(url, query, merges)
+            return (200, headers, page)
+        # https://docs.gitlab.com/ee/api/#keyset-based-pagination
+        per_page = min(int(query.get('per_page', PER_PAGE)), MAX_PER_PAGE)
+        id_after = int(query.get('id_after', 0))
+        page = [m for m in merges if m['id'] > id_after][:per_page]
+        headers = {}
+        if len(page) == per_page:
+            q = dict(query)
+            q['id_after'] = str(page[-1]['id'])
+            headers['Link'] = ('<http://' + url.netloc + url.path + '?' +
+                               parse.urlencode(sorted(q.items())) +
+                               '>; rel="next"')
+        return (200, headers, page)
+
+    def add_merge(self, url, query):
+        iid = len(self.merges) + 1
+        merge = {
+            'id': 1000000 + iid,
+            'iid': iid,
+            'source_branch': query['source_branch'],
+            'target_branch': query['target_branch'],
+            'title': query['title'],
+            'description': query.get('description'),
+            'state': 'opened',
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+        self.merges.append(merge)
+        return (201, {}, merge)
+
+    def update_merge(self, url, query, iid):
+        merge = self.merges[int(iid) - 1]
+        for field in ('title', 'description'):
+            if field in query:
+                merge[field] = query[field]
+        event = query.get('state_event')
+        if event == 'close':
+            merge['state'] = 'closed'
+        elif event == 'reopen':
+            merge['state'] = 'opened'
+        # like GitLab, refuse to merge when there is nothing to merge
+        merge['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        return (200, {}, merge)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep the connections of the client pools alive
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately and Nagle
+    # would delay the body until the headers are acknowledged
+    disable_nagle_algorithm = True
+
+    def answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        (status, headers, payload) = self.server.api.handle(
+            self.command, self.path, body)
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, api, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), Handler)
+        self.api = api
+
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--count', type=int, default=1000,
+                        help='number of pull requests')
+    parser.add_argument('--head', help='sha of the pull requests heads')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to wait before each answer')
+    parser.add_argument('--rate-limit', type=int,
+                        help='requests allowed per --rate-window')
+    parser.add_argument('--rate-window', type=int, default=3600)
+    args = parser.parse_args()
+    server = Server(FakeAPI(args.count, head=args.head,
+                            latency=args.latency,
+                            rate_limit=args.rate_limit,
+                            rate_window=args.rate_window),
+                    args.host, args.port)
+    print("serving on " + server.url())
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
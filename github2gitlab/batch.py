@@ -0,0 +1,200 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import argparse
+from concurrent import futures
+import json
+import logging
+import os
+import threading
+
+from github2gitlab.main import GitHub2GitLab
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+log = logging.getLogger(__name__)
+
+
+class Batch(object):
+    """Mirror all the repositories listed in a manifest
+
+    The manifest is a JSON or YAML file such as::
+
+      defaults:
+        gitlab-url: http://workbench.dachary.org
+        gitlab-token: sxQJ67SQKihMrGWVf
+        github-token: 64933d355fda9844aadd4e224d
+      repos:
+        - github-repo: ceph/ceph
+          gitlab-repo: ceph/ceph-backports
+          ignore-closed: true
+        - github-repo: dachary/test
+
+    Each entry of repos and defaults is a github2gitlab command line
+    option without the leading --. The repos list can also be the
+    whole manifest when there are no defaults.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.git_slots = threading.BoundedSemaphore(self.args.git_jobs)
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+        if self.args.verbose:
+            level = logging.DEBUG
+        else:
+            level = logging.INFO
+        logging.getLogger('github2gitlab').setLevel(level)
+
+    @staticmethod
+    def get_parser():
+        parser = argparse.ArgumentParser(
+            description="migrate many projects from GitHub to GitLab")
+
+        parser.add_argument('--manifest',
+                            help='JSON or YAML list of repositories',
+                            required=True)
+        parser.add_argument('--workdir', default='.',
+                            help=('directory where the bare clones of the '
+                                  'repositories are kept, in a '
+                                  'subdirectory per GitLab namespace'))
+        parser.add_argument('--jobs', type=int, default=4,
+                            help='number of repositories mirrored at once')
+        parser.add_argument('--git-jobs', type=int, default=2,
+                            help='number of git commands run at once')
+        parser.add_argument('--verbose', action='store_const',
+                            const=True,
+                            help='enable verbose (debug) logging')
+        return parser
+
+    @staticmethod
+    def factory(argv):
+        return Batch(Batch.get_parser().parse_args(argv))
+
+    @staticmethod
+    def load_manifest(path):
+        "Return the (defaults, repos) of the manifest"
+        with open(path) as f:
+            if path.endswith('.json'):
+                manifest = json.load(f)
+            else:
+                if yaml is None:
+                    raise ValueError(path + ": PyYAML is required to "
+                                     "read a YAML manifest")
+                manifest = yaml.safe_load(f)
+        if isinstance(manifest, list):
+            return ({}, manifest)
+        return (manifest.get('defaults') or {}, manifest['repos'])
+
+    @staticmethod
+    def options2argv(options):
+        "Convert {'github-repo': 'a/b'} into ['--github-repo', 'a/b']"
+        argv = []
+        for (key, value) in sorted(options.items()):
+            option = '--' + key
+            if value is True:
+                argv.append(option)
+            elif value is False or value is None:
+                continue
+            else:
+                argv.extend([option, str(value)])
+        return argv
+
+    @staticmethod
+    def normalize(options):
+        "Accept both github_repo and github-repo as option names"
+        return dict([(key.replace('_', '-'), value)
+                     for (key, value) in options.items()])
+
+    def repo_args(self, defaults, repo):
+        "Return the arguments of the repo, raise ValueError if invalid"
+        repo = self.normalize(repo)
+        options = self.normalize(defaults)
+        options.update(repo)
+        try:
+            args = GitHub2GitLab.get_parser().parse_args(
+                self.options2argv(options))
+        except SystemExit:
+            # argparse already displayed why
+            raise ValueError(str(repo) + ": invalid options")
+        if args.record or args.replay:
+            # the repositories share the same clients and run at the
+            # same time, their requests cannot be told apart
+            raise ValueError(str(repo) + ": --record and --replay are "
+                             "not supported by github2gitlab-batch")
+        if 'workdir' not in repo:
+            # repositories with the same name in different namespaces
+            # must not share the same bare clone
+            gitlab_repo = args.gitlab_repo or args.github_repo
+            args.workdir = os.path.join(self.args.workdir,
+                                        gitlab_repo.split('/')[0])
+        if not os.path.exists(args.workdir):
+            os.makedirs(args.workdir)
+        return args
+
+    # the options used by GitHub2GitLab.github_client and gitlab_client
+    CLIENT_OPTIONS = ('pool_size', 'max_retries', 'etag_cache', 'cache_dir')
+
+    def client(self, remote, args):
+        """Return the client shared by the repositories using the same token
+
+        The repositories that set different client options in the
+        manifest do not share the same client.
+        """
+        key = ((remote, getattr(args, remote + '_token')) +
+               tuple([getattr(args, option)
+                      for option in self.CLIENT_OPTIONS]))
+        with self.clients_lock:
+            if key not in self.clients:
+                factory = getattr(GitHub2GitLab, remote + '_client')
+                self.clients[key] = factory(args)
+            return self.clients[key]
+
+    def mirror(self, args):
+        g = GitHub2GitLab(args,
+                          github_client=self.client('github', args),
+                          gitlab_client=self.client('gitlab', args),
+                          git_slots=self.git_slots)
+        return g.run()
+
+    def run(self):
+        (defaults, repos) = self.load_manifest(self.args.manifest)
+        failed = 0
+        with futures.ThreadPoolExecutor(self.args.jobs) as executor:
+            jobs = {}
+            for repo in repos:
+                try:
+                    args = self.repo_args(defaults, repo)
+                except Exception:
+                    log.exception(str(repo) + " failed")
+                    failed += 1
+                    continue
+                jobs[executor.submit(self.mirror, args)] = args.github_repo
+            for job in futures.as_completed(jobs):
+                try:
+                    job.result()
+                    log.info(jobs[job] + " mirrored")
+                except Exception:
+                    log.exception(jobs[job] + " failed")
+                    failed += 1
+        if failed:
+            log.error(str(failed) + " of " + str(len(repos)) +
+                      " repositories failed")
+            return 1
+        return 0
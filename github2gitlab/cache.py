@@ -0,0 +1,379 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from six.moves.urllib import parse
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = '~/.cache/github2gitlab'
+
+# seconds a listing is served from the ListingCache
+LISTING_TTL = 24 * 60 * 60
+
+# bytes used by the ListingCache of all repositories
+LISTING_MAX_SIZE = 1024 * 1024 * 1024
+
+# bytes used by the bare clones of the MirrorCache
+MIRROR_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# (task, seconds between two runs, git arguments) run by
+# MirrorCache.maintain, in order
+MAINTENANCE = (
+    # the refs/pull/* fetched are loose refs
+    ('pack-refs', 60 * 60, ['pack-refs', '--all']),
+    ('commit-graph', 60 * 60,
+     ['commit-graph', 'write', '--reachable', '--split']),
+    # merge the small packs of each fetch into fewer, larger, packs
+    # and index them all with a multi-pack-index
+    ('geometric-repack', 24 * 60 * 60,
+     ['repack', '-d', '--geometric=2', '--write-midx']),
+    # remove what the pull requests that were closed left behind
+    ('gc', 7 * 24 * 60 * 60, ['gc', '--quiet', '--prune=2.weeks.ago']),
+)
+
+# git config of the bare clones of the MirrorCache
+MIRROR_CONFIG = (
+    # the maintenance is done by MirrorCache.maintain, not by fetch
+    ('gc.auto', '0'),
+    ('maintenance.auto', 'false'),
+    # keep what is fetched as a pack instead of loose objects
+    ('fetch.unpackLimit', '1'),
+    ('core.commitGraph', 'true'),
+    # the many refs/pull/* make the default negotiation slow
+    ('fetch.negotiationAlgorithm', 'skipping'),
+)
+
+
+class ConditionalCache(object):
+    """Persistent store of response bodies and their validators
+
+    https://developer.github.com/v3/#conditional-requests
+    """
+
+    # response headers replayed when the server answers 304 Not Modified
+    HEADERS = ('Link', 'ETag', 'Last-Modified', 'Content-Type')
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def key(url, params):
+        query = parse.urlencode(sorted((params or {}).items()))
+        return hashlib.sha1((url + "?" + query).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key):
+        try:
+            with open(self.path(key), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, response):
+        entry = {
+            'headers': dict([(h, response.headers[h])
+                             for h in self.HEADERS
+                             if h in response.headers]),
+            'body': response.text,
+        }
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self.path(key))
+
+    @staticmethod
+    def validators(entry):
+        "Return the headers making a request conditional on entry"
+        headers = {}
+        if 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+
+class ListingCache(object):
+    """Bounded store of listings, one JSON document per line
+
+    The entries are keyed on the URL, the query and the identity of
+    the token used to list them. They are written to a temporary file
+    renamed in place once complete, so that concurrent runs and
+    repositories can share the same directory. When the entries use
+    more than max_size bytes, the least recently used are removed.
+    """
+
+    # a temporary file older than this was left by a process that died
+    STALE = 60 * 60
+
+    def __init__(self, directory, max_size=LISTING_MAX_SIZE,
+                 compress=False):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.max_size = max_size
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.statistics = {'hits': 0, 'misses': 0, 'stores': 0,
+                           'evictions': 0}
+
+    @staticmethod
+    def key(url, params, identity):
+        "identity is a digest of the token, not the token itself"
+        query = parse.urlencode(sorted((params or {}).items()))
+        return hashlib.sha1((identity + " " + url + "?" +
+                             query).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        if self.compress:
+            return os.path.join(self.directory, key + ".jsonl.gz")
+        return os.path.join(self.directory, key + ".jsonl")
+
+    def count(self, name):
+        with self.lock:
+            self.statistics[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.statistics)
+
+    def open(self, fd, mode):
+        f = os.fdopen(fd, mode + 'b')
+        if self.compress:
+            f = gzip.GzipFile(fileobj=f, mode=mode + 'b')
+        return io.TextIOWrapper(f, encoding='utf-8')
+
+    def load(self, key, ttl):
+        """Return an iterator over the lines of the entry
+
+        Return None if there is no entry or it is older than ttl seconds.
+        """
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > ttl:
+                raise OSError(path + " expired")
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            self.count('misses')
+            return None
+        # the access time orders the entries for eviction
+        os.utime(path, (time.time(), stat.st_mtime))
+        self.count('hits')
+        return self.lines(fd)
+
+    def lines(self, fd):
+        with self.open(fd, 'r') as f:
+            for line in f:
+                yield line
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        "Return a file to write the entry to, it is stored on success"
+        (fd, tmp) = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with self.open(fd, 'w') as f:
+                yield f
+            os.rename(tmp, self.path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self.count('stores')
+        self.evict()
+
+    def evict(self):
+        "Remove the least recently used entries until under max_size"
+        entries = []
+        size = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if name.startswith('.tmp'):
+                    if now - stat.st_mtime > self.STALE:
+                        os.unlink(path)
+                    continue
+            except OSError:
+                # removed by a concurrent run
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+            size += stat.st_size
+        for (atime, entry_size, path) in sorted(entries):
+            if size <= self.max_size:
+                break
+            log.debug("evict " + path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            size -= entry_size
+            self.count('evictions')
+
+
+class MirrorCache(object):
+    """Bare clones kept from one run to the next
+
+    Each bare clone is used while holding a lock (flock) on a file
+    next to it, which is touched when it is released to order the
+    bare clones for eviction. The git MAINTENANCE tasks that are due
+    are run on a bare clone after it was mirrored and the least
+    recently used bare clones that are not locked are removed when
+    they use more than max_size bytes.
+    """
+
+    # the time each MAINTENANCE task last ran, in the bare clone
+    SCHEDULE = 'github2gitlab-maintenance.json'
+
+    def __init__(self, directory, max_size=MIRROR_MAX_SIZE):
+        self.directory = os.path.expanduser(directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.statistics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".git")
+
+    def count(self, name):
+        with self.lock:
+            self.statistics[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.statistics)
+
+    @contextlib.contextmanager
+    def use(self, name):
+        "Lock the bare clone name while in the with block, wait if needed"
+        lock = os.path.join(self.directory, name + ".lock")
+        with open(lock, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                log.info("waiting for " + lock + " held by another run")
+                fcntl.flock(f, fcntl.LOCK_EX)
+            if os.path.exists(self.path(name)):
+                self.count('hits')
+            else:
+                self.count('misses')
+            try:
+                yield self.path(name)
+            finally:
+                os.utime(lock, None)
+
+    def schedule(self, path):
+        "Return the task => time it last ran of the bare clone in path"
+        try:
+            with open(os.path.join(path, self.SCHEDULE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def maintain(self, path, git, now=None):
+        """Run the MAINTENANCE tasks that are due on the bare clone in path
+
+        git(args) runs git with args in path. A task that fails is
+        logged and tried again by the next run. Return the tasks run.
+        """
+        if now is None:
+            now = time.time()
+        schedule = self.schedule(path)
+        # the MIRROR_CONFIG may change from one version to the next
+        config = [list(option) for option in MIRROR_CONFIG]
+        due = []
+        if schedule.get('config') != config:
+            due.append(('config', config,
+                        [['config', name, value]
+                         for (name, value) in MIRROR_CONFIG]))
+        for (task, interval, args) in MAINTENANCE:
+            if now - schedule.get(task, 0) >= interval:
+                due.append((task, now, [args]))
+        tasks = []
+        for (task, done, commands) in due:
+            log.debug("maintenance " + task + " of " + path)
+            try:
+                for args in commands:
+                    git(args)
+            except Exception:
+                log.warning("maintenance " + task + " of " + path +
+                            " failed", exc_info=True)
+                continue
+            schedule[task] = done
+            tasks.append(task)
+        (fd, tmp) = tempfile.mkstemp(dir=path, prefix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(schedule, f)
+        os.rename(tmp, os.path.join(path, self.SCHEDULE))
+        return tasks
+
+    @staticmethod
+    def size(path):
+        size = 0
+        for (directory, dirs, files) in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(directory, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def evict(self):
+        """Remove the least recently used bare clones until under max_size
+
+        The bare clones locked by a run count but are not removed.
+        """
+        entries = []
+        size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.lock'):
+                continue
+            lock = os.path.join(self.directory, name)
+            entry_size = self.size(self.path(name[:-len('.lock')]))
+            entries.append((os.stat(lock).st_mtime, entry_size, lock))
+            size += entry_size
+        for (mtime, entry_size, lock) in sorted(entries):
+            if size <= self.max_size:
+                break
+            if entry_size == 0:
+                continue
+            path = self.path(os.path.basename(lock)[:-len('.lock')])
+            with open(lock, 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    log.debug(path + " is used by another run, not evicted")
+                    continue
+                log.info("evict " + path + " (" + str(entry_size) +
+                         " bytes) from the mirror cache")
+                shutil.rmtree(path, ignore_errors=True)
+            size -= entry_size
+            self.count('evictions')
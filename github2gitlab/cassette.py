@@ -0,0 +1,195 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import collections
+import gzip
+import io
+import json
+import logging
+import os
+import requests
+from requests.structures import CaseInsensitiveDict
+import threading
+import time
+from six.moves.urllib import parse
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+# query parameters that depend on the time of the run and are
+# ignored when looking up a recorded response
+VOLATILE = ('updated_after',)
+
+# response headers that are not recorded
+IGNORED_HEADERS = ('Set-Cookie',)
+
+SCRUBBED = 'SCRUBBED'
+
+
+class Cassette(object):
+    """The HTTP requests of a run and their responses, recorded or replayed
+
+    When recording, each request sent by a Client is written with its
+    response and the time it took, one JSON document per line, to a
+    gzip file. The request headers are not recorded and the secrets
+    (the tokens) are replaced with SCRUBBED everywhere else.
+
+    When replaying, no request is sent and the recorded responses are
+    served in the order they were recorded, waiting as long as they
+    took when latency=True. Raise ValueError if a request was not
+    recorded.
+    """
+
+    def __init__(self, path, mode, secrets=(), latency=False,
+                 sleep=time.sleep):
+        self.path = os.path.expanduser(path)
+        self.mode = mode
+        self.secrets = [secret for secret in secrets if secret]
+        self.latency = latency
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        if mode == 'record':
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            self.f = io.TextIOWrapper(gzip.open(self.path, 'wb'),
+                                      encoding='utf-8')
+            self.f.write(json.dumps({'version': VERSION}) + "\n")
+            self.recorded = 0
+        elif mode == 'replay':
+            self.responses = self.load()
+        else:
+            raise ValueError(mode + " is not record or replay")
+
+    @staticmethod
+    def record(path, secrets=()):
+        return Cassette(path, 'record', secrets=secrets)
+
+    @staticmethod
+    def replay(path, latency=False):
+        return Cassette(path, 'replay', latency=latency)
+
+    def load(self):
+        "Return the key => deque of recorded responses"
+        responses = collections.defaultdict(collections.deque)
+        with io.TextIOWrapper(gzip.open(self.path, 'rb'),
+                              encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+                if header.get('version') != VERSION:
+                    raise ValueError(self.path + " is version " +
+                                     str(header.get('version')) +
+                                     " instead of " + str(VERSION))
+                for line in f:
+                    entry = json.loads(line)
+                    responses[entry['key']].append(entry)
+            except EOFError:
+                # the recording run was interrupted
+                log.warning(self.path + " is truncated")
+        log.debug("loaded " + str(sum(map(len, responses.values()))) +
+                  " responses from " + self.path)
+        return responses
+
+    def scrub(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, SCRUBBED)
+        return text
+
+    @staticmethod
+    def canonical(values):
+        "Return values (dict, list of pairs, str, ...) as a sorted list"
+        if values is None:
+            return []
+        if isinstance(values, dict):
+            values = values.items()
+        elif not isinstance(values, (list, tuple)):
+            return [str(values)]
+        canonical = []
+        for (name, value) in values:
+            if name in VOLATILE:
+                value = '*'
+            elif isinstance(value, (list, tuple)):
+                value = [str(v) for v in value]
+            else:
+                value = str(value)
+            canonical.append([name, value])
+        return sorted(canonical)
+
+    def key(self, method, url, kwargs):
+        "Return what identifies the request, without the secrets"
+        url = parse.urlparse(url)
+        query = parse.parse_qsl(url.query)
+        return self.scrub(json.dumps([
+            method,
+            parse.urlunparse(url._replace(query='')),
+            # the page=2 of a Link is in the URL or in params
+            sorted(self.canonical(query) +
+                   self.canonical(kwargs.get('params'))),
+            self.canonical(kwargs.get('data')),
+            kwargs.get('json'),
+        ], sort_keys=True))
+
+    def send(self, session, method, url, kwargs):
+        "Send the request with session (or replay it), return the response"
+        key = self.key(method, url, kwargs)
+        if self.mode == 'replay':
+            return self.play(key, url)
+        start = time.time()
+        response = getattr(session, method.lower())(url, **kwargs)
+        elapsed = time.time() - start
+        headers = dict([(name, self.scrub(value))
+                        for (name, value) in response.headers.items()
+                        if name not in IGNORED_HEADERS])
+        entry = {
+            'key': key,
+            'status': response.status_code,
+            'headers': headers,
+            'body': self.scrub(response.text),
+            'elapsed': elapsed,
+        }
+        with self.lock:
+            self.f.write(json.dumps(entry) + "\n")
+            self.recorded += 1
+        return response
+
+    def play(self, key, url):
+        with self.lock:
+            recorded = self.responses.get(key)
+            if not recorded:
+                raise ValueError(url + " was not recorded in " + self.path +
+                                 ": " + key)
+            if len(recorded) > 1:
+                entry = recorded.popleft()
+            else:
+                # the last response is served to the requests that
+                # follow, for instance when the run is retried
+                entry = recorded[0]
+        if self.latency:
+            self.sleep(entry['elapsed'])
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.url = url
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body'].encode('utf-8')
+        return response
+
+    def close(self):
+        if self.mode == 'record':
+            with self.lock:
+                self.f.close()
+            log.info("recorded " + str(self.recorded) + " responses in " +
+                     self.path)
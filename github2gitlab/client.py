@@ -0,0 +1,291 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import copy
+import hashlib
+import json
+import logging
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import threading
+import time
+from urllib3 import exceptions as urllib3_exceptions
+
+log = logging.getLogger(__name__)
+
+POOL_SIZE = 10
+
+MAX_RETRIES = 5
+
+# the methods that can be sent again if the response was lost
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+class RateLimiter(object):
+    """Pace the requests to a remote according to its rate limit
+
+    https://developer.github.com/v3/#rate-limiting
+    https://docs.gitlab.com/ee/user/admin_area/settings/user_and_ip_rate_limits.html
+    """
+
+    # (remaining, limit, reset) headers of GitHub and GitLab
+    HEADERS = (
+        ('X-RateLimit-Remaining', 'X-RateLimit-Limit', 'X-RateLimit-Reset'),
+        ('RateLimit-Remaining', 'RateLimit-Limit', 'RateLimit-Reset'),
+    )
+
+    # pacing starts when less than this fraction of the limit remains
+    LOW = 0.1
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff=1.0,
+                 sleep=time.sleep):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.limit = None
+        self.reset = None
+        self.not_before = 0
+
+    def update(self, response):
+        "Record the budget advertised by the headers of response"
+        for (remaining, limit, reset) in self.HEADERS:
+            if remaining in response.headers:
+                with self.lock:
+                    self.remaining = int(response.headers[remaining])
+                    if limit in response.headers:
+                        self.limit = int(response.headers[limit])
+                    if reset in response.headers:
+                        self.reset = int(response.headers[reset])
+                return
+
+    def interval(self, now):
+        "Return the delay to keep between requests to not run out of budget"
+        if self.remaining is None or self.reset is None:
+            return 0
+        window = max(self.reset - now, 0)
+        if self.remaining <= 0:
+            return window
+        if self.limit and self.remaining > self.limit * self.LOW:
+            return 0
+        return window / self.remaining
+
+    def wait(self):
+        "Sleep until the next request is allowed"
+        with self.lock:
+            now = time.time()
+            start = max(now, self.not_before)
+            self.not_before = start + self.interval(start)
+            if self.remaining:
+                # account for the requests in flight
+                self.remaining -= 1
+        if start > now:
+            log.debug("rate limit: wait " + str(start - now) + " seconds")
+            self.sleep(start - now)
+
+    def retry_after(self, response, attempt, idempotent=True):
+        """Return how long to wait before retrying response, None if it fails
+
+        A request that is not idempotent is only retried when it was
+        rate limited, because a server error does not tell if it was
+        carried out.
+        """
+        status = response.status_code
+        exhausted = response.headers.get('X-RateLimit-Remaining') == '0'
+        if not (status == 429 or (status >= 500 and idempotent) or
+                (status == 403 and exhausted)):
+            return None
+        if attempt >= self.max_retries:
+            return None
+        if 'Retry-After' in response.headers:
+            try:
+                return float(response.headers['Retry-After'])
+            except ValueError:
+                pass
+        if exhausted and self.reset:
+            return max(self.reset - time.time(), 0) + 1
+        return self.jitter(attempt)
+
+    def jitter(self, attempt):
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class Client(object):
+    "HTTP client keeping connections to one remote (GitHub or GitLab) alive"
+
+    def __init__(self, headers=None, pool_size=POOL_SIZE,
+                 conditional_cache=None, rate_limiter=None, name=None):
+        self.name = name
+        # the Metrics recording the requests, if any
+        self.metrics = None
+        # the Cassette recording or replaying the requests, if any
+        self.cassette = None
+        self.conditional_cache = conditional_cache
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        # tells apart what was listed with another token, without
+        # revealing it, see ListingCache
+        self.identity = hashlib.sha1(json.dumps(
+            sorted((headers or {}).items())).encode('utf-8')).hexdigest()
+
+    def bind(self, metrics=None, cassette=None):
+        """Return a client recording its requests in metrics and cassette
+
+        It shares the connections, the rate limit and the cache of this
+        client, which may be used by other repositories at the same time.
+        """
+        client = copy.copy(self)
+        client.metrics = metrics
+        client.cassette = cassette
+        return client
+
+    @staticmethod
+    def github(token=None, **kwargs):
+        "https://developer.github.com/v3/#authentication"
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        if token:
+            headers['Authorization'] = 'token ' + token
+        return Client(headers, name='github', **kwargs)
+
+    @staticmethod
+    def gitlab(token, **kwargs):
+        "https://docs.gitlab.com/ce/api/#personal-access-tokens"
+        return Client({'PRIVATE-TOKEN': token}, name='gitlab', **kwargs)
+
+    @staticmethod
+    def connect_failed(e):
+        "True if the request failed before it was sent to the server"
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        reason = e.args[0] if e.args else None
+        # requests wraps the urllib3 error in a MaxRetryError
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, urllib3_exceptions.NewConnectionError)
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        limiter = self.rate_limiter
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT
+        attempt = 0
+        while True:
+            limiter.wait()
+            log.debug(method + " " + url + " " + str(kwargs.get('params')))
+            start = time.time()
+            try:
+                response = self.send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.observe(method, url, start)
+                if (attempt >= limiter.max_retries or
+                        not (idempotent or self.connect_failed(e))):
+                    raise
+                delay = limiter.jitter(attempt)
+                log.warning(method + " " + url + " failed with " + str(e) +
+                            ", retry in " + str(delay) + " seconds")
+            else:
+                limiter.update(response)
+                self.observe(method, url, start, response)
+                delay = limiter.retry_after(response, attempt, idempotent)
+                if delay is None:
+                    return response
+                log.warning(method + " " + url + " returned " +
+                            str(response.status_code) + ", retry in " +
+                            str(delay) + " seconds")
+            limiter.sleep(delay)
+            attempt += 1
+
+    def send(self, method, url, **kwargs):
+        if self.cassette is None:
+            return getattr(self.session, method.lower())(url, **kwargs)
+        return self.cassette.send(self.session, method, url, kwargs)
+
+    def observe(self, method, url, start, response=None):
+        "Record the request with the Metrics, response is None if it failed"
+        metrics = self.metrics
+        if metrics is None:
+            return
+        if response is None:
+            metrics.request(self.name, method, url, 'error',
+                            time.time() - start, 0)
+            return
+        metrics.request(self.name, method, url, response.status_code,
+                        time.time() - start, len(response.content))
+        limiter = self.rate_limiter
+        if limiter.remaining is not None:
+            metrics.rate_limit(self.name, limiter.remaining, limiter.limit)
+
+    def get(self, url, **kwargs):
+        if self.conditional_cache is None:
+            return self.request('GET', url, **kwargs)
+        return self.conditional_get(url, **kwargs)
+
+    def conditional_get(self, url, **kwargs):
+        "GET url and serve the stored body if it was not modified"
+        cache = self.conditional_cache
+        key = cache.key(url, kwargs.get('params'))
+        entry = cache.load(key)
+        if entry:
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers.update(cache.validators(entry))
+            kwargs['headers'] = headers
+        response = self.request('GET', url, **kwargs)
+        if (response.status_code == requests.codes.not_modified and
+                entry):
+            log.debug(url + " not modified, use cached body")
+            self.count_cache('hits')
+            return self.cached_response(response, entry)
+        self.count_cache('misses')
+        if (response.status_code == requests.codes.ok and
+                ('ETag' in response.headers or
+                 'Last-Modified' in response.headers)):
+            cache.store(key, response)
+        return response
+
+    def count_cache(self, counter):
+        if self.metrics is not None:
+            self.metrics.cache('etag', counter)
+
+    @staticmethod
+    def cached_response(not_modified, entry):
+        "Turn a 304 Not Modified response into the cached 200 response"
+        response = requests.Response()
+        response.status_code = requests.codes.ok
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict(not_modified.headers)
+        response.headers.update(entry['headers'])
+        response._content = entry['body'].encode('utf-8')
+        return response
+
+    def post(self, url, idempotent=False, **kwargs):
+        "idempotent=True if the POST can be retried (GraphQL queries)"
+        return self.request('POST', url, idempotent=idempotent, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def close(self):
+        self.session.close()
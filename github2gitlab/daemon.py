@@ -0,0 +1,279 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import copy
+import hashlib
+import hmac
+import json
+import logging
+import os
+from six.moves import BaseHTTPServer
+import threading
+import time
+
+from github2gitlab.main import GitHub2GitLab
+
+log = logging.getLogger(__name__)
+
+# GitHub does not send webhook payloads larger than 25MB
+PAYLOAD_MAX = 25 * 1024 * 1024
+
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > PAYLOAD_MAX:
+            (status, message) = (413, "payload too large")
+        else:
+            body = self.rfile.read(length)
+            (status, message) = self.server.webhooks.receive(self.headers,
+                                                             body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write((message + "\n").encode('utf-8'))
+
+    def log_message(self, format, *args):
+        log.debug(self.address_string() + " " + (format % args))
+
+
+class Daemon(object):
+    """Mirror the pull requests and branches GitHub webhooks report
+
+    The push and pull_request webhooks POSTed to the endpoint are
+    queued and mirrored --coalesce-delay seconds after they are
+    received, so that a burst of events about the same pull request
+    or ref is mirrored once. A pull request is mirrored by fetching
+    and pushing its refs and updating its merge request only. A full
+    github2gitlab run reconciles everything at startup and every
+    --reconcile-interval seconds.
+
+    A recorded webhook can be replayed with::
+
+      curl -H 'X-GitHub-Event: pull_request' \\
+           -H 'X-Hub-Signature-256: sha256=...' \\
+           --data @pull_request.json http://127.0.0.1:8080/
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.github_client = GitHub2GitLab.github_client(args)
+        self.gitlab_client = GitHub2GitLab.gitlab_client(args)
+        # (kind, pull request number or ref) => [received, payload]
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.reconciled_at = None
+        self.stopping = False
+
+        if self.args.verbose:
+            level = logging.DEBUG
+        else:
+            level = logging.INFO
+        logging.getLogger('github2gitlab').setLevel(level)
+
+        if self.args.insecure_webhooks:
+            log.warning("--insecure-webhooks: the signature of the "
+                        "webhooks is not verified")
+
+    @staticmethod
+    def get_parser():
+        parser = GitHub2GitLab.get_parser()
+        parser.description = ("mirror a project from GitHub to GitLab "
+                              "as GitHub webhooks are received")
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='address the webhook endpoint listens to')
+        parser.add_argument('--port', type=int, default=8080,
+                            help='port the webhook endpoint listens to')
+        parser.add_argument('--webhook-secret',
+                            default=os.environ.get(
+                                'GITHUB2GITLAB_WEBHOOK_SECRET'),
+                            help=('secret of the GitHub webhook, defaults '
+                                  'to $GITHUB2GITLAB_WEBHOOK_SECRET'))
+        parser.add_argument('--insecure-webhooks', action='store_const',
+                            const=True,
+                            help=('accept the webhooks without verifying '
+                                  'their signature (for local testing '
+                                  'only)'))
+        parser.add_argument('--coalesce-delay', type=float, default=5,
+                            help=('number of seconds to wait for more '
+                                  'events about the same pull request or '
+                                  'ref before mirroring it'))
+        parser.add_argument('--reconcile-interval', type=int,
+                            default=60 * 60,
+                            help=('number of seconds between two full '
+                                  'synchronizations'))
+        return parser
+
+    @staticmethod
+    def factory(argv):
+        parser = Daemon.get_parser()
+        args = parser.parse_args(argv)
+        if args.record or args.replay:
+            parser.error("--record and --replay are not supported by "
+                         "github2gitlab-daemon")
+        if not args.webhook_secret and not args.insecure_webhooks:
+            parser.error("--webhook-secret is required, unless "
+                         "--insecure-webhooks is set")
+        return Daemon(args)
+
+    @staticmethod
+    def verify(secret, body, signature):
+        "https://developer.github.com/webhooks/securing/"
+        if (not secret or not signature or
+                not signature.startswith('sha256=')):
+            return False
+        digest = hmac.new(secret.encode('utf-8'), body,
+                          hashlib.sha256).hexdigest()
+        return hmac.compare_digest('sha256=' + digest, signature)
+
+    def receive(self, headers, body):
+        "Queue the webhook and return the (status, message) of the reply"
+        if (not self.args.insecure_webhooks and
+                not self.verify(self.args.webhook_secret, body,
+                                headers.get('X-Hub-Signature-256'))):
+            log.warning("webhook with an invalid signature, ignore")
+            return (401, "invalid signature")
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return (400, "invalid JSON payload")
+        if self.submit(headers.get('X-GitHub-Event'), payload):
+            return (202, "queued")
+        return (200, "ignored")
+
+    def key(self, event, payload):
+        "Return what the event is about or None if it is ignored"
+        repository = payload.get('repository') or {}
+        if (repository.get('full_name', '').lower() !=
+                self.args.github_repo.lower()):
+            return None
+        if event == 'pull_request' and not self.args.skip_pull_requests:
+            return ('pull', str(payload['number']))
+        if event == 'push':
+            return ('ref', payload['ref'])
+        return None
+
+    def submit(self, event, payload):
+        "Queue the event, return False if it is ignored"
+        key = self.key(event, payload)
+        if key is None:
+            log.debug("ignore " + str(event) + " event")
+            return False
+        with self.condition:
+            if key in self.pending:
+                log.debug("coalesce " + str(event) + " event " + str(key))
+                self.pending[key][1] = payload
+            else:
+                log.debug("queue " + str(event) + " event " + str(key))
+                self.pending[key] = [time.time(), payload]
+            self.condition.notify()
+        return True
+
+    def take(self, now):
+        "Remove and return the (key, payload) received --coalesce-delay ago"
+        with self.condition:
+            due = sorted([(received, key)
+                          for (key, (received, payload))
+                          in self.pending.items()
+                          if received + self.args.coalesce_delay <= now])
+            return [(key, self.pending.pop(key)[1]) for (received, key) in due]
+
+    def timeout(self, now):
+        "Return how long to wait for the next event or reconciliation"
+        deadlines = [self.reconciled_at + self.args.reconcile_interval]
+        deadlines += [received + self.args.coalesce_delay
+                      for (received, payload) in self.pending.values()]
+        return max(min(deadlines) - now, 0)
+
+    def mirror(self):
+        "Return a GitHub2GitLab sharing the HTTP clients of the daemon"
+        # GitHub2GitLab modifies the args it is given
+        return GitHub2GitLab(copy.copy(self.args),
+                             github_client=self.github_client,
+                             gitlab_client=self.gitlab_client)
+
+    def reconcile(self):
+        start = time.time()
+        self.reconciled_at = start
+        log.info("reconcile " + self.args.github_repo)
+        try:
+            self.mirror().run()
+        except Exception:
+            log.exception("reconciliation of " + self.args.github_repo +
+                          " failed")
+            return
+        with self.condition:
+            # the events received before the reconciliation are mirrored
+            for (key, (received, payload)) in list(self.pending.items()):
+                if received < start:
+                    del self.pending[key]
+
+    def process(self, key, payload):
+        (kind, name) = key
+        log.info("mirror " + kind + " " + name)
+        g = self.mirror()
+        try:
+            with g.mirror_lock():
+                if kind == 'pull':
+                    # the payload of coalesced events may be out of date
+                    g.mirror_pull(g.get_pull_request(name))
+                else:
+                    g.mirror_ref(name, payload.get('deleted'))
+        except Exception:
+            log.exception("mirror " + kind + " " + name + " failed, "
+                          "the next reconciliation will catch up")
+
+    def step(self):
+        "Reconcile or mirror the events that are due, wait if there are none"
+        now = time.time()
+        if (self.reconciled_at is None or
+                now - self.reconciled_at >= self.args.reconcile_interval):
+            self.reconcile()
+            return
+        due = self.take(now)
+        for (key, payload) in due:
+            self.process(key, payload)
+        if due:
+            return
+        with self.condition:
+            if not self.stopping:
+                self.condition.wait(self.timeout(time.time()))
+
+    def server(self):
+        server = BaseHTTPServer.HTTPServer((self.args.host, self.args.port),
+                                           WebhookHandler)
+        server.webhooks = self
+        return server
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def run(self):
+        server = self.server()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log.info("listen to webhooks on http://%s:%d/" %
+                 server.server_address[:2])
+        try:
+            while not self.stopping:
+                self.step()
+        finally:
+            server.shutdown()
+            server.server_close()
+        return 0
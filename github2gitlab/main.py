@@ -18,8 +18,9 @@
 # along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
 #
 import argparse
+from concurrent import futures
+import contextlib
 import git
-import gitdb
 import hashlib
 import json
 import logging
@@ -29,11 +30,43 @@ import requests
 import six
 from six.moves.urllib import parse
 import subprocess
+import threading
 import time
 import shutil
 
+from github2gitlab.cache import (CACHE_DIR, ConditionalCache, LISTING_TTL,
+                                 ListingCache, MIRROR_MAX_SIZE,
+                                 MirrorCache)
+from github2gitlab.cassette import Cassette
+from github2gitlab.client import Client, MAX_RETRIES, POOL_SIZE, RateLimiter
+from github2gitlab.metrics import Metrics
+from github2gitlab.records import MergeRequest, PullRequest
+from github2gitlab import runner
+from github2gitlab.state import State
+
 DESCRIPTION_MAX = 1024
 
+# the maximum page size of both the GitHub and GitLab APIs
+PER_PAGE = 100
+
+# the git commands that report their progress with --progress
+PROGRESS_COMMANDS = ('clone', 'fetch', 'push')
+
+# https://developer.github.com/v4/object/pullrequest/
+GRAPHQL_PULL_REQUESTS = """
+query($owner: String!, $name: String!, $first: Int!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: $first, after: $cursor,
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number title body state mergedAt updatedAt baseRefName headRefOid
+      }
+    }
+  }
+}
+"""
+
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
 
 log = logging.getLogger(__name__)
@@ -48,7 +81,14 @@ class GitHub2GitLab(object):
         'close': 'closed',
     }
 
-    def __init__(self, args):
+    PULL_FIELD2MERGE_FIELD = {
+        'state': 'state',
+        'body': 'description',
+        'title': 'title',
+    }
+
+    def __init__(self, args, github_client=None, gitlab_client=None,
+                 git_slots=None):
         self.args = args
 
         self.args.ssh_public_key = os.path.expanduser(
@@ -60,12 +100,38 @@ class GitHub2GitLab(object):
         (self.args.gitlab_namespace,
          self.args.gitlab_name) = self.args.gitlab_repo.split('/')
         self.args.gitlab_repo = parse.quote_plus(self.args.gitlab_repo)
+        self.args.cache_dir = os.path.expanduser(self.args.cache_dir)
 
+        # github2gitlab-batch and the daemon share their clients with the
+        # instances they create and set the logging level themselves
+        shared = github_client is not None or gitlab_client is not None
+
+        self.metrics = Metrics(self.args.github_repo)
+        self.cassette = self.open_cassette(self.args)
+        if github_client is None:
+            github_client = self.github_client(self.args)
+        if gitlab_client is None:
+            gitlab_client = self.gitlab_client(self.args)
+        # the clients may be shared with other instances, the requests
+        # of this one are measured with its own metrics
+        github_client = github_client.bind(self.metrics, self.cassette)
+        gitlab_client = gitlab_client.bind(self.metrics, self.cassette)
+        # limits the number of git commands run at the same time
+        # by GitHub2GitLab instances sharing it
+        self.git_slots = git_slots
+        # refname => sha of the bare clone, see load_refs
+        self.refs = None
+        # ref_index is called by the sync_pull threads
+        self.refs_lock = threading.Lock()
+        # see state_store
+        self.state = None
         self.github = {
             'url': "https://api.github.com",
+            'graphql': "https://api.github.com/graphql",
             'git': "https://github.com",
             'repo': self.args.github_repo,
             'token': self.args.github_token,
+            'client': github_client,
         }
         if self.args.branches:
             self.github['branches'] = self.args.branches.split(',')
@@ -77,16 +143,48 @@ class GitHub2GitLab(object):
             'url': self.args.gitlab_url + "/api/v4",
             'repo': self.args.gitlab_repo,
             'token': self.args.gitlab_token,
+            'client': gitlab_client,
         }
 
-        if self.args.verbose:
-            level = logging.DEBUG
+        if not shared:
+            if self.args.verbose:
+                level = logging.DEBUG
+            else:
+                level = logging.INFO
+            logging.getLogger('github2gitlab').setLevel(level)
+
+        # see listing_cache
+        self.listing = None
+        # see mirror_cache
+        self.mirrors = None
+
+    @staticmethod
+    def open_cassette(args):
+        if args.record:
+            return Cassette.record(args.record,
+                                   [args.github_token, args.gitlab_token])
+        elif args.replay:
+            return Cassette.replay(args.replay, args.replay_latency)
         else:
-            level = logging.INFO
+            return None
 
-        logging.getLogger('github2gitlab').setLevel(level)
+    @staticmethod
+    def github_client(args):
+        if args.etag_cache:
+            conditional_cache = ConditionalCache(
+                os.path.join(os.path.expanduser(args.cache_dir), 'etag'))
+        else:
+            conditional_cache = None
+        return Client.github(args.github_token,
+                             pool_size=args.pool_size,
+                             conditional_cache=conditional_cache,
+                             rate_limiter=RateLimiter(args.max_retries))
 
-        self.tmpdir = "/tmp"
+    @staticmethod
+    def gitlab_client(args):
+        return Client.gitlab(args.gitlab_token,
+                             pool_size=args.pool_size,
+                             rate_limiter=RateLimiter(args.max_retries))
 
     @staticmethod
     def get_parser():
@@ -123,10 +221,146 @@ class GitHub2GitLab(object):
                             help='enable verbose (debug) logging')
         parser.add_argument('--cache', action='store_const',
                             const=True,
-                            help='cache GitHub pull requests list')
+                            help=('cache the pull requests list in '
+                                  '--cache-dir'))
+        parser.add_argument('--cache-ttl', action='append', default=[],
+                            metavar='[ENDPOINT=]SECONDS',
+                            help=('with --cache, how long a list is '
+                                  'cached, for all lists or for the '
+                                  'ENDPOINT (pulls, merge_requests) only. '
+                                  'Can be repeated. Defaults to ' +
+                                  str(LISTING_TTL)))
+        parser.add_argument('--cache-max-size', type=int, default=1024,
+                            help=('with --cache, the least recently used '
+                                  'lists are removed when they use more '
+                                  'than this many MB'))
+        parser.add_argument('--cache-compress', action='store_const',
+                            const=True,
+                            help='with --cache, gzip the cached lists')
+        parser.add_argument('--metrics-json', metavar='PATH',
+                            help=('write the time spent in each phase '
+                                  'and the API requests per endpoint '
+                                  'to PATH, in JSON'))
+        parser.add_argument('--metrics-textfile', metavar='PATH',
+                            help=('write the metrics of --metrics-json '
+                                  'to PATH, in the Prometheus text format '
+                                  '(for the node exporter textfile '
+                                  'collector)'))
+        parser.add_argument('--record', metavar='PATH',
+                            help=('record the GitHub and GitLab API '
+                                  'requests, their responses and how long '
+                                  'they took in PATH (the tokens are '
+                                  'removed)'))
+        parser.add_argument('--replay', metavar='PATH',
+                            help=('serve the API responses recorded in '
+                                  'PATH with --record instead of sending '
+                                  'the requests. The git repository is not '
+                                  'mirrored, the bare clone in --workdir '
+                                  'is used as it is'))
+        parser.add_argument('--replay-latency', action='store_const',
+                            const=True,
+                            help=('with --replay, wait as long as the '
+                                  'recorded requests took'))
         parser.add_argument('--clean', action='store_const',
                             const=True,
                             help='Remove the repo after sync')
+        parser.add_argument('--mirror-cache', action='store_const',
+                            const=True,
+                            help=('keep the bare clone in '
+                                  '--cache-dir/mirrors instead of '
+                                  '--workdir, run the git maintenance '
+                                  '(commit-graph, geometric repack, ...) '
+                                  'when it is due and remove the least '
+                                  'recently used bare clones'))
+        parser.add_argument('--mirror-cache-max-size', type=int,
+                            default=MIRROR_MAX_SIZE // (1024 * 1024),
+                            help=('with --mirror-cache, the least recently '
+                                  'used bare clones are removed when they '
+                                  'use more than this many MB'))
+        parser.add_argument('--etag-cache', action='store_const',
+                            const=True,
+                            help=('revalidate GitHub listings with '
+                                  'conditional requests (ETag) and only '
+                                  'download the pages that changed'))
+        parser.add_argument('--cache-dir',
+                            default=CACHE_DIR,
+                            help='directory where cached data is stored')
+        parser.add_argument('--incremental', action='store_const',
+                            const=True,
+                            help=('only list and mirror the pull requests '
+                                  'updated since the last successful '
+                                  'sync'))
+        parser.add_argument('--full-sync-interval', type=int,
+                            default=24 * 60 * 60,
+                            help=('with --incremental, list all pull '
+                                  'requests if the last full list is '
+                                  'older than this many seconds'))
+        parser.add_argument('--page-workers', type=int, default=4,
+                            help=('number of pages of a listing fetched '
+                                  'concurrently'))
+        parser.add_argument('--github-graphql', action='store_const',
+                            const=True,
+                            help=('list GitHub pull requests with the '
+                                  'GraphQL API, which only transfers the '
+                                  'fields that are mirrored (requires '
+                                  '--github-token, falls back to REST)'))
+        parser.add_argument('--gitlab-keyset', action='store_const',
+                            const=True,
+                            help=('list GitLab merge requests with keyset '
+                                  'pagination instead of page offsets'))
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help=('number of pull requests mirrored to '
+                                  'merge requests concurrently'))
+        parser.add_argument('--sequential', action='store_const',
+                            const=True,
+                            help=('mirror the git repository, then list '
+                                  'the pull requests, then the merge '
+                                  'requests instead of doing all three at '
+                                  'the same time'))
+        parser.add_argument('--git-timeout', type=int, default=600,
+                            help=('kill a git command that does not '
+                                  'output anything (progress included) '
+                                  'for that many seconds, 0 to never '
+                                  'kill it'))
+        parser.add_argument('--max-retries', type=int, default=MAX_RETRIES,
+                            help=('number of times a request is retried '
+                                  'when rate limited (429) or on server '
+                                  'errors (5xx)'))
+        parser.add_argument('--delta-push', action='store_const',
+                            const=True,
+                            help=('only push the refs that differ from '
+                                  'the GitLab refs'))
+        parser.add_argument('--push-chunk', type=int, default=1000,
+                            help=('with --delta-push, maximum number of '
+                                  'refs updated by a single git push'))
+        parser.add_argument('--updated-after-overlap', type=int,
+                            default=5 * 60,
+                            help=('with --incremental, list the merge '
+                                  'requests updated this many seconds '
+                                  'before the previous listing'))
+        parser.add_argument('--targeted-fetch', action='store_const',
+                            const=True,
+                            help=('only fetch the refs of the pull '
+                                  'requests whose head moved instead of '
+                                  'all refs/pull/*'))
+        parser.add_argument('--fetch-chunk', type=int, default=500,
+                            help=('with --targeted-fetch, maximum number '
+                                  'of refs fetched by a single git fetch'))
+        parser.add_argument('--state-check', action='store_const',
+                            const=True,
+                            help=('verify the state database used by '
+                                  '--incremental agrees with GitLab '
+                                  'and exit'))
+        parser.add_argument('--state-rebuild', action='store_const',
+                            const=True,
+                            help=('clear the state database used by '
+                                  '--incremental before syncing'))
+        parser.add_argument('--workdir', default='.',
+                            help=('directory where the bare clone of the '
+                                  'repository is kept'))
+        parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                            help=('number of HTTP connections kept alive '
+                                  'for each of GitHub and GitLab'))
         return parser
 
     @staticmethod
@@ -134,39 +368,138 @@ class GitHub2GitLab(object):
         return GitHub2GitLab(GitHub2GitLab.get_parser().parse_args(argv))
 
     def run(self):
-        self.add_key()
-        if self.add_project():
-            self.unprotect_branches()
-        self.git_mirror()
-        if not self.args.skip_pull_requests:
-            self.pull_requests = self.get_pull_requests()
-            self.merge_requests = self.get_merge_requests()
-            self.update_merge_pull()
-            self.sync()
-        if self.args.clean:
-            self.clean()
+        if self.args.state_check:
+            return self.state_check()
+        if self.args.state_rebuild:
+            self.state_store().rebuild()
+        try:
+            with self.mirror_lock():
+                self.mirror()
+        finally:
+            if self.listing is not None:
+                stats = self.listing.stats()
+                log.info("list cache: " + json.dumps(stats, sort_keys=True))
+                for (counter, value) in stats.items():
+                    self.metrics.cache('list', counter, value)
+            if self.mirrors is not None:
+                for (counter, value) in self.mirrors.stats().items():
+                    self.metrics.cache('mirror', counter, value)
+            self.metrics.save(self.args.metrics_json,
+                              self.args.metrics_textfile)
+            if self.cassette is not None:
+                self.cassette.close()
         return 0
 
-    def sh(self, command):
-        log.debug(":sh: " + command)
-        proc = subprocess.Popen(
-            args=command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=True,
-            bufsize=1)
-        lines = []
-        with proc.stdout:
-            for line in iter(proc.stdout.readline, b''):
-                line = line.decode('utf-8')
-                lines.append(line)
-                log.debug(str(line.strip()))
-        if proc.wait() != 0:
-            raise subprocess.CalledProcessError(
-                returncode=proc.returncode,
-                cmd=command
-            )
-        return "".join(lines)
+    def mirror(self):
+        phase = self.metrics.phase
+        with phase('add_key'):
+            self.add_key()
+        with phase('add_project'):
+            created = self.add_project()
+        if created:
+            with phase('unprotect_branches'):
+                self.unprotect_branches()
+        if self.args.skip_pull_requests:
+            self.git_transfer()
+        else:
+            if self.args.incremental:
+                # open it before the threads of transfer share it
+                self.state_store()
+            (self.pull_requests, self.merge_requests) = self.transfer()
+            with phase('sync'):
+                self.update_merge_pull()
+                self.sync()
+            if self.args.incremental:
+                self.save_state(self.next_state)
+        if self.args.clean:
+            with phase('clean'):
+                self.clean()
+        elif self.args.mirror_cache and not self.args.replay:
+            with phase('maintenance'):
+                self.maintenance()
+
+    def transfer(self):
+        """Mirror the git repository, list the pull and merge requests
+
+        The three do not depend on each other and run at the same time,
+        unless --sequential. With --targeted-fetch the git repository
+        is mirrored after the pull requests are listed because they
+        tell which refs to fetch. Return the pull and merge requests.
+        """
+        phase = self.metrics.phase
+
+        def pulls():
+            with phase('get_pull_requests'):
+                pull_requests = self.get_pull_requests()
+            if self.args.targeted_fetch:
+                self.pull_requests = pull_requests
+                self.git_transfer()
+            return pull_requests
+
+        def merges():
+            with phase('get_merge_requests'):
+                return self.get_merge_requests()
+
+        if self.args.targeted_fetch:
+            tasks = (pulls, merges)
+        else:
+            tasks = (self.git_transfer, pulls, merges)
+        if self.args.sequential:
+            results = [task() for task in tasks]
+        else:
+            with futures.ThreadPoolExecutor(len(tasks)) as executor:
+                running = [executor.submit(task) for task in tasks]
+            # all tasks are done, raise the error of the first that failed
+            results = [task.result() for task in running]
+        return tuple(results[-2:])
+
+    def git_transfer(self):
+        if self.args.replay:
+            # the refs of the bare clone left by the recorded run are used
+            log.info("replay " + self.args.replay + ", git is not mirrored")
+            return
+        with self.metrics.phase('git_mirror'):
+            self.git_mirror()
+
+    def slot(self):
+        if self.git_slots is None:
+            return contextlib.nullcontext()
+        return self.git_slots
+
+    def git(self, args, cwd=None, input=None, capture=False, timeout=None):
+        """Run git with args, return its output if capture
+
+        The git progress of clone, fetch and push is parsed to count the
+        bytes transferred in the metrics. git is killed if it does not
+        output anything for timeout seconds (--git-timeout by default,
+        0 to wait forever).
+        """
+        if timeout is None:
+            timeout = self.args.git_timeout
+        argv = ['git', args[0]]
+        if args[0] in PROGRESS_COMMANDS:
+            argv.append('--progress')
+        argv += args[1:]
+        transferred = {}
+
+        def progress(report):
+            transferred[report['phase']] = report['bytes']
+        with self.slot():
+            start = time.time()
+            try:
+                return runner.run(argv, cwd=cwd, input=input,
+                                  capture=capture,
+                                  timeout=timeout or None,
+                                  progress=progress)
+            finally:
+                self.metrics.git(args[0], time.time() - start,
+                                 sum(transferred.values()))
+
+    def sh(self, command, cwd=None, input=None):
+        "Run the shell command, return its output"
+        with self.slot():
+            return runner.run(['sh', '-c', command], cwd=cwd, input=input,
+                              capture=True)
 
     def gitlab_create_remote(self, repo):
         # when using access token, gitlab doesn't care the username
@@ -177,79 +510,318 @@ class GitHub2GitLab(object):
                            self.gitlab['namespace'] + "/" +
                            self.gitlab['name'] + ".git")
 
+    def repo_path(self):
+        "Return the path of the bare clone of the repository"
+        if self.args.mirror_cache:
+            return self.mirror_cache().path(self.repository_key())
+        return os.path.join(self.args.workdir, self.gitlab['name'])
+
+    def mirror_cache(self):
+        "Return the MirrorCache of --mirror-cache, create it if needed"
+        if self.mirrors is None:
+            self.mirrors = MirrorCache(
+                os.path.join(self.args.cache_dir, 'mirrors'),
+                max_size=self.args.mirror_cache_max_size * 1024 * 1024)
+        return self.mirrors
+
+    def mirror_lock(self):
+        "Keep other runs from using or evicting the bare clone"
+        if not self.args.mirror_cache:
+            return contextlib.nullcontext()
+        return self.mirror_cache().use(self.repository_key())
+
+    def maintenance(self):
+        "Maintain the bare clone, evict the least recently used others"
+        path = self.repo_path()
+        tasks = self.mirror_cache().maintain(
+            path, lambda args: self.git(args, cwd=path, timeout=0))
+        if tasks:
+            log.info("maintenance of " + path + ": " + ", ".join(tasks))
+        self.mirror_cache().evict()
+
     def git_mirror(self):
-        name = self.gitlab['name']
-        if not os.path.exists(name):
-            self.sh("git clone --bare " + self.github['git'] +
-                    "/" + self.github['repo'] + " " + name)
-        repo = git.Repo(name)
-        os.chdir(name)
+        path = self.repo_path()
+        if not os.path.exists(path):
+            self.git(['clone', '--bare',
+                      self.github['git'] + "/" + self.github['repo'], path])
+        repo = git.Repo(path)
         if not hasattr(repo.remotes, 'gitlab'):
             self.gitlab_create_remote(repo)
         if 'branches' in self.github:
-            branches_ref = " ".join([
+            branches_ref = [
                 "+refs/heads/{b}:refs/heads/{b}".format(b=b)
                 for b in self.github['branches']
-            ])
+            ]
         else:
-            branches_ref = "+refs/heads/*:refs/heads/*"
+            branches_ref = ["+refs/heads/*:refs/heads/*"]
         #
         # Fetch
         #
-        self.sh("git fetch --force origin " +
-                branches_ref +
-                " +refs/tags/*:refs/tags/*")
+        self.git(['fetch', '--force', 'origin'] + branches_ref +
+                 ['+refs/tags/*:refs/tags/*'], cwd=path)
         #
         # Track refs
         #
         if self.args.skip_pull_requests:
             self.git_mirror_optimize(repo)
+        elif self.args.targeted_fetch:
+            self.git_fetch_pulls(self.pull_requests)
+            self.load_refs()
         else:
-            self.sh("git fetch origin +refs/pull/*:refs/heads/pull/*")
+            self.git(['fetch', 'origin', '+refs/pull/*:refs/heads/pull/*'],
+                     cwd=path)
+            self.load_refs()
         #
         # Push
         #
-        self.sh("git push --prune --force gitlab " +
-                branches_ref + " " +
-                "+refs/heads/pull/*:refs/heads/pull/* " +
-                "+refs/tags/*:refs/tags/* ")
-        os.chdir("..")
-        self.revision2commit = {}
+        if self.args.delta_push or self.args.targeted_fetch:
+            # git push --prune +refs/heads/* would remove the pull
+            # request branches that were not fetched, see prunable
+            self.git_push_delta()
+        else:
+            self.git(['push', '--prune', '--force', 'gitlab'] +
+                     branches_ref +
+                     ['+refs/heads/pull/*:refs/heads/pull/*',
+                      '+refs/tags/*:refs/tags/*'], cwd=path)
+
+    def git_fetch_pulls(self, pulls):
+        """Fetch the refs of the pull requests whose head moved
+
+        Instead of +refs/pull/*, which makes GitHub advertise the refs
+        of every pull request ever opened, only fetch the head of the
+        pull requests that are new or whose head.sha differs from the
+        local pull/N/head branch. The merge ref is only fetched for
+        open pull requests whose head moved, since GitHub recomputes
+        it every time the base branch changes.
+        """
+        refs = self.load_refs()
+        heads = []
+        merges = []
+        for number in sorted(pulls.keys(), key=int):
+            pull = pulls[number]
+            head = 'refs/heads/pull/' + number + '/head'
+            if refs.get(head) == pull['head_sha']:
+                continue
+            heads.append('+refs/pull/' + number + '/head:' + head)
+            if pull['state'] == 'open':
+                merges.append('+refs/pull/' + number + '/merge:' +
+                              'refs/heads/pull/' + number + '/merge')
+        log.info("fetch the refs of " + str(len(heads)) + " pull requests")
+        chunk = self.args.fetch_chunk
+        for i in range(0, len(heads), chunk):
+            self.git_fetch(heads[i:i + chunk])
+        for i in range(0, len(merges), chunk):
+            try:
+                self.git_fetch(merges[i:i + chunk])
+            except subprocess.CalledProcessError:
+                # there is no merge ref when the pull request
+                # does not merge cleanly: fetch them one by one
+                for refspec in merges[i:i + chunk]:
+                    try:
+                        self.git_fetch([refspec])
+                    except subprocess.CalledProcessError:
+                        log.debug(refspec + " does not exist, ignore")
+        return len(heads)
+
+    def git_fetch(self, refspecs):
+        self.git(['fetch', 'origin'] + list(refspecs), cwd=self.repo_path())
+
+    def pushed(self, ref):
+        "True if git_mirror pushes the local ref to GitLab"
+        if (ref.startswith('refs/tags/') or
+                ref.startswith('refs/heads/pull/')):
+            return True
+        if ref.startswith('refs/heads/'):
+            return ('branches' not in self.github or
+                    ref[len('refs/heads/'):] in self.github['branches'])
+        return False
+
+    def prunable(self, ref):
+        "True if the GitLab ref is removed when it does not exist locally"
+        if ref.startswith('refs/heads/pull/'):
+            # with --targeted-fetch the bare clone only has the refs of
+            # the pull requests listed, which may be a few of them if it
+            # was just cloned and with --incremental or --ignore-closed
+            return not self.args.targeted_fetch
+        if ref.startswith('refs/tags/'):
+            return True
+        # only the refs/heads/* wildcard prunes, not the explicit branches
+        return (ref.startswith('refs/heads/') and
+                'branches' not in self.github)
+
+    def ls_remote(self, remote):
+        "Return the refname => sha of the remote"
+        output = self.git(['ls-remote', remote], cwd=self.repo_path(),
+                          capture=True)
+        refs = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) != 2 or fields[1].endswith('^{}'):
+                continue
+            (sha, ref) = fields
+            refs[ref] = sha
+        return refs
+
+    def git_push_delta(self):
+        """Push to GitLab only the refs that differ from the GitLab refs
+
+        The refspecs are pushed --push-chunk at a time so that each
+        push stays small regardless of how many refs the repository has.
+        """
+        local = dict([(ref, sha)
+                      for (ref, sha) in six.iteritems(self.ref_index())
+                      if self.pushed(ref)])
+        remote = self.ls_remote('gitlab')
+        refspecs = []
+        changed = 0
+        for ref in sorted(local.keys()):
+            if remote.get(ref) != local[ref]:
+                refspecs.append('+' + ref + ':' + ref)
+                changed += 1
+        deleted = 0
+        for ref in sorted(remote.keys()):
+            if ref not in local and self.prunable(ref):
+                refspecs.append(':' + ref)
+                deleted += 1
+        log.info("push " + str(changed) + " changed refs and delete " +
+                 str(deleted) + " refs")
+        chunk = self.args.push_chunk
+        for i in range(0, len(refspecs), chunk):
+            self.git_push(refspecs[i:i + chunk])
+        return {'changed': changed, 'deleted': deleted}
+
+    def git_push(self, refspecs):
+        self.git(['push', '--force', 'gitlab'] + list(refspecs),
+                 cwd=self.repo_path())
+
+    def mirror_ref(self, ref, deleted=False):
+        """Mirror a single branch or tag, as reported by a push webhook
+
+        Return False if the ref is not mirrored.
+        """
+        if not self.pushed(ref) or ref.startswith('refs/heads/pull/'):
+            log.debug(ref + " is not mirrored, ignore")
+            return False
+        if deleted:
+            if self.prunable(ref):
+                self.git_push([':' + ref])
+            self.git(['update-ref', '-d', ref], cwd=self.repo_path())
+        else:
+            self.git_fetch(['+' + ref + ':' + ref])
+            self.git_push(['+' + ref + ':' + ref])
+        return True
+
+    def mirror_pull(self, pull):
+        """Mirror a single pull request, as reported by a webhook
+
+        The refs of the pull request are fetched and pushed if its head
+        moved, then its merge request is created or updated. Return
+        False if the pull request is not mirrored.
+        """
+        number = str(pull['number'])
+        if not self.mirrored(pull):
+            log.debug("pull/" + number + " is not mirrored, ignore")
+            return False
+        self.pull_requests = {number: pull}
+        if self.git_fetch_pulls(self.pull_requests):
+            refs = self.load_refs()
+            self.git_push(['+' + ref + ':' + ref
+                           for ref in ('refs/heads/pull/' + number + '/head',
+                                       'refs/heads/pull/' + number + '/merge')
+                           if ref in refs])
+        merge = self.find_merge_request(number)
+        if merge is None:
+            self.pull2merge = {}
+        else:
+            self.pull2merge = {number: merge}
+        self.sync_pull(number)
+        if self.args.incremental:
+            self.state_store().commit()
+        return True
+
+    def load_refs(self, parents=False):
+        """Index the sha of all the refs of the bare clone in a single pass
+
+        With parents=True, also index the parents of the commit each
+        ref points to in self.parents.
+        """
+        format = '%(objectname) %(refname)'
+        if parents:
+            format += ' %(parent)'
+        output = self.git(['for-each-ref', '--format=' + format],
+                          cwd=self.repo_path(), capture=True)
+        refs = {}
+        ref_parents = {}
+        for line in output.splitlines():
+            if not line:
+                continue
+            fields = line.split()
+            (sha, ref) = fields[:2]
+            refs[ref] = sha
+            if parents:
+                ref_parents[ref] = fields[2:]
+        # the sync_pull threads must not see a partial index
+        (self.refs, self.parents) = (refs, ref_parents)
+        log.debug("loaded " + str(len(refs)) + " refs")
+        return refs
+
+    def ref_index(self):
+        with self.refs_lock:
+            if self.refs is None:
+                self.load_refs()
+        return self.refs
 
     def git_mirror_optimize(self, repo):
-        self.sh("git fetch origin +refs/pull/*:refs/remotes/origin/pull/*")
-        for head in repo.refs:
-            pr = re.search('^origin/pull/(\d+)/head$', head.name)
+        self.git(['fetch', 'origin',
+                  '+refs/pull/*:refs/remotes/origin/pull/*'],
+                 cwd=repo.git_dir)
+        refs = self.load_refs(parents=True)
+        updates = {}
+        summary = {'create': 0, 'update': 0}
+        for name in sorted(refs.keys()):
+            pr = re.search(r'^refs/remotes/origin/pull/(\d+)/head$', name)
             if not pr:
                 continue
+            head = refs[name]
             pr = pr.group(1)
-            merge_name = 'origin/pull/' + pr + '/merge'
-            if merge_name not in repo.refs:
-                log.debug(head.name + " cannot merge, ignore")
+            merge_name = 'refs/remotes/origin/pull/' + pr + '/merge'
+            if merge_name not in refs:
+                log.debug(name + " cannot merge, ignore")
                 continue
-            merge = repo.commit(merge_name)
-            if merge.parents[1] != head.commit:
-                log.debug(head.name + " merge is obsolete, skip")
+            merge = refs[merge_name]
+            merge_parents = self.parents[merge_name]
+            if len(merge_parents) < 2 or merge_parents[1] != head:
+                log.debug(name + " merge is obsolete, skip")
                 continue
-            known_head_name = 'pull/' + pr + '/head'
-            try:
-                known_head = repo.commit(known_head_name)
-                if known_head == head.commit:
-                    log.debug(head.name + " head has not moved, skip")
+            known_head_name = 'refs/pull/' + pr + '/head'
+            if known_head_name in refs:
+                if refs[known_head_name] == head:
+                    log.debug(name + " head has not moved, skip")
                     continue
                 action = 'update'
-            except gitdb.exc.BadName:
+            else:
                 action = 'create'
-            log.debug(action + " ref " + known_head_name + "==" +
-                      head.commit.hexsha)
-            repo.git.update_ref('refs/' + known_head_name, head.commit)
-            log.info(action + " branch " + 'pull/' + pr + "/merge == " +
-                     merge.hexsha)
-            repo.git.update_ref('refs/heads/pull/' + pr + '/merge', merge)
+            log.debug(action + " ref " + known_head_name + " == " + head +
+                      ", branch pull/" + pr + "/merge == " + merge)
+            updates[known_head_name] = head
+            updates['refs/heads/pull/' + pr + '/merge'] = merge
+            summary[action] += 1
+        if updates:
+            # a single transaction instead of one git update-ref per ref
+            self.git(['update-ref', '--stdin'],
+                     cwd=repo.git_dir,
+                     input="".join([
+                         "update " + ref + " " + sha + "\n"
+                         for (ref, sha) in sorted(updates.items())]))
+            refs.update(updates)
+        log.info("pull requests merge branches: " +
+                 str(summary['create']) + " created, " +
+                 str(summary['update']) + " updated")
+        return summary
 
     def clean(self):
         log.info('Removing cloned repo...')
-        shutil.rmtree(self.gitlab['name'])
+        shutil.rmtree(self.repo_path())
 
     def add_key(self):
         "Add ssh key to gitlab if necessary"
@@ -261,8 +833,7 @@ class GitHub2GitLab(object):
             return None
         g = self.gitlab
         url = g['url'] + "/user/keys"
-        query = {'private_token': g['token']}
-        keys = requests.get(url, params=query).json()
+        keys = g['client'].get(url).json()
         log.debug("looking for '" + public_key + "' in " + str(keys))
         if (list(filter(lambda key: key['key'] == public_key, keys))):
             log.debug(self.args.ssh_public_key + " already exists")
@@ -271,9 +842,8 @@ class GitHub2GitLab(object):
             name = 'github2gitlab'
             log.info("add " + name + " ssh public key from " +
                      self.args.ssh_public_key)
-            query['title'] = name
-            query['key'] = public_key
-            result = requests.post(url, query)
+            query = {'title': name, 'key': public_key}
+            result = g['client'].post(url, data=query)
             if result.status_code != requests.codes.created:
                 log.warn('Key {} already in GitLab. '
                          'Possible under a different user. Skipping...'
@@ -284,17 +854,18 @@ class GitHub2GitLab(object):
         "Create project in gitlab if it does not exist"
         g = self.gitlab
         url = g['url'] + "/projects/" + g['repo']
-        query = {'private_token': g['token']}
-        if (requests.get(url, params=query).status_code == requests.codes.ok):
+        if g['client'].get(url).status_code == requests.codes.ok:
             log.debug("project " + url + " already exists")
             return None
         else:
             log.info("add project " + g['repo'])
             url = g['url'] + "/projects"
-            query['public'] = 'true'
-            query['namespace'] = g['namespace']
-            query['name'] = g['name']
-            result = requests.post(url, params=query)
+            query = {
+                'public': 'true',
+                'namespace': g['namespace'],
+                'name': g['name'],
+            }
+            result = g['client'].post(url, params=query)
             if result.status_code != requests.codes.created:
                 raise ValueError(result.text)
             log.debug("project " + g['repo'] + " added: " +
@@ -305,14 +876,13 @@ class GitHub2GitLab(object):
         "Unprotect branches of the GitLab project"
         g = self.gitlab
         url = g['url'] + "/projects/" + g['repo'] + "/repository/branches"
-        query = {'private_token': g['token']}
         unprotected = 0
-        r = requests.get(url, params=query)
+        r = g['client'].get(url)
         r.raise_for_status()
         for branch in r.json():
             if branch['protected']:
-                r = requests.put(url + "/" + branch['name'] +
-                                 "/unprotect", params=query)
+                r = g['client'].put(url + "/" + branch['name'] +
+                                    "/unprotect")
                 r.raise_for_status()
                 unprotected += 1
         return unprotected
@@ -367,68 +937,171 @@ class GitHub2GitLab(object):
             return (merge_field, pull_value)
 
     def sync(self):
-        pull_f2merge_f = {
-            'state': 'state',
-            'body': 'description',
-            'title': 'title',
-        }
-        for number in sorted(self.pull_requests.keys()):
-            pull = self.pull_requests[number]
-            merge = None
-            if number in self.pull2merge:
-                merge = self.pull2merge[number]
+        numbers = sorted(self.pull_requests.keys())
+        if self.args.incremental:
+            store = self.state_store()
+        try:
+            if self.args.concurrency > 1:
+                with futures.ThreadPoolExecutor(
+                        self.args.concurrency) as executor:
+                    # consume the results to raise the first error, if any
+                    list(executor.map(self.sync_pull, numbers))
             else:
-                source_branch = 'pull/' + number + '/head'
-                target_branch = pull['base']['ref']
-                if (self.rev_parse(pull, source_branch) and
-                        self.rev_parse(pull, target_branch)):
-                    data = {'title': pull['title'],
-                            'source_branch': source_branch,
-                            'target_branch': target_branch}
-                    if pull['body']:
-                        data['description'] = pull['body'][:DESCRIPTION_MAX]
-                    merge = self.create_merge_request(data)
-
-            if merge:
-                updates = {}
-                for (pull_field, merge_field) in six.iteritems(pull_f2merge_f):
-                    if not self.field_equal(pull,
-                                            pull_field,
-                                            pull[pull_field],
-                                            merge,
-                                            merge_field,
-                                            merge[merge_field]):
-                        (key, value) = self.field_update(pull,
-                                                         pull_field,
-                                                         pull[pull_field],
-                                                         merge,
-                                                         merge_field,
-                                                         merge[merge_field])
-                        updates[key] = value
-                if updates:
-                    self.update_merge_request(merge, updates)
-                else:
-                    log.debug("https://github.com/" +
-                              self.github['repo'] + "/" +
-                              "pull/" + number + " == " +
-                              self.gitlab['host'] + "/" +
-                              parse.unquote(self.gitlab['repo']) + "/" +
-                              "merge_requests/" + str(merge['iid']))
+                for number in numbers:
+                    self.sync_pull(number)
+        finally:
+            if self.args.incremental:
+                # keep track of what was done even if sync failed
+                store.commit()
+
+    @staticmethod
+    def fingerprint(pull):
+        "Return a digest of the pull request fields mirrored by sync"
+        fields = [
+            pull['title'],
+            (pull['body'] or '')[:DESCRIPTION_MAX],
+            pull['state'],
+            bool(pull.get('merged_at')),
+        ]
+        return hashlib.sha1(json.dumps(fields).encode('utf-8')).hexdigest()
+
+    def unchanged(self, number, pull, merge):
+        "True if neither the pull nor the merge request changed since sync"
+        known = self.state_store().pull(number)
+        if (known is None or
+                known['pull_updated_at'] != pull.get('updated_at') or
+                known['fingerprint'] != self.fingerprint(pull)):
+            return False
+        return (merge is not None and
+                known['iid'] == merge['iid'] and
+                known['merge_updated_at'] == merge.get('updated_at'))
+
+    def sync_pull(self, number):
+        "Create or update the merge request mirroring the pull request"
+        pull = self.pull_requests[number]
+        merge = self.pull2merge.get(number)
+        if self.args.incremental:
+            if self.unchanged(number, pull, merge):
+                log.debug("pull/" + number + " did not change since last sync")
+                return
+            if merge is None:
+                # do not create a duplicate if the stored merge
+                # requests missed it
+                merge = self.get_merge_request_of(number)
+        if merge is None:
+            source_branch = 'pull/' + number + '/head'
+            target_branch = pull['base_ref']
+            if (self.rev_parse(pull, source_branch) and
+                    self.rev_parse(pull, target_branch)):
+                data = {'title': pull['title'],
+                        'source_branch': source_branch,
+                        'target_branch': target_branch}
+                if pull['body']:
+                    data['description'] = pull['body'][:DESCRIPTION_MAX]
+                merge = self.create_merge_request(data)
+
+        if merge:
+            updates = {}
+            for (pull_field, merge_field) in six.iteritems(
+                    self.PULL_FIELD2MERGE_FIELD):
+                if not self.field_equal(pull,
+                                        pull_field,
+                                        pull[pull_field],
+                                        merge,
+                                        merge_field,
+                                        merge[merge_field]):
+                    (key, value) = self.field_update(pull,
+                                                     pull_field,
+                                                     pull[pull_field],
+                                                     merge,
+                                                     merge_field,
+                                                     merge[merge_field])
+                    updates[key] = value
+            if updates:
+                merge = self.update_merge_request(merge, updates)
+            else:
+                log.debug("https://github.com/" +
+                          self.github['repo'] + "/" +
+                          "pull/" + number + " == " +
+                          self.gitlab['host'] + "/" +
+                          parse.unquote(self.gitlab['repo']) + "/" +
+                          "merge_requests/" + str(merge['iid']))
+            if self.args.incremental:
+                self.state_store().store_merges([merge])
+                self.state_store().record(number,
+                                          merge['iid'],
+                                          pull.get('updated_at'),
+                                          self.fingerprint(pull),
+                                          merge.get('updated_at'))
 
     def rev_parse(self, pull, revision):
-        if revision in self.revision2commit:
+        if "refs/heads/" + revision in self.ref_index():
             return True
         else:
-            repo = git.Repo(self.gitlab['name'])
-            try:
-                repo.rev_parse("heads/" + revision)
-                return True
-            except gitdb.exc.BadName:
-                log.debug("ignore https://github.com/" +
-                          self.github['repo'] + "/pull/" +
-                          str(pull['number']) + " because " +
-                          revision + " is not a known revision")
-                return False
+            log.debug("ignore https://github.com/" +
+                      self.github['repo'] + "/pull/" +
+                      str(pull['number']) + " because " +
+                      revision + " is not a known revision")
+            return False
+
+    def repository_key(self):
+        "Return a file name for the GitHub repository and GitLab project"
+        # the same GitHub repository may be mirrored to more than one
+        # GitLab project, each with its own merge requests
+        gitlab = hashlib.sha1((self.gitlab['host'] + "/" +
+                               parse.unquote(self.gitlab['repo'])
+                               ).encode('utf-8')).hexdigest()
+        return self.github['repo'].replace('/', '_') + "-" + gitlab[:16]
+
+    def state_path(self):
+        return os.path.join(self.args.cache_dir, 'state',
+                            self.repository_key() + ".sqlite")
+
+    def state_store(self):
+        "Return the State database of the repository, open it if needed"
+        if self.state is None:
+            self.state = State(self.state_path())
+        return self.state
+
+    def load_state(self):
+        "Return what was saved by the last successful sync of the repo"
+        return self.state_store().get('sync', {})
+
+    def save_state(self, state):
+        self.state_store().set('sync', state)
+
+    def state_check(self):
+        """Verify the State database agrees with the GitLab merge requests
+
+        Return 0 if it does, 1 otherwise. Use --state-rebuild to fix it.
+        """
+        store = self.state_store()
+        problems = store.check()
+        iid2merge = dict([(merge['iid'], merge)
+                          for merge in self.list_merge_requests()])
+        for known in store.pulls():
+            merge = iid2merge.get(known['iid'])
+            source_branch = 'pull/' + str(known['number']) + '/head'
+            if merge is None:
+                problems.append(source_branch + " is mirrored by " +
+                                str(known['iid']) + " which does not exist")
+            elif merge['source_branch'] != source_branch:
+                problems.append(source_branch + " is mirrored by " +
+                                str(known['iid']) + " which is " +
+                                merge['source_branch'])
+        for problem in problems:
+            log.error(self.state_path() + ": " + problem)
+        if problems:
+            return 1
+        log.info(self.state_path() + " is consistent")
+        return 0
+
+    def client_for(self, url):
+        "Return the client of the remote (GitHub or GitLab) serving url"
+        if url.startswith(self.gitlab['url']):
+            return self.gitlab['client']
+        else:
+            return self.github['client']
 
     @staticmethod
     def json_loads(payload):
@@ -439,87 +1112,328 @@ class GitHub2GitLab(object):
             log.error("unable to json.loads(" + payload + ")")
             raise e
 
-    def get(self, url, query, cache):
-        payloads_file = (self.tmpdir + "/" +
-                         hashlib.sha1(url.encode('utf-8')).hexdigest() +
-                         ".json")
-        if 'access_token' in query:
-            headers = {"Accept": "application/vnd.github.v3+json",
-                       "Authorization": f'token {query["access_token"]}'
-                       }
-            q = query
-            del q['access_token']
-        else:
-            headers = None
-            q = query
-        if (not cache or not os.access(payloads_file, 0) or
-                time.time() - os.stat(payloads_file).st_mtime > 24 * 60 * 60):
-            payloads = []
-            next_query = q
-            while next_query:
-                log.debug(str(next_query))
-                result = requests.get(url, params=next_query, headers=headers)
-                payloads += result.json()
-                next_query = None
-                for link in result.headers.get('Link', '').split(','):
-                    if 'rel="next"' in link:
-                        m = re.search('<(.*)>', link)
-                        if m:
-                            parsed_url = parse.urlparse(m.group(1))
-                            # append query in case it was not preserved
-                            # (gitlab has that problem)
-                            next_query = q
-                            next_query.update(
-                                dict(parse.parse_qsl(parsed_url.query))
-                            )
-            if cache:
-                with open(payloads_file, 'w') as f:
-                    json.dump(payloads, f)
-        else:
-            with open(payloads_file, 'r') as f:
-                payloads = json.load(f)
-        return payloads
+    @staticmethod
+    def links(result):
+        "Return a rel => url dict from the Link header of result"
+        links = {}
+        for link in result.headers.get('Link', '').split(','):
+            m = re.search(r'<(.*)>.*rel="(\w+)"', link)
+            if m:
+                links[m.group(2)] = m.group(1)
+        return links
+
+    def get(self, url, query, cache, client=None, stop=None, keyset=False):
+        """Yield the items of a listing, page by page
+
+        With cache=True the items are also written, one JSON document
+        per line, to the listing_cache which is read back line by line
+        instead of listing again, for --cache-ttl seconds.
+        """
+        if client is None:
+            client = self.client_for(url)
+        if cache:
+            listing = self.listing_cache()
+            key = listing.key(url, query, client.identity)
+            lines = listing.load(key, self.cache_ttl(url))
+            if lines is not None:
+                for line in lines:
+                    yield json.loads(line)
+                return
+        pages = self.get_pages(url, query, client, stop, keyset)
+        if not cache:
+            for page in pages:
+                for item in page:
+                    yield item
+            return
+        # only a complete listing is stored
+        with listing.writer(key) as f:
+            for page in pages:
+                for item in page:
+                    f.write(json.dumps(item) + "\n")
+                    yield item
+
+    def listing_cache(self):
+        "Return the ListingCache used by get, create it if needed"
+        if self.listing is None:
+            self.listing = ListingCache(
+                os.path.join(self.args.cache_dir, 'list'),
+                max_size=self.args.cache_max_size * 1024 * 1024,
+                compress=self.args.cache_compress)
+        return self.listing
+
+    def cache_ttl(self, url):
+        "Return the --cache-ttl of the endpoint (pulls, ...) of url"
+        endpoint = parse.urlparse(url).path.rstrip('/').split('/')[-1]
+        ttl = LISTING_TTL
+        for option in self.args.cache_ttl:
+            if '=' in option:
+                (name, seconds) = option.split('=', 1)
+                if name == endpoint:
+                    return int(seconds)
+            else:
+                ttl = int(option)
+        return ttl
+
+    def get_pages(self, url, query, client=None, stop=None, keyset=False):
+        "Yield the pages of a listing"
+        if client is None:
+            client = self.client_for(url)
+        q = dict(query)
+        q.setdefault('per_page', PER_PAGE)
+        if keyset:
+            # https://docs.gitlab.com/ee/api/#keyset-based-pagination
+            q.update({'pagination': 'keyset',
+                      'order_by': 'id',
+                      'sort': 'asc'})
+        log.debug(str(q))
+        result = client.get(url, params=q)
+        page = self.page(url, result)
+        self.metrics.page(client.name, url)
+        yield page
+        links = self.links(result)
+        if stop is None and not keyset and 'last' in links:
+            for page in self.get_last_pages(client, url, q, links['last']):
+                yield page
+            return
+        while 'next' in links:
+            if stop and any(map(stop, page)):
+                log.debug("stop paginating " + url)
+                break
+            # append query in case it was not preserved
+            # (gitlab has that problem)
+            next_query = dict(q)
+            next_query.update(parse.parse_qsl(
+                parse.urlparse(links['next']).query))
+            log.debug(str(next_query))
+            result = client.get(url, params=next_query)
+            page = self.page(url, result)
+            self.metrics.page(client.name, url)
+            yield page
+            links = self.links(result)
+
+    @staticmethod
+    def page(url, result):
+        "Return the items of a listing page, raise if it is an error"
+        if result.status_code != requests.codes.ok:
+            raise ValueError(url + " " + str(result.status_code) + ": " +
+                             result.text)
+        return result.json()
+
+    def get_last_pages(self, client, url, query, last):
+        "Yield the pages following the first up to last, GET concurrently"
+        last_query = dict(query)
+        last_query.update(parse.parse_qsl(parse.urlparse(last).query))
+        last_page = int(last_query['page'])
+
+        def get_page(page):
+            q = dict(last_query)
+            q['page'] = str(page)
+            log.debug(str(q))
+            result = self.page(url, client.get(url, params=q))
+            self.metrics.page(client.name, url)
+            return result
+
+        with futures.ThreadPoolExecutor(self.args.page_workers) as executor:
+            for page in executor.map(get_page, range(2, last_page + 1)):
+                yield page
 
     def get_pull_requests(self):
         "https://developer.github.com/v3/pulls/#list-pull-requests"
         g = self.github
         query = {'state': 'all'}
-        if self.args.github_token:
-            query['access_token'] = g['token']
+        cache = self.args.cache
+        stop = None
+        if self.args.incremental:
+            state = self.load_state()
+            self.next_state = dict(state)
+            now = time.time()
+            if (state.get('updated_at') and
+                    (now - state.get('full_sync', 0) <
+                     self.args.full_sync_interval)):
+                mark = state['updated_at']
+                log.info("list pull requests updated since " + mark)
+                query['sort'] = 'updated'
+                query['direction'] = 'desc'
+                cache = False
 
-        def f(pull):
-            if self.args.ignore_closed:
-                return (pull['state'] == 'opened' or
-                        (pull['state'] == 'closed' and pull['merged_at']))
+                def older(pull):
+                    return pull['updated_at'] < mark
+                stop = older
             else:
-                return True
-        pulls = filter(f,
-                       self.get(g['url'] + "/repos/" + g['repo'] + "/pulls",
-                                query, self.args.cache))
-        return dict([(str(pull['number']), pull) for pull in pulls])
+                log.info("list all pull requests (full reconciliation)")
+                self.next_state['full_sync'] = now
 
-    def get_merge_requests(self):
+        if self.args.github_graphql:
+            try:
+                return self.collect_pull_requests(
+                    self.get_pull_requests_graphql(stop))
+            except (ValueError, requests.RequestException) as e:
+                log.warning("GraphQL listing of pull requests failed, "
+                            "fall back to REST: " + str(e))
+        return self.collect_pull_requests(
+            self.get(g['url'] + "/repos/" + g['repo'] + "/pulls",
+                     query, cache, stop=stop))
+
+    def collect_pull_requests(self, payloads):
+        "Return the number => PullRequest of the payloads that are mirrored"
+        pulls = {}
+        mark = None
+        for pull in payloads:
+            if self.args.incremental:
+                mark = max(mark or pull['updated_at'], pull['updated_at'])
+            if self.mirrored(pull):
+                pulls[str(pull['number'])] = PullRequest.from_api(
+                    pull, DESCRIPTION_MAX)
+        if self.args.incremental and mark is not None:
+            self.next_state['updated_at'] = max(
+                self.next_state.get('updated_at') or mark, mark)
+        return pulls
+
+    def get_pull_requests_graphql(self, stop=None):
+        """Yield the pull requests listed with the GitHub GraphQL API
+
+        Only the fields that are mirrored are requested, most recently
+        updated first. The items have the keys of the REST API pull
+        requests. Raise ValueError if the query fails.
+        """
+        g = self.github
+        if not g['token']:
+            raise ValueError("the GraphQL API requires --github-token")
+        (owner, name) = g['repo'].split('/')
+        variables = {'owner': owner, 'name': name,
+                     'first': PER_PAGE, 'cursor': None}
+        while True:
+            log.debug(str(variables))
+            result = g['client'].post(g['graphql'], idempotent=True,
+                                      json={'query': GRAPHQL_PULL_REQUESTS,
+                                            'variables': variables})
+            data = self.page(g['graphql'], result)
+            self.metrics.page(g['client'].name, g['graphql'])
+            repository = (data.get('data') or {}).get('repository')
+            if data.get('errors') or not repository:
+                raise ValueError(g['graphql'] + ": " +
+                                 json.dumps(data.get('errors')))
+            connection = repository['pullRequests']
+            page = [self.graphql2rest(node) for node in connection['nodes']]
+            for pull in page:
+                yield pull
+            if not connection['pageInfo']['hasNextPage']:
+                break
+            if stop and any(map(stop, page)):
+                log.debug("stop paginating " + g['graphql'])
+                break
+            variables['cursor'] = connection['pageInfo']['endCursor']
+
+    @staticmethod
+    def graphql2rest(node):
+        "Convert a GraphQL PullRequest into the fields of the REST API"
+        if node['state'] == 'OPEN':
+            state = 'open'
+        else:
+            # MERGED or CLOSED
+            state = 'closed'
+        return {
+            'number': node['number'],
+            'title': node['title'],
+            'body': node['body'],
+            'state': state,
+            'merged_at': node['mergedAt'],
+            'updated_at': node['updatedAt'],
+            'base': {'ref': node['baseRefName']},
+            'head': {'sha': node['headRefOid']},
+        }
+
+    def mirrored(self, pull):
+        "False if the pull request is ignored because of --ignore-closed"
+        if self.args.ignore_closed:
+            return (pull['state'] == 'open' or
+                    (pull['state'] == 'closed' and pull['merged_at']))
+        else:
+            return True
+
+    def get_pull_request(self, number):
+        "https://developer.github.com/v3/pulls/#get-a-single-pull-request"
+        g = self.github
+        url = g['url'] + "/repos/" + g['repo'] + "/pulls/" + number
+        return PullRequest.from_api(self.page(url, g['client'].get(url)),
+                                    DESCRIPTION_MAX)
+
+    def list_merge_requests(self, query=None):
         "http://doc.gitlab.com/ce/api/merge_requests.html"
         g = self.gitlab
-        merges = self.get(g['url'] + "/projects/" +
-                          g['repo'] + "/merge_requests",
-                          {'private_token': g['token'],
-                           'state': 'all'}, cache=False)
-        return dict([(str(merge['id']), merge) for merge in merges])
+        q = {'state': 'all'}
+        q.update(query or {})
+        return self.get(g['url'] + "/projects/" +
+                        g['repo'] + "/merge_requests",
+                        q, cache=False,
+                        keyset=self.args.gitlab_keyset)
+
+    def get_merge_requests(self):
+        if self.args.incremental:
+            merges = self.get_merge_requests_incremental()
+        else:
+            merges = self.list_merge_requests()
+        return dict([(str(merge['id']), MergeRequest.from_api(merge))
+                     for merge in merges])
+
+    def get_merge_requests_incremental(self):
+        """Return the merge requests, only listing those recently updated
+
+        The merge requests updated since the previous listing (minus
+        --updated-after-overlap seconds to not miss any because of
+        clock skew) are listed and merged into the merge requests
+        stored in the State database. All merge requests are listed
+        every --full-sync-interval seconds.
+        """
+        store = self.state_store()
+        mark = store.get('merges', {})
+        now = time.time()
+        if (mark.get('listed_at') and
+                now - mark.get('full_sync', 0) < self.args.full_sync_interval):
+            since = mark['listed_at'] - self.args.updated_after_overlap
+            updated_after = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                          time.gmtime(since))
+            log.info("list merge requests updated after " + updated_after)
+            store.store_merges(self.list_merge_requests(
+                {'updated_after': updated_after}))
+        else:
+            log.info("list all merge requests (full reconciliation)")
+            store.store_merges(self.list_merge_requests(), replace=True)
+            mark['full_sync'] = now
+        mark['listed_at'] = now
+        store.set('merges', mark)
+        return store.merges()
+
+    def get_merge_request_of(self, number):
+        "Return the merge request known to mirror the pull request or None"
+        known = self.state_store().pull(number)
+        if known is None:
+            return None
+        merges = self.list_merge_requests({'iids[]': [known['iid']]})
+        for merge in merges:
+            if merge['source_branch'] == 'pull/' + number + '/head':
+                self.state_store().store_merges([merge])
+                return MergeRequest.from_api(merge)
+        return None
+
+    def find_merge_request(self, number):
+        "Return the merge request of the pull request or None"
+        for merge in self.list_merge_requests(
+                {'source_branch': 'pull/' + number + '/head'}):
+            if merge['source_branch'] == 'pull/' + number + '/head':
+                return MergeRequest.from_api(merge)
+        return None
 
     def create_merge_request(self, query):
         g = self.gitlab
-        query['private_token'] = g['token']
         url = g['url'] + "/projects/" + g['repo'] + "/merge_requests"
         log.info('create_merge_request: ' + str(query))
-        result = requests.post(url, params=query)
+        result = g['client'].post(url, params=query)
         if result.status_code != requests.codes.created:
             raise ValueError(result.text)
         merge = result.json()
         log.debug('merge ' + str(merge))
         for (key, value) in six.iteritems(query):
-            if key == 'private_token':
-                continue
             if value.strip().replace('\n', '').replace('\r', '') != merge.get(key).strip().replace('\n', '').replace('\r', ''):
                 raise ValueError(url + " " + key + " expected " +
                                  value + " but is " + merge.get(key, 'None'))
@@ -527,7 +1441,7 @@ class GitHub2GitLab(object):
 
     def update_merge_request(self, merge_request, updates):
         state_event = updates.pop('state_event', None)
-        if len(updates) == 0 or (len(updates) == 1 and 'private_token' in updates):
+        if len(updates) == 0:
             result = merge_request
         else:
             result = self.put_merge_request(merge_request, updates)
@@ -544,17 +1458,14 @@ class GitHub2GitLab(object):
 
     def put_merge_request(self, merge_request, updates):
         g = self.gitlab
-        updates['private_token'] = g['token']
         url = (g['url'] + "/projects/" + g['repo'] + "/merge_requests/" +
                str(merge_request['iid']))
         log.info('update_merge_request: ' + url + ' <= ' + str(updates))
-        return requests.put(url, params=updates).json()
+        return g['client'].put(url, params=updates).json()
 
     def verify_merge_update(self, updates, result):
         g = self.gitlab
         for (key, value) in six.iteritems(updates):
-            if key == 'private_token':
-                continue
             if key == 'state_event':
                 key = 'state'
                 value = self.STATE_EVENT2MERGE_STATE[updates['state_event']]
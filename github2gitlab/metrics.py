@@ -0,0 +1,294 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import bisect
+import contextlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from six.moves.urllib import parse
+
+log = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the API latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# path => endpoint, in order, so that the number of endpoints does
+# not grow with the number of repositories, pull requests or branches
+ENDPOINTS = (
+    (re.compile(r'^.*/api/v\d+'), ''),
+    (re.compile(r'^/repos/[^/]+/[^/]+'), '/repos/:repo'),
+    (re.compile(r'^/projects/[^/]+'), '/projects/:id'),
+    (re.compile(r'/branches/.+/unprotect$'), '/branches/:branch/unprotect'),
+    (re.compile(r'/\d+(?=/|$)'), '/:id'),
+)
+
+
+class Metrics(object):
+    """Time spent in each phase of a run and API requests per endpoint
+
+    The report is written as JSON or as a Prometheus textfile for the
+    node exporter textfile collector.
+    """
+
+    def __init__(self, repo=None):
+        self.repo = repo
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        # (remote, method, endpoint, status) => {count, seconds, ...}
+        self.requests = {}
+        # (remote, endpoint) => listing pages
+        self.pages = {}
+        # cache => {hits, misses, ...}
+        self.caches = {}
+        # remote => {remaining, limit}
+        self.rate_limits = {}
+        # git subcommand => {count, seconds, bytes}
+        self.gits = {}
+
+    @staticmethod
+    def endpoint(url):
+        "Return the path of url without the project, the numbers, ..."
+        path = parse.urlparse(url).path.rstrip('/')
+        for (pattern, replacement) in ENDPOINTS:
+            path = pattern.sub(replacement, path)
+        return path or '/'
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        "Add the time spent in the with block to the phase name"
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+            log.debug(name + " took " + str(elapsed) + " seconds")
+
+    def request(self, remote, method, url, status, seconds, size):
+        "Record a request answered with status (error if none)"
+        key = (remote, method, self.endpoint(url), str(status))
+        with self.lock:
+            if key not in self.requests:
+                self.requests[key] = {
+                    'count': 0,
+                    'seconds': 0,
+                    'bytes': 0,
+                    'buckets': [0] * len(BUCKETS),
+                }
+            r = self.requests[key]
+            r['count'] += 1
+            r['seconds'] += seconds
+            r['bytes'] += size
+            bucket = bisect.bisect_left(BUCKETS, seconds)
+            if bucket < len(BUCKETS):
+                r['buckets'][bucket] += 1
+
+    def page(self, remote, url):
+        "Record a listing page"
+        key = (remote, self.endpoint(url))
+        with self.lock:
+            self.pages[key] = self.pages.get(key, 0) + 1
+
+    def cache(self, name, counter, value=1):
+        "Add value to the counter (hits, misses, ...) of the cache name"
+        with self.lock:
+            counters = self.caches.setdefault(name, {})
+            counters[counter] = counters.get(counter, 0) + value
+
+    def git(self, subcommand, seconds, size):
+        "Record a git command and the bytes it transferred"
+        with self.lock:
+            g = self.gits.setdefault(subcommand, {
+                'count': 0,
+                'seconds': 0,
+                'bytes': 0,
+            })
+            g['count'] += 1
+            g['seconds'] += seconds
+            g['bytes'] += size
+
+    def rate_limit(self, remote, remaining, limit):
+        with self.lock:
+            self.rate_limits[remote] = {
+                'remaining': remaining,
+                'limit': limit,
+            }
+
+    def report(self):
+        "Return the metrics as a dict that can be dumped in JSON"
+        with self.lock:
+            requests = []
+            for key in sorted(self.requests.keys()):
+                r = self.requests[key]
+                (remote, method, endpoint, status) = key
+                requests.append({
+                    'remote': remote,
+                    'method': method,
+                    'endpoint': endpoint,
+                    'status': status,
+                    'count': r['count'],
+                    'seconds': r['seconds'],
+                    'bytes': r['bytes'],
+                    'buckets': dict(zip([str(b) for b in BUCKETS],
+                                        r['buckets'])),
+                })
+            return {
+                'repo': self.repo,
+                'started': self.started,
+                'duration': time.time() - self.started,
+                'phases': dict(self.phases),
+                'requests': requests,
+                'pages': [{'remote': remote, 'endpoint': endpoint,
+                           'count': count}
+                          for ((remote, endpoint), count)
+                          in sorted(self.pages.items())],
+                'caches': dict([(name, dict(counters)) for (name, counters)
+                                in self.caches.items()]),
+                'rate_limits': dict([(remote, dict(limits))
+                                     for (remote, limits)
+                                     in self.rate_limits.items()]),
+                'git': dict([(subcommand, dict(g)) for (subcommand, g)
+                             in self.gits.items()]),
+            }
+
+    @staticmethod
+    def labels(**labels):
+        return "{" + ",".join([
+            name + '="' + str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n') + '"'
+            for (name, value) in sorted(labels.items())
+            if value is not None]) + "}"
+
+    def textfile(self):
+        """Return the metrics in the Prometheus text format
+
+        https://prometheus.io/docs/instrumenting/exposition_formats/
+        """
+        report = self.report()
+        repo = report['repo']
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append("# HELP github2gitlab_" + name + " " + help)
+            lines.append("# TYPE github2gitlab_" + name + " " + kind)
+
+        def sample(name, value, **labels):
+            lines.append("github2gitlab_" + name +
+                         self.labels(repo=repo, **labels) + " " +
+                         repr(float(value)))
+
+        metric('last_run_timestamp_seconds', 'gauge',
+               'When the last run started')
+        sample('last_run_timestamp_seconds', report['started'])
+        metric('run_duration_seconds', 'gauge',
+               'Wall time of the last run')
+        sample('run_duration_seconds', report['duration'])
+        metric('phase_duration_seconds', 'gauge',
+               'Wall time of each phase of the last run')
+        for (phase, seconds) in sorted(report['phases'].items()):
+            sample('phase_duration_seconds', seconds, phase=phase)
+        metric('api_requests_total', 'counter',
+               'API requests by endpoint and status code')
+        for r in report['requests']:
+            sample('api_requests_total', r['count'], remote=r['remote'],
+                   method=r['method'], endpoint=r['endpoint'],
+                   status=r['status'])
+        metric('api_response_bytes_total', 'counter',
+               'Bytes of the API response bodies')
+        for r in report['requests']:
+            sample('api_response_bytes_total', r['bytes'],
+                   remote=r['remote'], method=r['method'],
+                   endpoint=r['endpoint'], status=r['status'])
+        metric('api_request_duration_seconds', 'histogram',
+               'API request latency')
+        for r in report['requests']:
+            labels = dict(remote=r['remote'], method=r['method'],
+                          endpoint=r['endpoint'], status=r['status'])
+            cumulative = 0
+            for bound in BUCKETS:
+                cumulative += r['buckets'][str(bound)]
+                sample('api_request_duration_seconds_bucket', cumulative,
+                       le=str(bound), **labels)
+            sample('api_request_duration_seconds_bucket', r['count'],
+                   le='+Inf', **labels)
+            sample('api_request_duration_seconds_sum', r['seconds'],
+                   **labels)
+            sample('api_request_duration_seconds_count', r['count'],
+                   **labels)
+        metric('api_pages_total', 'counter', 'Listing pages fetched')
+        for p in report['pages']:
+            sample('api_pages_total', p['count'], remote=p['remote'],
+                   endpoint=p['endpoint'])
+        metric('cache_total', 'counter',
+               'Cache hits, misses, stores and evictions')
+        for (name, counters) in sorted(report['caches'].items()):
+            for (counter, value) in sorted(counters.items()):
+                sample('cache_total', value, cache=name, result=counter)
+        metric('rate_limit_remaining', 'gauge',
+               'Requests left in the rate limit window')
+        for (remote, limits) in sorted(report['rate_limits'].items()):
+            if limits['remaining'] is not None:
+                sample('rate_limit_remaining', limits['remaining'],
+                       remote=remote)
+        metric('rate_limit', 'gauge',
+               'Requests allowed in the rate limit window')
+        for (remote, limits) in sorted(report['rate_limits'].items()):
+            if limits['limit'] is not None:
+                sample('rate_limit', limits['limit'], remote=remote)
+        metric('git_commands_total', 'counter', 'git commands run')
+        for (subcommand, g) in sorted(report['git'].items()):
+            sample('git_commands_total', g['count'], subcommand=subcommand)
+        metric('git_command_seconds_total', 'counter',
+               'Wall time of the git commands')
+        for (subcommand, g) in sorted(report['git'].items()):
+            sample('git_command_seconds_total', g['seconds'],
+                   subcommand=subcommand)
+        metric('git_transfer_bytes_total', 'counter',
+               'Bytes received or sent by git clone, fetch and push')
+        for (subcommand, g) in sorted(report['git'].items()):
+            sample('git_transfer_bytes_total', g['bytes'],
+                   subcommand=subcommand)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write(path, content):
+        "Replace path with content at once (the exporter may be reading)"
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        (fd, tmp) = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def save(self, json_path=None, textfile_path=None):
+        if json_path:
+            self.write(json_path, json.dumps(self.report(), indent=2,
+                                             sort_keys=True) + "\n")
+        if textfile_path:
+            self.write(textfile_path, self.textfile())
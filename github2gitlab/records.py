@@ -0,0 +1,97 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+
+
+class Record(object):
+    """The fields of an API payload that are mirrored
+
+    A record reads like the dict it was projected from (record['title'],
+    record.get('merged_at')) but only keeps the fields listed in
+    __slots__, without a per instance dict.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def get(self, field, default=None):
+        if field not in self.__slots__:
+            return default
+        return getattr(self, field)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def as_dict(self):
+        return dict([(field, getattr(self, field))
+                     for field in self.__slots__])
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(" + repr(self.as_dict()) + ")"
+
+
+class PullRequest(Record):
+    "https://developer.github.com/v3/pulls/#list-pull-requests"
+
+    __slots__ = ('number', 'title', 'body', 'state', 'merged_at',
+                 'updated_at', 'base_ref', 'head_sha')
+
+    @classmethod
+    def from_api(cls, pull, body_max=None):
+        "Project the GitHub payload, keep at most body_max chars of body"
+        body = pull.get('body')
+        if body and body_max:
+            body = body[:body_max]
+        return cls(number=pull['number'],
+                   title=pull.get('title'),
+                   body=body,
+                   state=pull.get('state'),
+                   merged_at=pull.get('merged_at'),
+                   updated_at=pull.get('updated_at'),
+                   base_ref=(pull.get('base') or {}).get('ref'),
+                   head_sha=(pull.get('head') or {}).get('sha'))
+
+
+class MergeRequest(Record):
+    "http://doc.gitlab.com/ce/api/merge_requests.html"
+
+    __slots__ = ('id', 'iid', 'source_branch', 'target_branch', 'title',
+                 'description', 'state', 'updated_at')
+
+    @classmethod
+    def from_api(cls, merge):
+        return cls(**dict([(field, merge.get(field))
+                           for field in cls.__slots__]))
@@ -0,0 +1,161 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import collections
+import logging
+import os
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# lines of output kept to report why a command failed
+TAIL = 50
+
+# Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s
+PROGRESS = re.compile(r'(?P<phase>[A-Za-z][A-Za-z ]*):\s+(?P<percent>\d+)% '
+                      r'\((?P<done>\d+)/(?P<total>\d+)\)'
+                      r'(?:, (?P<size>[\d.]+) (?P<unit>bytes|KiB|MiB|GiB))?')
+
+UNITS = {
+    'bytes': 1,
+    'KiB': 1024,
+    'MiB': 1024 ** 2,
+    'GiB': 1024 ** 3,
+}
+
+
+def parse_progress(line):
+    "Return the git progress report of line as a dict or None"
+    m = PROGRESS.search(line)
+    if not m:
+        return None
+    size = 0
+    if m.group('size'):
+        size = int(float(m.group('size')) * UNITS[m.group('unit')])
+    return {
+        'phase': m.group('phase').strip(),
+        'percent': int(m.group('percent')),
+        'done': int(m.group('done')),
+        'total': int(m.group('total')),
+        'bytes': size,
+    }
+
+
+def run(argv, cwd=None, input=None, capture=False, timeout=None,
+        progress=None, tail=TAIL):
+    """Run argv, without a shell, and return its output if capture
+
+    The output is logged line by line instead of being kept: only the
+    last tail lines are, to be reported in the output of the
+    CalledProcessError raised if argv fails. The git progress reports
+    (--progress) are given to the progress function instead. With
+    capture=True the standard output is returned instead of being
+    logged.
+
+    If argv does not output anything for timeout seconds, it is killed
+    and TimeoutExpired is raised.
+    """
+    log.debug(":run: " + " ".join([shlex.quote(arg) for arg in argv]))
+    proc = subprocess.Popen(
+        args=argv,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        # to kill the helpers (git-remote-https, ssh, ...) as well
+        start_new_session=True)
+    recent = collections.deque(maxlen=tail)
+    captured = []
+    activity = [time.time()]
+
+    def line(text):
+        report = parse_progress(text)
+        if report is None:
+            recent.append(text)
+            log.debug(text)
+            return
+        if progress:
+            progress(report)
+        if report['percent'] == 100 and text.endswith('done.'):
+            log.debug(text)
+
+    def read_stdout():
+        for data in iter(proc.stdout.readline, b''):
+            activity[0] = time.time()
+            if capture:
+                captured.append(data)
+            else:
+                line(data.decode('utf-8', 'replace').rstrip())
+
+    def read_stderr():
+        # the progress reports are terminated by \r, not \n
+        pending = b''
+        while True:
+            data = proc.stderr.read1(4096)
+            if not data:
+                break
+            activity[0] = time.time()
+            lines = re.split(b'[\r\n]', pending + data)
+            pending = lines.pop()
+            for text in lines:
+                if text:
+                    line(text.decode('utf-8', 'replace').rstrip())
+        if pending:
+            line(pending.decode('utf-8', 'replace').rstrip())
+
+    readers = [threading.Thread(target=read_stdout),
+               threading.Thread(target=read_stderr)]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    if input is not None:
+        with proc.stdin:
+            proc.stdin.write(input.encode('utf-8'))
+    try:
+        while True:
+            try:
+                proc.wait(timeout=1 if timeout else None)
+                break
+            except subprocess.TimeoutExpired:
+                if time.time() - activity[0] > timeout:
+                    log.warning(argv[0] + " did not output anything for " +
+                                str(timeout) + " seconds, kill it")
+                    raise subprocess.TimeoutExpired(argv, timeout,
+                                                    output="\n".join(recent))
+    except BaseException:
+        # also on KeyboardInterrupt: the new session does not get SIGINT
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(returncode=proc.returncode,
+                                            cmd=argv,
+                                            output="\n".join(recent))
+    if capture:
+        return b"".join(captured).decode('utf-8')
+    return None
@@ -0,0 +1,154 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from github2gitlab.records import MergeRequest
+
+log = logging.getLogger(__name__)
+
+
+class State(object):
+    "SQLite database of what was mirrored from a GitHub repository"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS pulls (
+        number INTEGER PRIMARY KEY,
+        iid INTEGER NOT NULL,
+        pull_updated_at TEXT,
+        fingerprint TEXT NOT NULL,
+        merge_updated_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS merges (
+        id INTEGER PRIMARY KEY,
+        merge TEXT NOT NULL
+    );
+    """
+
+    # the merge request fields kept in the merges table
+    MERGE_FIELDS = MergeRequest.__slots__
+
+    PULL_FIELDS = ('number', 'iid', 'pull_updated_at', 'fingerprint',
+                   'merge_updated_at')
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        # sync() may record pull requests from several threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                                  (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                            (key, json.dumps(value)))
+            self.db.commit()
+
+    def pull(self, number):
+        "Return what was recorded about the pull request or None"
+        with self.lock:
+            row = self.db.execute("SELECT " + ", ".join(self.PULL_FIELDS) +
+                                  " FROM pulls WHERE number = ?",
+                                  (int(number),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.PULL_FIELDS, row))
+
+    def pulls(self):
+        with self.lock:
+            rows = self.db.execute("SELECT " + ", ".join(self.PULL_FIELDS) +
+                                   " FROM pulls ORDER BY number").fetchall()
+        return [dict(zip(self.PULL_FIELDS, row)) for row in rows]
+
+    def record(self, number, iid, pull_updated_at, fingerprint,
+               merge_updated_at):
+        "Remember the pull request is mirrored, call commit() to save"
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO pulls VALUES "
+                            "(?, ?, ?, ?, ?)",
+                            (int(number), iid, pull_updated_at,
+                             fingerprint, merge_updated_at))
+
+    def forget(self, number):
+        with self.lock:
+            self.db.execute("DELETE FROM pulls WHERE number = ?",
+                            (int(number),))
+
+    def merges(self):
+        "Return the merge requests stored with store_merges"
+        with self.lock:
+            rows = self.db.execute("SELECT merge FROM merges").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def store_merges(self, merges, replace=False):
+        """Add or update the merge requests
+
+        With replace=True, the merge requests that are not in merges
+        are removed.
+        """
+        rows = []
+        for merge in merges:
+            merge = dict([(field, merge.get(field))
+                          for field in self.MERGE_FIELDS])
+            rows.append((merge['id'], json.dumps(merge)))
+        with self.lock:
+            if replace:
+                self.db.execute("DELETE FROM merges")
+            self.db.executemany("INSERT OR REPLACE INTO merges VALUES (?, ?)",
+                                rows)
+            self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def check(self):
+        "Return the list of problems found by the SQLite integrity check"
+        with self.lock:
+            rows = self.db.execute("PRAGMA integrity_check").fetchall()
+        return [row[0] for row in rows if row[0] != 'ok']
+
+    def rebuild(self):
+        "Forget everything so the next sync is a full reconciliation"
+        log.info("rebuild " + self.path)
+        with self.lock:
+            self.db.execute("DELETE FROM pulls")
+            self.db.execute("DELETE FROM merges")
+            self.db.execute("DELETE FROM meta")
+            self.db.commit()
+            self.db.execute("VACUUM")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
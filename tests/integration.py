@@ -111,11 +111,11 @@ git push origin master
 
     def verify_create_pull_request(self):
         g = self.g.gitlab
-        merges = self.g.get(g['url'] + "/projects/" + g['repo'] +
-                            "/merge_requests",
-                            {'private_token': g['token'],
-                             'state': 'open'},
-                            cache=False)
+        merges = list(self.g.get(g['url'] + "/projects/" + g['repo'] +
+                                 "/merge_requests",
+                                 {'private_token': g['token'],
+                                  'state': 'open'},
+                                 cache=False))
         log.debug("merges " + str(merges))
         assert len(merges) == 4
         for merge in merges:
@@ -146,11 +146,11 @@ git push origin master
 
     def verify_create_pull_request_and_merge(self, number):
         g = self.g.gitlab
-        merges = self.g.get(g['url'] + "/projects/" + g['repo'] +
-                            "/merge_requests",
-                            {'private_token': g['token'],
-                             'state': 'open'},
-                            cache=False)
+        merges = list(self.g.get(g['url'] + "/projects/" + g['repo'] +
+                                 "/merge_requests",
+                                 {'private_token': g['token'],
+                                  'state': 'open'},
+                                 cache=False))
         log.debug("merges " + str(merges))
         merge = filter(lambda merge: (merge['source_branch'] == 'pull/' +
                                       number + '/head'),
@@ -168,11 +168,11 @@ git push origin master
 
     def verify_closed_pull(self):
         g = self.g.gitlab
-        merges = self.g.get(g['url'] + "/projects/" + g['repo'] +
-                            "/merge_requests",
-                            {'private_token': g['token'],
-                             'state': 'all'},
-                            cache=False)
+        merges = list(self.g.get(g['url'] + "/projects/" + g['repo'] +
+                                 "/merge_requests",
+                                 {'private_token': g['token'],
+                                  'state': 'all'},
+                                 cache=False))
         log.debug("merges " + str(merges))
         assert len(merges) == 5
         for merge in merges:
@@ -201,11 +201,11 @@ git push origin master
 
     def verify_deleted_branch(self):
         g = self.g.gitlab
-        merges = self.g.get(g['url'] + "/projects/" + g['repo'] +
-                            "/merge_requests",
-                            {'private_token': g['token'],
-                             'state': 'all'},
-                            cache=False)
+        merges = list(self.g.get(g['url'] + "/projects/" + g['repo'] +
+                                 "/merge_requests",
+                                 {'private_token': g['token'],
+                                  'state': 'all'},
+                                 cache=False))
         log.debug("merges " + str(merges))
         assert len(merges) == 5
 
@@ -220,11 +220,11 @@ git push origin master
 
     def verify_merge_pull(self):
         g = self.g.gitlab
-        merges = self.g.get(g['url'] + "/projects/" + g['repo'] +
-                            "/merge_requests",
-                            {'private_token': g['token'],
-                             'state': 'all'},
-                            cache=False)
+        merges = list(self.g.get(g['url'] + "/projects/" + g['repo'] +
+                                 "/merge_requests",
+                                 {'private_token': g['token'],
+                                  'state': 'all'},
+                                 cache=False))
         log.debug("merges " + str(merges))
         assert len(merges) == 5
         for merge in merges:
@@ -0,0 +1,190 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import json
+import logging
+import mock
+import os
+import pytest
+import requests
+import shutil
+import tempfile
+
+from github2gitlab import batch
+
+
+class TestBatch(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+        self.manifest = self.d + '/manifest.json'
+        with open(self.manifest, 'w') as f:
+            json.dump({
+                'defaults': {
+                    'gitlab-url': 'http://gitlab',
+                    'gitlab-token': 'TOKEN',
+                    'ignore-closed': True,
+                },
+                'repos': [
+                    {'github-repo': 'ceph/ceph',
+                     'gitlab-repo': 'ceph/ceph-backports'},
+                    {'github-repo': 'other/ceph',
+                     'ignore_closed': False},
+                ],
+            }, f)
+        self.b = batch.Batch.factory([
+            '--manifest', self.manifest,
+            '--workdir', self.d + '/work',
+        ])
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def test_load_manifest(self):
+        (defaults, repos) = batch.Batch.load_manifest(self.manifest)
+        assert 'TOKEN' == defaults['gitlab-token']
+        assert 2 == len(repos)
+        with open(self.d + '/list.json', 'w') as f:
+            json.dump([{'github-repo': 'a/b'}], f)
+        assert (({}, [{'github-repo': 'a/b'}]) ==
+                batch.Batch.load_manifest(self.d + '/list.json'))
+
+    def test_load_manifest_yaml(self):
+        yaml = pytest.importorskip('yaml')
+        with open(self.d + '/manifest.yaml', 'w') as f:
+            yaml.safe_dump({'repos': [{'github-repo': 'a/b'}]}, f)
+        assert (({}, [{'github-repo': 'a/b'}]) ==
+                batch.Batch.load_manifest(self.d + '/manifest.yaml'))
+
+    def test_options2argv(self):
+        assert ['--a-b', 'c', '--d'] == batch.Batch.options2argv({
+            'a-b': 'c',
+            'd': True,
+            'e': False,
+            'f': None,
+        })
+
+    def test_repo_args(self):
+        (defaults, repos) = batch.Batch.load_manifest(self.manifest)
+        args = self.b.repo_args(defaults, repos[0])
+        assert args.ignore_closed
+        assert self.d + '/work/ceph' == args.workdir
+        assert os.path.isdir(args.workdir)
+        args = self.b.repo_args(defaults, repos[1])
+        assert not args.ignore_closed
+        assert self.d + '/work/other' == args.workdir
+        with pytest.raises(ValueError):
+            self.b.repo_args(defaults, {'gitlab-repo': 'no/github'})
+        with pytest.raises(ValueError):
+            self.b.repo_args(defaults, {'github-repo': 'a/b',
+                                        'pool-size': 'many'})
+
+    def test_client(self):
+        (defaults, repos) = batch.Batch.load_manifest(self.manifest)
+        a = self.b.repo_args(defaults, repos[0])
+        b = self.b.repo_args(defaults, repos[1])
+        assert self.b.client('gitlab', a) is self.b.client('gitlab', b)
+        b.pool_size = a.pool_size + 1
+        assert self.b.client('gitlab', a) is not self.b.client('gitlab', b)
+        b.pool_size = a.pool_size
+        b.etag_cache = True
+        assert self.b.client('github', a) is not self.b.client('github', b)
+
+    def test_run(self):
+        instances = []
+
+        def run(g):
+            instances.append(g)
+            return 0
+        with mock.patch.object(batch.GitHub2GitLab, 'run',
+                               autospec=True, side_effect=run):
+            assert 0 == self.b.run()
+        assert 2 == len(instances)
+        (a, b) = instances
+        # the connections are shared, the metrics are not
+        assert a.github['client'].session is b.github['client'].session
+        assert a.gitlab['client'].session is b.gitlab['client'].session
+        assert a.github['client'].metrics is a.metrics
+        assert a.metrics is not b.metrics
+        assert a.git_slots is b.git_slots
+        assert a.repo_path() != b.repo_path()
+
+        with mock.patch.object(batch.GitHub2GitLab, 'run',
+                               side_effect=ValueError('FAIL')):
+            assert 1 == self.b.run()
+
+    def test_verbose(self):
+        logger = logging.getLogger('github2gitlab')
+        level = logger.level
+        try:
+            b = batch.Batch.factory(['--manifest', self.manifest,
+                                     '--workdir', self.d + '/work',
+                                     '--verbose'])
+            (defaults, repos) = b.load_manifest(self.manifest)
+            args = b.repo_args(defaults, repos[0])
+            # the repositories do not reset the level of --verbose
+            batch.GitHub2GitLab(args,
+                                github_client=b.client('github', args),
+                                gitlab_client=b.client('gitlab', args))
+            assert logging.DEBUG == logger.level
+        finally:
+            logger.setLevel(level)
+
+    @mock.patch('requests.Session.get')
+    def test_run_metrics(self, m_get):
+        with open(self.manifest, 'w') as f:
+            json.dump({
+                'defaults': {
+                    'gitlab-url': 'http://gitlab',
+                    'gitlab-token': 'TOKEN',
+                },
+                'repos': [
+                    {'github-repo': 'a/a',
+                     'metrics-json': self.d + '/a.json'},
+                    {'github-repo': 'b/b',
+                     'metrics-json': self.d + '/b.json'},
+                ],
+            }, f)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'[]'
+        m_get.return_value = response
+
+        def mirror(g):
+            g.github['client'].get(g.github['url'] + '/repos/' +
+                                   g.github['repo'] + '/pulls')
+        with mock.patch.object(batch.GitHub2GitLab, 'mirror',
+                               autospec=True, side_effect=mirror):
+            assert 0 == self.b.run()
+        for name in ('a', 'b'):
+            with open(self.d + '/' + name + '.json') as f:
+                report = json.load(f)
+            assert [('github', '/repos/:repo/pulls', 1)] == [
+                (r['remote'], r['endpoint'], r['count'])
+                for r in report['requests']]
+
+    def test_run_invalid(self):
+        with open(self.manifest, 'w') as f:
+            json.dump([
+                {'github-repo': 'ceph/ceph', 'gitlab-url': 'http://gitlab',
+                 'gitlab-token': 'TOKEN'},
+                {'github-repo': 'other/ceph', 'no-such-option': True},
+                {'github-repo': 'replay/ceph', 'gitlab-url': 'http://gitlab',
+                 'gitlab-token': 'TOKEN', 'replay': self.d + '/c.jsonl.gz'},
+            ], f)
+        with mock.patch.object(batch.GitHub2GitLab, 'run',
+                               return_value=0) as m_run:
+            assert 1 == self.b.run()
+        assert 1 == m_run.call_count
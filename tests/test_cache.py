@@ -0,0 +1,206 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import mock
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from github2gitlab import runner
+from github2gitlab.cache import (ConditionalCache, ListingCache, MAINTENANCE,
+                                 MirrorCache)
+
+
+class TestConditionalCache(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def test_key(self):
+        k1 = ConditionalCache.key('http://a', {'page': '1', 'state': 'all'})
+        k2 = ConditionalCache.key('http://a', {'state': 'all', 'page': '1'})
+        k3 = ConditionalCache.key('http://a', {'state': 'all', 'page': '2'})
+        assert k1 == k2
+        assert k1 != k3
+        assert ConditionalCache.key('http://a', None)
+
+    def test_store_load(self):
+        cache = ConditionalCache(self.d + '/etag')
+        assert os.path.isdir(self.d + '/etag')
+        assert cache.load('missing') is None
+        response = mock.Mock()
+        response.headers = {'ETag': '"abc"', 'Link': 'LINK', 'Other': 'O'}
+        response.text = u'[1]'
+        cache.store('k', response)
+        entry = cache.load('k')
+        assert u'[1]' == entry['body']
+        assert {'ETag': '"abc"', 'Link': 'LINK'} == entry['headers']
+        assert ({'If-None-Match': '"abc"'} ==
+                ConditionalCache.validators(entry))
+        assert ['k.json'] == os.listdir(self.d + '/etag')
+
+
+class TestListingCache(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def store(self, cache, key, lines):
+        with cache.writer(key) as f:
+            for line in lines:
+                f.write(line + "\n")
+
+    def test_key(self):
+        k = ListingCache.key('http://a', {'page': '1', 'state': 'all'}, 'I')
+        assert k == ListingCache.key('http://a',
+                                     {'state': 'all', 'page': '1'}, 'I')
+        assert k != ListingCache.key('http://a', {'page': '1'}, 'I')
+        assert k != ListingCache.key('http://a',
+                                     {'page': '1', 'state': 'all'}, 'J')
+
+    def test_store_load(self):
+        for compress in (False, True):
+            cache = ListingCache(self.d + '/list', compress=compress)
+            assert cache.load('k', 60) is None
+            self.store(cache, 'k', ['1', '2'])
+            assert ['1\n', '2\n'] == list(cache.load('k', 60))
+            assert cache.load('k', -1) is None
+            assert {'evictions': 0, 'hits': 1, 'misses': 2,
+                    'stores': 1} == cache.stats()
+            shutil.rmtree(self.d + '/list')
+        #
+        # an entry that is not written entirely is not stored
+        #
+        cache = ListingCache(self.d + '/list')
+        try:
+            with cache.writer('k') as f:
+                f.write('1\n')
+                raise ValueError()
+        except ValueError:
+            pass
+        assert [] == os.listdir(self.d + '/list')
+
+    def test_evict(self):
+        cache = ListingCache(self.d, max_size=25)
+        self.store(cache, 'a', ['a' * 9])
+        self.store(cache, 'b', ['b' * 9])
+        os.utime(cache.path('a'), (time.time() - 100, time.time()))
+        os.utime(cache.path('b'), (time.time() - 200, time.time()))
+        # b is the least recently used until it is read
+        assert cache.load('b', 60)
+        self.store(cache, 'c', ['c' * 9])
+        assert ['b.jsonl', 'c.jsonl'] == sorted(os.listdir(self.d))
+        assert 1 == cache.stats()['evictions']
+        #
+        # temporary files of dead processes are removed
+        #
+        (fd, tmp) = tempfile.mkstemp(dir=self.d, prefix='.tmp')
+        os.close(fd)
+        cache.evict()
+        assert os.path.exists(tmp)
+        os.utime(tmp, (0, 0))
+        cache.evict()
+        assert not os.path.exists(tmp)
+
+
+class TestMirrorCache(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def clone(self, cache, name, size):
+        os.makedirs(cache.path(name))
+        with open(os.path.join(cache.path(name), 'pack'), 'w') as f:
+            f.write('x' * size)
+        with cache.use(name):
+            pass
+
+    def test_use(self):
+        cache = MirrorCache(self.d + '/mirrors')
+        with cache.use('a') as path:
+            assert cache.path('a') == path
+            os.makedirs(path)
+        with cache.use('a'):
+            pass
+        assert {'evictions': 0, 'hits': 1, 'misses': 1} == cache.stats()
+        assert os.path.exists(self.d + '/mirrors/a.lock')
+
+    def test_maintain(self):
+        cache = MirrorCache(self.d)
+        path = cache.path('a')
+        os.makedirs(path)
+        calls = []
+        assert (['config'] + [task for (task, interval, args)
+                              in MAINTENANCE] ==
+                cache.maintain(path, calls.append, now=1000000))
+        assert ['config', 'gc.auto', '0'] == calls[0]
+        # nothing is due
+        assert [] == cache.maintain(path, calls.append, now=1000001)
+        # the hourly tasks are due
+        assert ['pack-refs', 'commit-graph'] == \
+            cache.maintain(path, calls.append, now=1000000 + 3601)
+
+        def fail(args):
+            raise subprocess.CalledProcessError(1, args)
+        # a failed task is tried again
+        assert [] == cache.maintain(path, fail, now=1000000 + 7202)
+        assert ['pack-refs', 'commit-graph'] == \
+            cache.maintain(path, calls.append, now=1000000 + 7202)
+
+    def test_maintain_git(self):
+        path = self.d + '/a.git'
+        runner.run(['git', 'init', '--quiet', '--bare', path])
+        tree = runner.run(['git', 'mktree'], cwd=path, input='',
+                          capture=True).strip()
+        commit = runner.run(['git', '-c', 'user.name=u',
+                             '-c', 'user.email=u@example.com',
+                             'commit-tree', '-m', 'c', tree], cwd=path,
+                            capture=True).strip()
+        runner.run(['git', 'update-ref', 'refs/pull/1/head', commit],
+                   cwd=path)
+        cache = MirrorCache(self.d)
+        tasks = cache.maintain(path, lambda args: runner.run(['git'] + args,
+                                                             cwd=path))
+        assert 'gc' in tasks
+        assert '0\n' == runner.run(['git', 'config', 'gc.auto'], cwd=path,
+                                   capture=True)
+        assert 'refs/pull/1/head' in open(path + '/packed-refs').read()
+
+    def test_evict(self):
+        cache = MirrorCache(self.d, max_size=25)
+        self.clone(cache, 'a', 10)
+        self.clone(cache, 'b', 10)
+        self.clone(cache, 'c', 10)
+        os.utime(self.d + '/a.lock', (0, time.time() - 200))
+        os.utime(self.d + '/b.lock', (0, time.time() - 100))
+        with cache.use('a'):
+            # a is the least recently used but locked
+            cache.evict()
+        assert not os.path.exists(cache.path('b'))
+        assert os.path.exists(cache.path('a'))
+        assert 1 == cache.stats()['evictions']
+        cache.evict()
+        assert os.path.exists(cache.path('c'))
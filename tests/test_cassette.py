@@ -0,0 +1,102 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import gzip
+import mock
+import pytest
+import requests
+import shutil
+import tempfile
+
+from github2gitlab.cassette import Cassette
+from github2gitlab.client import Client
+
+URL = 'http://gitlab/api/v4/projects/user%2Frepo/merge_requests'
+
+
+def response(status_code, body, headers=None):
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers.update(headers or {})
+    r._content = body.encode('utf-8')
+    return r
+
+
+class TestCassette(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+        self.path = self.d + '/run.jsonl.gz'
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    @mock.patch('requests.Session.put')
+    @mock.patch('requests.Session.get')
+    def record(self, m_get, m_put):
+        m_get.side_effect = [
+            response(200, '[1]', {'Link': '<' + URL + '?page=2>; rel="next"',
+                                  'Set-Cookie': 'session=S'}),
+            response(200, '[2]'),
+            response(200, '[3]'),
+        ]
+        m_put.return_value = response(200, '{"title": "TOKEN"}')
+        c = Client.gitlab('TOKEN')
+        c.cassette = Cassette.record(self.path, ['TOKEN', None])
+        c.get(URL, params={'state': 'all', 'updated_after': 'T1'})
+        c.get(URL, params={'updated_after': 'T1', 'state': 'all'})
+        c.get(URL, params={'state': 'all', 'page': '2'})
+        c.put(URL + '/1', params={'title': 'TOKEN'})
+        c.cassette.close()
+
+    def test_record_replay(self):
+        self.record()
+        with gzip.open(self.path, 'rb') as f:
+            recorded = f.read().decode('utf-8')
+        assert 'TOKEN' not in recorded
+        assert 'session=S' not in recorded
+        c = Client.gitlab('OTHER')
+        sleep = mock.Mock()
+        c.cassette = Cassette.replay(self.path, latency=True)
+        c.cassette.sleep = sleep
+        with mock.patch('requests.Session.get') as m_get:
+            # the same request is answered in the recorded order
+            # even if the time dependent parameters changed
+            r = c.get(URL, params={'state': 'all', 'updated_after': 'T2'})
+            assert [1] == r.json()
+            assert 'rel="next"' in r.headers['Link']
+            assert [2] == c.get(URL, params={'state': 'all',
+                                             'updated_after': 'T2'}).json()
+            assert [2] == c.get(URL, params={'state': 'all',
+                                             'updated_after': 'T3'}).json()
+            assert [3] == c.get(URL + '?page=2',
+                                params={'state': 'all'}).json()
+            assert not m_get.called
+        r = c.put(URL + '/1', params={'title': 'SCRUBBED'})
+        assert 'SCRUBBED' == r.json()['title']
+        assert 5 == sleep.call_count
+        with pytest.raises(ValueError) as e:
+            c.get(URL, params={'state': 'opened'})
+        assert 'not recorded' in str(e.value)
+
+    def test_truncated(self):
+        self.record()
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(content[:-10])
+        Cassette.replay(self.path)
+        with pytest.raises(ValueError):
+            Cassette(self.path, 'other')
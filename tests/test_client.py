@@ -0,0 +1,194 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import mock
+import pytest
+import requests
+import shutil
+import tempfile
+import time
+from urllib3 import exceptions as urllib3_exceptions
+
+from github2gitlab.cache import ConditionalCache
+from github2gitlab.client import Client, RateLimiter
+
+
+def response(status_code, headers=None):
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers.update(headers or {})
+    return r
+
+
+class TestClient(object):
+
+    def test_github(self):
+        c = Client.github('TOKEN', pool_size=3)
+        assert 'token TOKEN' == c.session.headers['Authorization']
+        adapter = c.session.get_adapter('https://api.github.com')
+        assert 3 == adapter._pool_maxsize
+        assert 'Authorization' not in Client.github().session.headers
+
+    def test_gitlab(self):
+        c = Client.gitlab('TOKEN')
+        assert 'TOKEN' == c.session.headers['PRIVATE-TOKEN']
+
+    @mock.patch('requests.Session.put')
+    @mock.patch('requests.Session.post')
+    @mock.patch('requests.Session.get')
+    def test_request(self, m_get, m_post, m_put):
+        for m in (m_get, m_post, m_put):
+            m.return_value = mock.Mock(status_code=200, headers={})
+        c = Client.gitlab('TOKEN')
+        c.get('http://gitlab/api', params={'a': 'b'})
+        m_get.assert_called_with('http://gitlab/api', params={'a': 'b'})
+        c.post('http://gitlab/api', data={'a': 'b'})
+        m_post.assert_called_with('http://gitlab/api', data={'a': 'b'})
+        c.put('http://gitlab/api')
+        m_put.assert_called_with('http://gitlab/api')
+
+    @mock.patch('requests.Session.get')
+    def test_conditional_get(self, m_get):
+        d = tempfile.mkdtemp()
+        try:
+            c = Client.github(conditional_cache=ConditionalCache(d))
+            url = 'https://api.github.com/repos/user/repo/pulls'
+
+            def modified(url, params=None, headers=None):
+                assert headers is None
+                r = requests.Response()
+                r.status_code = 200
+                r.headers['ETag'] = '"1"'
+                r.headers['Link'] = '<' + url + '?page=2>; rel="next"'
+                r._content = b'[1]'
+                return r
+            m_get.side_effect = modified
+            assert [1] == c.get(url, params={'page': '1'}).json()
+
+            def not_modified(url, params=None, headers=None):
+                assert '"1"' == headers['If-None-Match']
+                r = requests.Response()
+                r.status_code = 304
+                return r
+            m_get.side_effect = not_modified
+            r = c.get(url, params={'page': '1'})
+            assert 200 == r.status_code
+            assert [1] == r.json()
+            assert 'rel="next"' in r.headers['Link']
+        finally:
+            shutil.rmtree(d)
+
+
+class TestRateLimiter(object):
+
+    def test_interval(self):
+        limiter = RateLimiter()
+        now = time.time()
+        assert 0 == limiter.interval(now)
+        limiter.update(response(200, {
+            'X-RateLimit-Remaining': '4000',
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Reset': str(int(now) + 100),
+        }))
+        assert 0 == limiter.interval(now)
+        limiter.update(response(200, {
+            'RateLimit-Remaining': '10',
+            'RateLimit-Limit': '5000',
+            'RateLimit-Reset': str(int(now) + 100),
+        }))
+        assert 10 == limiter.remaining
+        assert 9 < limiter.interval(now) <= 10
+        limiter.remaining = 0
+        assert 99 < limiter.interval(now) <= 100
+
+    def test_wait(self):
+        sleep = mock.Mock()
+        limiter = RateLimiter(sleep=sleep)
+        limiter.wait()
+        assert not sleep.called
+        limiter.remaining = 2
+        limiter.limit = 5000
+        limiter.reset = time.time() + 100
+        limiter.wait()
+        limiter.wait()
+        assert sleep.called
+        assert 0 == limiter.remaining
+
+    def test_retry_after(self):
+        limiter = RateLimiter(max_retries=2)
+        assert limiter.retry_after(response(200), 0) is None
+        assert limiter.retry_after(response(404), 0) is None
+        assert limiter.retry_after(response(403), 0) is None
+        assert 7 == limiter.retry_after(response(429, {
+            'Retry-After': '7'}), 0)
+        assert 0 < limiter.retry_after(response(502), 1) <= 3
+        assert limiter.retry_after(response(502), 2) is None
+        limiter.reset = time.time() + 50
+        assert 50 < limiter.retry_after(response(403, {
+            'X-RateLimit-Remaining': '0'}), 0) <= 51
+
+    @mock.patch('requests.Session.get')
+    def test_request_retry(self, m_get):
+        sleep = mock.Mock()
+        c = Client.github(rate_limiter=RateLimiter(max_retries=3,
+                                                   sleep=sleep))
+        m_get.side_effect = [
+            requests.ConnectionError('RESET'),
+            response(503),
+            response(429, {'Retry-After': '2'}),
+            response(200),
+        ]
+        assert 200 == c.get('https://api.github.com/').status_code
+        assert 4 == m_get.call_count
+        sleep.assert_called_with(2.0)
+
+        m_get.side_effect = [response(500)] * 4
+        assert 500 == c.get('https://api.github.com/').status_code
+
+        m_get.side_effect = [requests.ConnectionError('RESET')] * 4
+        with pytest.raises(requests.ConnectionError):
+            c.get('https://api.github.com/')
+
+    @mock.patch('requests.Session.post')
+    def test_request_retry_post(self, m_post):
+        sleep = mock.Mock()
+        c = Client.gitlab('TOKEN', rate_limiter=RateLimiter(max_retries=3,
+                                                            sleep=sleep))
+        url = 'http://gitlab/api/v4/projects'
+        #
+        # the POST may have been carried out: it is not retried
+        #
+        m_post.side_effect = [response(502), response(201)]
+        assert 502 == c.post(url).status_code
+        assert 1 == m_post.call_count
+        m_post.reset_mock()
+        m_post.side_effect = [requests.ConnectionError('RESET')]
+        with pytest.raises(requests.ConnectionError):
+            c.post(url)
+        assert 1 == m_post.call_count
+        #
+        # the POST was not carried out: it is retried
+        #
+        m_post.reset_mock()
+        refused = urllib3_exceptions.MaxRetryError(
+            None, url, urllib3_exceptions.NewConnectionError(None, 'REFUSED'))
+        m_post.side_effect = [
+            requests.ConnectionError(refused),
+            requests.exceptions.ConnectTimeout('TIMEOUT'),
+            response(429, {'Retry-After': '1'}),
+            response(201),
+        ]
+        assert 201 == c.post(url).status_code
+        assert 4 == m_post.call_count
@@ -0,0 +1,188 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import hashlib
+import hmac
+import json
+import logging
+import mock
+import os
+import pytest
+import requests
+import threading
+import time
+
+from github2gitlab.daemon import Daemon
+
+SECRET = 'SECRET'
+
+
+def signature(body):
+    return 'sha256=' + hmac.new(SECRET.encode('utf-8'), body,
+                                hashlib.sha256).hexdigest()
+
+
+def pull_request(number):
+    return {
+        'action': 'synchronize',
+        'number': number,
+        'pull_request': {'number': number},
+        'repository': {'full_name': 'User/Repo'},
+    }
+
+
+def push(ref, deleted=False):
+    return {
+        'ref': ref,
+        'deleted': deleted,
+        'repository': {'full_name': 'user/repo'},
+    }
+
+
+class TestDaemon(object):
+
+    def setup_method(self):
+        self.daemon = Daemon.factory([
+            '--gitlab-url', 'http://gitlab',
+            '--gitlab-token', 'token',
+            '--github-repo', 'user/repo',
+            '--webhook-secret', SECRET,
+            '--port', '0',
+            '--coalesce-delay', '10',
+        ])
+
+    def receive(self, event, payload, sign=True):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'X-GitHub-Event': event}
+        if sign:
+            headers['X-Hub-Signature-256'] = signature(body)
+        return self.daemon.receive(headers, body)
+
+    def test_verify(self):
+        body = b'{}'
+        assert Daemon.verify(SECRET, body, signature(body))
+        assert not Daemon.verify(SECRET, body + b' ', signature(body))
+        assert not Daemon.verify(SECRET, body, None)
+        assert not Daemon.verify(SECRET, body, 'sha1=' + '0' * 40)
+        assert not Daemon.verify(None, body, signature(body))
+
+    def test_insecure(self):
+        argv = [
+            '--gitlab-url', 'http://gitlab',
+            '--gitlab-token', 'token',
+            '--github-repo', 'user/repo',
+        ]
+        with mock.patch.dict('os.environ'):
+            os.environ.pop('GITHUB2GITLAB_WEBHOOK_SECRET', None)
+            with pytest.raises(SystemExit):
+                Daemon.factory(argv)
+            self.daemon = Daemon.factory(argv + ['--insecure-webhooks'])
+            with pytest.raises(SystemExit):
+                Daemon.factory(argv + ['--insecure-webhooks',
+                                       '--record', 'cassette.jsonl.gz'])
+        assert 202 == self.receive('pull_request', pull_request(1),
+                                   sign=False)[0]
+
+    def test_verbose(self):
+        logger = logging.getLogger('github2gitlab')
+        level = logger.level
+        try:
+            logger.setLevel(logging.WARNING)
+            Daemon.factory(['--gitlab-url', 'http://gitlab',
+                            '--gitlab-token', 'token',
+                            '--github-repo', 'user/repo',
+                            '--insecure-webhooks'])
+            assert logging.INFO == logger.level
+            self.daemon.mirror()
+            assert logging.INFO == logger.level
+        finally:
+            logger.setLevel(level)
+
+    def test_receive(self):
+        assert 202 == self.receive('pull_request', pull_request(1))[0]
+        assert 202 == self.receive('push', push('refs/heads/master'))[0]
+        assert ['pull', 'ref'] == sorted([kind for (kind, name)
+                                          in self.daemon.pending.keys()])
+        assert 401 == self.receive('pull_request', pull_request(2),
+                                   sign=False)[0]
+        assert 200 == self.receive('ping', {'zen': 'zen'})[0]
+        other = pull_request(3)
+        other['repository']['full_name'] = 'other/repo'
+        assert 200 == self.receive('pull_request', other)[0]
+        headers = {'X-Hub-Signature-256': signature(b']')}
+        assert 400 == self.daemon.receive(headers, b']')[0]
+        assert 2 == len(self.daemon.pending)
+
+    def test_take(self):
+        for i in range(3):
+            self.receive('pull_request', pull_request(1))
+        self.receive('push', push('refs/heads/master'))
+        self.receive('push', push('refs/heads/master', deleted=True))
+        now = time.time()
+        assert [] == self.daemon.take(now)
+        due = self.daemon.take(now + 10)
+        assert [('pull', '1'), ('ref', 'refs/heads/master')] == [
+            key for (key, payload) in due]
+        assert due[1][1]['deleted']
+        assert {} == self.daemon.pending
+
+    @mock.patch('github2gitlab.daemon.Daemon.process')
+    @mock.patch('github2gitlab.daemon.Daemon.mirror')
+    def test_step(self, m_mirror, m_process):
+        self.daemon.args.coalesce_delay = 0
+        #
+        # the events received before a reconciliation are dropped
+        #
+        self.receive('pull_request', pull_request(1))
+        self.daemon.step()
+        m_mirror.return_value.run.assert_called_with()
+        assert {} == self.daemon.pending
+        self.receive('pull_request', pull_request(2))
+        self.daemon.step()
+        m_process.assert_called_with(('pull', '2'), pull_request(2))
+
+    @mock.patch('github2gitlab.daemon.Daemon.mirror')
+    def test_process(self, m_mirror):
+        g = m_mirror.return_value
+        g.get_pull_request.return_value = {'number': 1}
+        self.daemon.process(('pull', '1'), pull_request(1))
+        g.get_pull_request.assert_called_with('1')
+        g.mirror_pull.assert_called_with({'number': 1})
+        self.daemon.process(('ref', 'refs/heads/master'),
+                            push('refs/heads/master', deleted=True))
+        g.mirror_ref.assert_called_with('refs/heads/master', True)
+        g.mirror_ref.side_effect = ValueError()
+        # the errors are logged, not raised
+        self.daemon.process(('ref', 'refs/heads/master'),
+                            push('refs/heads/master'))
+
+    def test_server(self):
+        server = self.daemon.server()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://%s:%d/' % server.server_address[:2]
+            body = json.dumps(push('refs/tags/v1.0')).encode('utf-8')
+            r = requests.post(url, data=body, headers={
+                'X-GitHub-Event': 'push',
+                'X-Hub-Signature-256': signature(body),
+            })
+            assert 202 == r.status_code
+            assert [('ref', 'refs/tags/v1.0')] == list(
+                self.daemon.pending.keys())
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
@@ -19,19 +19,29 @@
 #
 import git
 import gitdb
+import json
 import logging
 import mock
 import os
 import pytest
 import shutil
 import tempfile
+import threading
+import time
 
-from github2gitlab import main
+from github2gitlab import cache, main
+from github2gitlab.records import MergeRequest, PullRequest
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
                     level=logging.DEBUG)
 
 
+class Response(object):
+    status_code = 200
+    headers = {}
+    content = b""
+
+
 class TestGitHub2GitLab(object):
 
     def setup(self):
@@ -55,12 +65,16 @@ class TestGitHub2GitLab(object):
         assert os.environ['HOME'] in self.g.args.ssh_public_key
         assert self.github_repo == self.g.github['repo']
         assert self.gitlab_url in self.g.gitlab['url']
+        assert (self.g.gitlab['client'] ==
+                self.g.client_for(self.g.gitlab['url'] + '/projects'))
+        assert (self.g.github['client'] ==
+                self.g.client_for(self.g.github['url'] + '/repos'))
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_get(self, m_requests_get):
         g = self.g
 
-        class Request(object):
+        class Request(Response):
             def __init__(self, params):
                 if params.get('page') == '1':
                     self.payload = [1]
@@ -75,21 +89,259 @@ class TestGitHub2GitLab(object):
             def json(self):
                 return self.payload
 
-        m_requests_get.side_effect = lambda url, params: Request(params)
+        m_requests_get.side_effect = (
+            lambda url, params, **kwargs: Request(params))
         result = self.g.get(self.g.gitlab['url'], {'key': 'value'},
                             cache=False)
+        # items are only requested when consumed
+        assert not m_requests_get.called
+        result = list(result)
         assert m_requests_get.called
         assert [0, 1] == result
         other_result = self.g.get(self.g.gitlab['url'], {'key': 'value'},
                                   cache=False)
-        assert result == other_result
+        assert result == list(other_result)
+
+    @mock.patch('requests.Session.get')
+    def test_get_cache(self, m_requests_get):
+        g = self.g
+        g.args.cache_dir = self.d
+        url = g.github['url'] + '/repos/user/repo/pulls'
+
+        class Request(Response):
+            def __init__(self, params):
+                page = int(params.get('page', 1))
+                self.payload = [{'number': page}]
+                self.headers = {}
+                if page < 3:
+                    self.headers['Link'] = ('<' + url + '?page=' +
+                                            str(page + 1) + '>; rel="next"')
+
+            def json(self):
+                return self.payload
+
+        m_requests_get.side_effect = (
+            lambda url, params, **kwargs: Request(params))
+        #
+        # a listing that is not consumed entirely is not cached
+        #
+        pulls = g.get(url, {}, cache=True)
+        assert {'number': 1} == next(pulls)
+        pulls.close()
+        assert [] == os.listdir(self.d + '/list')
+        #
+        # the cache has one pull request per line
+        #
+        assert [1, 2, 3] == [pull['number']
+                             for pull in g.get(url, {}, cache=True)]
+        (cached,) = os.listdir(self.d + '/list')
+        with open(self.d + '/list/' + cached) as f:
+            assert 3 == len(f.readlines())
+        m_requests_get.reset_mock()
+        assert [1, 2, 3] == [pull['number']
+                             for pull in g.get(url, {}, cache=True)]
+        assert not m_requests_get.called
+        #
+        # another query is another entry
+        #
+        assert 3 == len(list(g.get(url, {'state': 'all'}, cache=True)))
+        assert m_requests_get.called
+        assert 2 == len(os.listdir(self.d + '/list'))
+        assert {'evictions': 0, 'hits': 1, 'misses': 3,
+                'stores': 2} == g.listing_cache().stats()
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_mirror')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.add_project')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.add_key')
+    def test_run_metrics(self, m_add_key, m_add_project, m_git_mirror):
+        g = self.g
+        g.args.skip_pull_requests = True
+        g.args.metrics_json = self.d + '/metrics.json'
+        g.args.metrics_textfile = self.d + '/github2gitlab.prom'
+        m_add_project.return_value = False
+        m_git_mirror.side_effect = ValueError()
+        # the metrics of a failed run are written as well
+        with pytest.raises(ValueError):
+            g.run()
+        with open(g.args.metrics_json) as f:
+            assert ['add_key', 'add_project', 'git_mirror'] == sorted(
+                json.load(f)['phases'].keys())
+        assert os.path.exists(g.args.metrics_textfile)
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_mirror')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.add_project')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.add_key')
+    def test_run_mirror_cache(self, m_add_key, m_add_project, m_git_mirror):
+        g = self.g
+        g.args.skip_pull_requests = True
+        g.args.mirror_cache = True
+        g.args.cache_dir = self.d
+        m_add_project.return_value = False
+        path = g.repo_path()
+        assert path.startswith(self.d + '/mirrors/user_repo-')
+
+        def git_mirror():
+            g.sh("git init --quiet --bare " + path)
+            # the bare clone is not evicted while it is mirrored
+            cache.MirrorCache(self.d + '/mirrors', max_size=0).evict()
+            assert os.path.exists(path)
+        m_git_mirror.side_effect = git_mirror
+        g.run()
+        report = g.metrics.report()
+        assert 'maintenance' in report['phases']
+        assert {'evictions': 0, 'hits': 0, 'misses': 1} == \
+            report['caches']['mirror']
+        assert '0\n' == g.sh("git config gc.auto", cwd=path)
+        #
+        # the bare clone is evicted by the run of another repository
+        #
+        other = main.GitHub2GitLab.factory([
+            '--gitlab-url', self.gitlab_url,
+            '--gitlab-token', self.gitlab_token,
+            '--github-repo', 'user/other',
+            '--cache-dir', self.d,
+            '--mirror-cache',
+            '--mirror-cache-max-size', '0',
+        ])
+        with other.mirror_lock():
+            other.mirror_cache().evict()
+        assert not os.path.exists(path)
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.sync')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.get_merge_requests')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.get_pull_requests')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_mirror')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.add_project')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.add_key')
+    def test_run_transfer(self, m_add_key, m_add_project, m_git_mirror,
+                          m_get_pull_requests, m_get_merge_requests,
+                          m_sync):
+        g = self.g
+        m_add_project.return_value = False
+        pulls = {'1': PullRequest(number=1, head_sha='A')}
+        m_get_pull_requests.return_value = pulls
+        m_get_merge_requests.return_value = {}
+        #
+        # git_mirror runs while the merge requests are listed
+        #
+        listing = threading.Event()
+
+        def get_merge_requests():
+            listing.set()
+            return {}
+        m_get_merge_requests.side_effect = get_merge_requests
+        m_git_mirror.side_effect = lambda: listing.wait(5) or 1 / 0
+        g.run()
+        assert pulls == g.pull_requests
+        assert {} == g.merge_requests
+        m_sync.assert_called_with()
+        #
+        # the errors are raised when all are done
+        #
+        m_git_mirror.side_effect = ValueError()
+        listing.clear()
+        with pytest.raises(ValueError):
+            g.run()
+        assert listing.is_set()
+        #
+        # with --targeted-fetch, git_mirror fetches the listed pull requests
+        #
+        g.args.targeted_fetch = True
+        g.pull_requests = None
+
+        def git_mirror():
+            assert pulls == g.pull_requests
+        m_git_mirror.side_effect = git_mirror
+        g.run()
+        #
+        # with --sequential, git_mirror is done before listing
+        #
+        g.args.targeted_fetch = None
+        g.args.sequential = True
+        order = []
+        m_git_mirror.side_effect = lambda: order.append('git')
+        m_get_pull_requests.side_effect = (
+            lambda: order.append('pulls') or pulls)
+        m_get_merge_requests.side_effect = (
+            lambda: order.append('merges') or {})
+        g.run()
+        assert ['git', 'pulls', 'merges'] == order
+
+    def test_cache_ttl(self):
+        self.g.args.cache_ttl = ['pulls=60', '3600']
+        assert 60 == self.g.cache_ttl(self.g.github['url'] +
+                                      '/repos/user/repo/pulls')
+        assert 3600 == self.g.cache_ttl(self.g.gitlab['url'] +
+                                        '/projects/1/merge_requests')
+        self.g.args.cache_ttl = []
+        assert cache.LISTING_TTL == self.g.cache_ttl('http://a/pulls')
+
+    @mock.patch('requests.Session.get')
+    def test_get_concurrent(self, m_requests_get):
+        g = self.g
+        url = g.github['url'] + '/repos/user/repo/pulls'
+        last = 5
+
+        class Request(Response):
+            def __init__(self, params):
+                page = int(params.get('page', 1))
+                assert 100 == int(params['per_page'])
+                self.payload = [page]
+                self.headers = {}
+                if page == 1:
+                    self.headers['Link'] = (
+                        '<' + url + '?page=2&per_page=100>; rel="next", ' +
+                        '<' + url + '?page=' + str(last) +
+                        '&per_page=100>; rel="last"')
+
+            def json(self):
+                return self.payload
+
+        m_requests_get.side_effect = (
+            lambda url, params, **kwargs: Request(params))
+        assert [1, 2, 3, 4, 5] == list(g.get(url, {'state': 'all'},
+                                             cache=False))
+        assert last == m_requests_get.call_count
+
+    @mock.patch('requests.Session.get')
+    def test_get_keyset(self, m_requests_get):
+        g = self.g
+        url = g.gitlab['url'] + '/projects/user%2Frepo/merge_requests'
+
+        class Request(Response):
+            def __init__(self, params):
+                assert 'keyset' == params['pagination']
+                self.headers = {}
+                if 'id_after' in params:
+                    self.payload = [2]
+                else:
+                    self.payload = [1]
+                    self.headers['Link'] = (
+                        '<' + url + '?id_after=1&pagination=keyset>; '
+                        'rel="next"')
+
+            def json(self):
+                return self.payload
+
+        m_requests_get.side_effect = (
+            lambda url, params, **kwargs: Request(params))
+        assert [1, 2] == list(g.get(url, {}, cache=False, keyset=True))
+
+    def test_links(self):
+        class Result(object):
+            headers = {
+                'Link': ('<http://a?page=2>; rel="next", '
+                         '<http://a?page=3>; rel="last"'),
+            }
+        assert ({'next': 'http://a?page=2', 'last': 'http://a?page=3'} ==
+                main.GitHub2GitLab.links(Result()))
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_get_pull_requests(self, m_requests_get):
         number1 = 1
         number2 = 2
 
-        class Request(object):
+        class Request(Response):
             def __init__(self):
                 self.headers = {}
 
@@ -97,19 +349,164 @@ class TestGitHub2GitLab(object):
                 return [{"number": number1},
                         {"number": number2}]
 
-        m_requests_get.side_effect = lambda url, params: Request()
+        m_requests_get.side_effect = lambda url, **kwargs: Request()
         result = self.g.get_pull_requests()
         assert {
-            str(number1): {u'number': number1},
-            str(number2): {u'number': number2},
+            str(number1): PullRequest(number=number1),
+            str(number2): PullRequest(number=number2),
         } == result
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
+    def test_get_pull_requests_incremental(self, m_requests_get):
+        self.g.args.incremental = True
+        self.g.args.cache_dir = self.d
+        url = self.g.github['url'] + '/repos/user/repo/pulls'
+        pages = 3
+
+        class Request(Response):
+            def __init__(self, params):
+                self.params = dict(params)
+                page = int(params.get('page', 1))
+                self.headers = {}
+                if page < pages:
+                    self.headers['Link'] = ('<' + url + '?page=' +
+                                            str(page + 1) + '>; rel="next"')
+                self.payload = [
+                    {'number': page,
+                     'state': 'open',
+                     'updated_at': '2016-01-0' + str(9 - page)},
+                ]
+
+            def json(self):
+                return self.payload
+
+        requests = []
+
+        def get(url, params, **kwargs):
+            requests.append(Request(params))
+            return requests[-1]
+        m_requests_get.side_effect = get
+
+        #
+        # without a high-water mark all pull requests are listed
+        # and the most recent updated_at becomes the mark
+        #
+        result = self.g.get_pull_requests()
+        assert 'sort' not in requests[0].params
+        assert pages == len(requests)
+        assert pages == len(result)
+        assert '2016-01-08' == self.g.next_state['updated_at']
+        assert self.g.next_state['full_sync']
+        self.g.save_state(self.g.next_state)
+
+        #
+        # with a high-water mark, pagination stops on the first
+        # page that contains an older pull request
+        #
+        del requests[:]
+        result = self.g.get_pull_requests()
+        assert 'updated' == requests[0].params['sort']
+        assert 'desc' == requests[0].params['direction']
+        assert 2 == len(requests)
+        assert ['1', '2'] == sorted(result.keys())
+        assert '2016-01-08' == self.g.next_state['updated_at']
+
+        #
+        # a full reconciliation happens when the last one is too old
+        #
+        del requests[:]
+        self.g.args.full_sync_interval = 0
+        result = self.g.get_pull_requests()
+        assert 'sort' not in requests[0].params
+        assert pages == len(requests)
+
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
+    def test_get_pull_requests_graphql(self, m_requests_post,
+                                       m_requests_get):
+        self.g.args.github_graphql = True
+        self.g.github['token'] = 'TOKEN'
+
+        def node(number, state):
+            return {'number': number, 'title': 'TITLE', 'body': None,
+                    'state': state, 'mergedAt': None,
+                    'updatedAt': '2016-01-01T00:00:00Z',
+                    'baseRefName': 'master', 'headRefOid': 'SHA'}
+
+        class Query(Response):
+            def __init__(self, variables):
+                cursor = variables['cursor']
+                self.payload = {'data': {'repository': {'pullRequests': {
+                    'pageInfo': {'hasNextPage': cursor is None,
+                                 'endCursor': 'CURSOR'},
+                    'nodes': [node(2 if cursor else 1,
+                                   'MERGED' if cursor else 'OPEN')],
+                }}}}
+
+            def json(self):
+                return self.payload
+
+        m_requests_post.side_effect = (
+            lambda url, json, **kwargs: Query(json['variables']))
+        pulls = self.g.get_pull_requests()
+        assert 2 == m_requests_post.call_count
+        assert not m_requests_get.called
+        assert 'open' == pulls['1']['state']
+        assert 'closed' == pulls['2']['state']
+        assert 'master' == pulls['1']['base_ref']
+        assert 'SHA' == pulls['1']['head_sha']
+
+        #
+        # fall back to REST if the query fails
+        #
+        class Error(Response):
+            def json(self):
+                return {'errors': [{'message': 'FAIL'}]}
+
+        class Rest(Response):
+            def json(self):
+                return [{'number': 3, 'state': 'open'}]
+
+        m_requests_post.side_effect = lambda url, **kwargs: Error()
+        m_requests_get.side_effect = lambda url, **kwargs: Rest()
+        assert ['3'] == list(self.g.get_pull_requests().keys())
+
+        self.g.github['token'] = None
+        m_requests_post.reset_mock()
+        assert ['3'] == list(self.g.get_pull_requests().keys())
+        assert not m_requests_post.called
+
+    def test_state(self):
+        self.g.args.cache_dir = self.d + '/cache'
+        assert {} == self.g.load_state()
+        self.g.save_state({'updated_at': 'DATE'})
+        assert {'updated_at': 'DATE'} == self.g.load_state()
+        assert self.g.state_path().startswith(self.d + '/cache/state/')
+
+        #
+        # the same GitHub repository mirrored to another GitLab project
+        # or to another GitLab instance does not share the state
+        #
+        other = main.GitHub2GitLab.factory([
+            '--gitlab-url', self.gitlab_url,
+            '--gitlab-token', self.gitlab_token,
+            '--github-repo', self.github_repo,
+            '--gitlab-repo', 'user/repo-backports',
+            '--cache-dir', self.d + '/cache',
+        ])
+        assert self.g.state_path() != other.state_path()
+        assert {} == other.load_state()
+        other.gitlab['repo'] = self.g.gitlab['repo']
+        assert self.g.state_path() == other.state_path()
+        other.gitlab['host'] = 'http://other-gitlab'
+        assert self.g.state_path() != other.state_path()
+
+    @mock.patch('requests.Session.get')
     def test_get_merge_requests(self, m_requests_get):
         id1 = 100
         id2 = 200
 
-        class Request(object):
+        class Request(Response):
             def __init__(self):
                 self.headers = {}
 
@@ -117,19 +514,19 @@ class TestGitHub2GitLab(object):
                 return [{"id": id1},
                         {"id": id2}]
 
-        m_requests_get.side_effect = lambda url, params: Request()
+        m_requests_get.side_effect = lambda url, **kwargs: Request()
         result = self.g.get_merge_requests()
         assert {
-            str(id1): {u'id': id1},
-            str(id2): {u'id': id2},
+            str(id1): MergeRequest(id=id1),
+            str(id2): MergeRequest(id=id2),
         } == result
 
-    @mock.patch('requests.put')
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.put')
+    @mock.patch('requests.Session.get')
     def test_unprotect_branches(self,
                                 m_requests_get,
                                 m_requests_put):
-        class Get(object):
+        class Get(Response):
             def raise_for_status(self):
                 pass
 
@@ -144,12 +541,12 @@ class TestGitHub2GitLab(object):
                         'protected': False,
                     },
                 ]
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
 
-        class Put(object):
+        class Put(Response):
             def raise_for_status(self):
                 pass
-        m_requests_put.side_effect = lambda url, params: Put()
+        m_requests_put.side_effect = lambda url, **kwargs: Put()
         assert 1 == self.g.unprotect_branches()
         assert m_requests_get.called
         assert m_requests_put.called
@@ -178,26 +575,26 @@ class TestGitHub2GitLab(object):
         assert (self.g.pull2merge ==
                 {'1': {u'id': 100, u'source_branch': 'pull/1/head'}})
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_create_merge_request(self, m_requests_post):
         data = {'title': u'TITLE é'}
 
-        class Request(object):
+        class Request(Response):
             def __init__(self):
                 self.status_code = 201
 
             def json(self):
                 return data
 
-        m_requests_post.side_effect = lambda url, params: Request()
+        m_requests_post.side_effect = lambda url, **kwargs: Request()
         self.g.create_merge_request(data)
         assert m_requests_post.called
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_create_merge_request_fail(self, m_requests_post):
         data = {'title': u'TITLE é'}
 
-        class Request(object):
+        class Request(Response):
             def __init__(self):
                 self.status_code = 400
                 self.text = 'FAIL'
@@ -207,28 +604,28 @@ class TestGitHub2GitLab(object):
             self.g.create_merge_request(data)
         assert m_requests_post.called
 
-    @mock.patch('requests.put')
+    @mock.patch('requests.Session.put')
     def test_update_merge_request(self, m_requests_put):
         data = {
             'title': u'TITLE é',
             'state_event': 'close',
         }
 
-        class Request(object):
+        class Request(Response):
             def json(self):
                 data['state'] = 'closed'
                 return data
 
-        m_requests_put.side_effect = lambda url, params: Request()
+        m_requests_put.side_effect = lambda url, **kwargs: Request()
         merge_request = {'id': 3}
         self.g.update_merge_request(merge_request, data)
         assert m_requests_put.called
 
-    @mock.patch('requests.put')
+    @mock.patch('requests.Session.put')
     def test_update_merge_request_fail_state(self, m_requests_put):
         data = {'state_event': 'close'}
 
-        class Request(object):
+        class Request(Response):
             def json(self):
                 return {
                     'state': 'UNEXPECTED',
@@ -236,7 +633,7 @@ class TestGitHub2GitLab(object):
                     'merged': False,
                 }
 
-        m_requests_put.side_effect = lambda url, params: Request()
+        m_requests_put.side_effect = lambda url, **kwargs: Request()
         merge_request = {'id': 3}
         with pytest.raises(ValueError) as e:
             self.g.update_merge_request(merge_request, data)
@@ -265,63 +662,63 @@ class TestGitHub2GitLab(object):
         assert self.g.TAG_MERGED in result['description']
         assert m_verify_merge_update.called
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
     def test_add_project_create(self,
                                 m_requests_post,
                                 m_requests_get):
-        class Get(object):
+        class Get(Response):
 
             def __init__(self):
                 self.status_code = 404
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
 
-        class Post(object):
+        class Post(Response):
             def __init__(self):
                 self.status_code = 201
                 self.text = 'true'
 
             def json(self):
                 return {}
-        m_requests_post.side_effect = lambda url, params: Post()
+        m_requests_post.side_effect = lambda url, **kwargs: Post()
         assert {} == self.g.add_project()
         assert m_requests_get.called
         assert m_requests_post.called
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
     def test_add_project_create_400(self,
                                     m_requests_post,
                                     m_requests_get):
-        class Get(object):
+        class Get(Response):
 
             def __init__(self):
                 self.status_code = 404
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
         error_message = 'ERROR MESSAGE'
 
-        class Post(object):
+        class Post(Response):
             def __init__(self):
                 self.status_code = 400
                 self.text = error_message
-        m_requests_post.side_effect = lambda url, params: Post()
+        m_requests_post.side_effect = lambda url, **kwargs: Post()
         with pytest.raises(ValueError) as e:
             self.g.add_project()
         assert error_message in str(e)
         assert m_requests_get.called
         assert m_requests_post.called
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_add_project_noop(self, m_requests_get):
-        class Get(object):
+        class Get(Response):
             def __init__(self):
                 self.status_code = 200
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
         assert None == self.g.add_project()
         assert m_requests_get.called
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
     def test_add_key_create(self,
                             m_requests_post,
                             m_requests_get):
@@ -331,21 +728,21 @@ class TestGitHub2GitLab(object):
             f.write(public_key)
         self.g.args.ssh_public_key = ssh_public_key
 
-        class Get(object):
+        class Get(Response):
             def json(self):
                 return []
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
 
-        class Post(object):
+        class Post(Response):
             def __init__(self):
                 self.status_code = 201
-        m_requests_post.side_effect = lambda url, params: Post()
+        m_requests_post.side_effect = lambda url, **kwargs: Post()
         assert public_key == self.g.add_key()
         assert m_requests_get.called
         assert m_requests_post.called
 
-    @mock.patch('requests.get')
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.get')
+    @mock.patch('requests.Session.post')
     def test_add_key_create_400(self,
                                 m_requests_post,
                                 m_requests_get):
@@ -355,24 +752,24 @@ class TestGitHub2GitLab(object):
             f.write(public_key)
         self.g.args.ssh_public_key = ssh_public_key
 
-        class Get(object):
+        class Get(Response):
             def json(self):
                 return []
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
         error_message = 'ERROR MESSAGE'
 
-        class Post(object):
+        class Post(Response):
             def __init__(self):
                 self.status_code = 400
                 self.text = error_message
-        m_requests_post.side_effect = lambda url, params: Post()
+        m_requests_post.side_effect = lambda url, **kwargs: Post()
         with pytest.raises(ValueError) as e:
             self.g.add_key()
         assert error_message in str(e)
         assert m_requests_get.called
         assert m_requests_post.called
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     def test_add_key_noop(self, m_requests_get):
         public_key = 'PUBLIC KEY'
         ssh_public_key = self.d + "/key.pub"
@@ -380,10 +777,10 @@ class TestGitHub2GitLab(object):
             f.write(public_key)
         self.g.args.ssh_public_key = ssh_public_key
 
-        class Get(object):
+        class Get(Response):
             def json(self):
                 return [{'key': public_key}]
-        m_requests_get.side_effect = lambda url, params: Get()
+        m_requests_get.side_effect = lambda url, **kwargs: Get()
         assert None == self.g.add_key()
         assert m_requests_get.called
 
@@ -401,9 +798,7 @@ class TestGitHub2GitLab(object):
                 'state': 'open',
                 'title': u'TITLE é',
                 'body': 'DESCRIPTION è',
-                'base': {
-                    'ref': 'master',
-                },
+                'base_ref': 'master',
                 'merged_at': None,
             },
             '2': {
@@ -440,10 +835,174 @@ class TestGitHub2GitLab(object):
         m_create_merge_request.assert_called_with({
             'title': pull['title'],
             'description': pull['body'],
-            'target_branch': pull['base']['ref'],
+            'target_branch': pull['base_ref'],
             'source_branch': 'pull/' + str(pull['number']) + '/head',
         })
 
+    @mock.patch('github2gitlab.main.GitHub2GitLab.update_merge_request')
+    def test_sync_incremental(self, m_update_merge_request):
+        self.g.args.incremental = True
+        self.g.args.cache_dir = self.d
+        pull = {
+            'number': 1,
+            'state': 'open',
+            'title': 'TITLE',
+            'body': 'DESCRIPTION',
+            'updated_at': 'PULL DATE',
+        }
+        merge = {
+            'id': 100,
+            'iid': 10,
+            'state': 'opened',
+            'title': 'OTHER TITLE',
+            'description': 'DESCRIPTION',
+            'updated_at': 'MERGE DATE',
+        }
+        updated = dict(merge, title='TITLE', updated_at='NEW MERGE DATE')
+        m_update_merge_request.return_value = updated
+        self.g.pull_requests = {'1': pull}
+        self.g.pull2merge = {'1': merge}
+        self.g.sync()
+        assert 1 == m_update_merge_request.call_count
+        known = self.g.state_store().pull(1)
+        assert 10 == known['iid']
+        assert 'NEW MERGE DATE' == known['merge_updated_at']
+
+        #
+        # nothing changed: the pull request is not compared
+        #
+        self.g.pull2merge = {'1': updated}
+        with mock.patch.object(self.g, 'field_equal') as m_field_equal:
+            self.g.sync()
+            assert not m_field_equal.called
+
+        #
+        # the merge request changed: it is compared
+        #
+        self.g.pull2merge = {'1': dict(merge, updated_at='EDITED')}
+        self.g.sync()
+        assert 2 == m_update_merge_request.call_count
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.list_merge_requests')
+    def test_get_merge_requests_incremental(self, m_list_merge_requests):
+        self.g.args.incremental = True
+        self.g.args.cache_dir = self.d
+        m_list_merge_requests.return_value = [
+            {'id': 100, 'iid': 1, 'title': 'ONE'},
+            {'id': 200, 'iid': 2, 'title': 'TWO'},
+        ]
+        merges = self.g.get_merge_requests()
+        assert ['100', '200'] == sorted(merges.keys())
+        m_list_merge_requests.assert_called_with()
+
+        #
+        # only the merge requests recently updated are listed
+        # and merged with those already known
+        #
+        m_list_merge_requests.return_value = [
+            {'id': 200, 'iid': 2, 'title': 'UPDATED'},
+            {'id': 300, 'iid': 3, 'title': 'THREE'},
+        ]
+        merges = self.g.get_merge_requests()
+        assert 'updated_after' in m_list_merge_requests.call_args[0][0]
+        assert ['100', '200', '300'] == sorted(merges.keys())
+        assert 'UPDATED' == merges['200']['title']
+
+        #
+        # a full listing forgets the merge requests that were removed
+        #
+        self.g.args.full_sync_interval = 0
+        merges = self.g.get_merge_requests()
+        m_list_merge_requests.assert_called_with()
+        assert ['200', '300'] == sorted(merges.keys())
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.list_merge_requests')
+    def test_get_merge_request_of(self, m_list_merge_requests):
+        self.g.args.cache_dir = self.d
+        assert self.g.get_merge_request_of('1') is None
+        self.g.state_store().record(1, 10, None, 'FINGERPRINT', None)
+        merge = {'id': 100, 'iid': 10, 'source_branch': 'pull/1/head'}
+        m_list_merge_requests.return_value = [merge]
+        assert (MergeRequest.from_api(merge) ==
+                self.g.get_merge_request_of('1'))
+        m_list_merge_requests.assert_called_with({'iids[]': [10]})
+        m_list_merge_requests.return_value = []
+        assert self.g.get_merge_request_of('1') is None
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.list_merge_requests')
+    def test_state_check(self, m_list_merge_requests):
+        self.g.args.cache_dir = self.d
+        self.g.args.state_check = True
+        store = self.g.state_store()
+        store.record(1, 10, None, 'FINGERPRINT', None)
+        store.commit()
+        m_list_merge_requests.return_value = [
+            {'iid': 10, 'source_branch': 'pull/1/head'},
+        ]
+        assert 0 == self.g.run()
+        m_list_merge_requests.return_value = [
+            {'iid': 10, 'source_branch': 'pull/2/head'},
+        ]
+        assert 1 == self.g.run()
+        m_list_merge_requests.return_value = []
+        assert 1 == self.g.run()
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.sync_pull')
+    def test_sync_concurrency(self, m_sync_pull):
+        self.g.pull_requests = dict([(str(n), {'number': n})
+                                     for n in range(1, 20)])
+        self.g.args.concurrency = 4
+        self.g.sync()
+        assert 19 == m_sync_pull.call_count
+        assert (sorted(self.g.pull_requests.keys()) ==
+                sorted([c[0][0] for c in m_sync_pull.call_args_list]))
+
+        m_sync_pull.side_effect = ValueError('FAIL')
+        with pytest.raises(ValueError):
+            self.g.sync()
+
+    def test_rev_parse(self):
+        self.g.sh("""
+        git init --bare project
+        cd project
+        sha=$(git -c user.name=a -c user.email=a@a commit-tree -m a \\
+              4b825dc642cb6eb9a060e54bf8d69288fbee4904)
+        git update-ref refs/heads/master $sha
+        git update-ref refs/heads/pull/1/head $sha
+        """, cwd=self.d)
+        self.g.args.workdir = self.d
+        self.g.gitlab['name'] = 'project'
+        pull = {'number': 1}
+        assert self.g.rev_parse(pull, 'master')
+        assert self.g.rev_parse(pull, 'pull/1/head')
+        assert not self.g.rev_parse(pull, 'pull/2/head')
+        refs = self.g.ref_index()
+        assert refs['refs/heads/master'] == refs['refs/heads/pull/1/head']
+        assert 2 == len(refs)
+        #
+        # the sync_pull threads load the index once and never see it
+        # half filled
+        #
+        self.g.refs = None
+        git = self.g.git
+        loads = []
+
+        def slow_git(args, **kwargs):
+            loads.append(args[0])
+            time.sleep(0.1)
+            return git(args, **kwargs)
+        self.g.git = slow_git
+        found = []
+        threads = [threading.Thread(
+            target=lambda: found.append(self.g.rev_parse(pull, 'master')))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [True] * 8 == found
+        assert ['for-each-ref'] == loads
+
     @mock.patch('github2gitlab.main.GitHub2GitLab.gitlab_create_remote')
     def test_gitmirror(self, m_gitlab_create_remote):
         self.g.args.skip_pull_requests = True
@@ -470,6 +1029,13 @@ class TestGitHub2GitLab(object):
         self.g.github['git'] = self.d
         self.g.github['repo'] = 'github'
         self.g.gitlab['name'] = 'project'
+        summaries = []
+        git_mirror_optimize = self.g.git_mirror_optimize
+
+        def optimize(repo):
+            summaries.append(git_mirror_optimize(repo))
+            return summaries[-1]
+        self.g.git_mirror_optimize = optimize
 
         cwd = os.getcwd()
         os.chdir(self.d)
@@ -510,6 +1076,7 @@ class TestGitHub2GitLab(object):
 
         self.g.git_mirror()
         assert gitlab.commit('pull/1/merge') == github.commit('pull/1/merge')
+        assert {'create': 1, 'update': 0} == summaries[-1]
 
         #
         # When the base (master in this case) changes, github
@@ -602,6 +1169,7 @@ class TestGitHub2GitLab(object):
         """.format(dir=self.d))
 
         self.g.git_mirror()
+        assert {'create': 0, 'update': 1} == summaries[-1]
         merge_2 = gitlab.commit('pull/3/merge')
         assert merge_1 != merge_2
         assert merge_2 == github.commit('pull/3/merge')
@@ -649,6 +1217,224 @@ class TestGitHub2GitLab(object):
 
         os.chdir(cwd)
 
+    @mock.patch('github2gitlab.main.GitHub2GitLab.gitlab_create_remote')
+    def test_gitmirror_delta_push(self, m_gitlab_create_remote):
+        self.g.args.skip_pull_requests = True
+        self.g.args.delta_push = True
+        self.g.args.push_chunk = 2
+        self.g.args.workdir = self.d
+
+        self.g.sh("""
+        mkdir github
+        cd github
+        git init
+        echo a > a ; git add a ; git commit -m "a" a
+        git tag -a -m 'v1' v1
+        for b in b c d ; do git branch $b ; done
+        cd ..
+        git init --bare gitlab
+        """, cwd=self.d)
+
+        def gitlab_create_remote(repo):
+            repo.create_remote('gitlab', self.d + "/gitlab")
+        m_gitlab_create_remote.side_effect = gitlab_create_remote
+
+        self.g.github['git'] = self.d
+        self.g.github['repo'] = 'github'
+        self.g.gitlab['name'] = 'project'
+        gitlab = git.Repo(self.d + '/gitlab')
+        github = git.Repo(self.d + '/github')
+
+        self.g.git_mirror()
+        for ref in ('b', 'c', 'd', 'v1'):
+            assert gitlab.commit(ref) == github.commit(ref)
+        assert {'changed': 0, 'deleted': 0} == self.g.git_push_delta()
+
+        self.g.sh("""
+        git --git-dir project branch -D c
+        cd github
+        git branch -D c
+        git checkout b
+        echo b > b ; git add b ; git commit -m "b" b
+        """, cwd=self.d)
+        self.g.git_mirror()
+        assert gitlab.commit('b') == github.commit('b')
+        with pytest.raises(gitdb.exc.BadName):
+            gitlab.commit('c')
+        assert {'changed': 0, 'deleted': 0} == self.g.git_push_delta()
+
+        #
+        # branches that are not mirrored anymore are not removed
+        #
+        self.g.github['branches'] = ['b']
+        self.g.sh("git --git-dir project branch -D d", cwd=self.d)
+        self.g.git_mirror()
+        assert gitlab.commit('d')
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.gitlab_create_remote')
+    def test_gitmirror_targeted_fetch_fresh_clone(self,
+                                                  m_gitlab_create_remote):
+        self.g.args.targeted_fetch = True
+        self.g.args.workdir = self.d
+        self.g.args.fetch_chunk = 10
+        self.g.github['git'] = self.d
+        self.g.github['repo'] = 'github'
+        self.g.gitlab['name'] = 'project'
+
+        def gitlab_create_remote(repo):
+            repo.create_remote('gitlab', self.d + "/gitlab")
+        m_gitlab_create_remote.side_effect = gitlab_create_remote
+
+        self.g.sh("""
+        mkdir github
+        cd github
+        git init
+        echo a > a ; git add a ; git commit -m "a" a
+        git update-ref refs/pull/1/head HEAD
+        echo b > b ; git add b ; git commit -m "b" b
+        git update-ref refs/pull/2/head HEAD
+        git init --bare ../gitlab
+        git push ../gitlab refs/pull/1/head:refs/heads/pull/1/head \\
+                           refs/pull/2/head:refs/heads/pull/2/head
+        """, cwd=self.d)
+        github = git.Repo(self.d + '/github')
+        gitlab = git.Repo(self.d + '/gitlab')
+        sha = github.commit('HEAD').hexsha
+        github.git.commit('--allow-empty', '-m', 'c')
+        github.git.update_ref('refs/pull/2/head', 'HEAD')
+
+        #
+        # the clone is fresh and only pull request 2 is listed
+        # (--incremental): the branch of pull request 1 is kept
+        #
+        for delta_push in (False, True):
+            self.g.args.delta_push = delta_push
+            self.g.pull_requests = {
+                '2': {'state': 'closed',
+                      'head_sha': github.commit('pull/2/head').hexsha},
+            }
+            self.g.git_mirror()
+            assert gitlab.commit('pull/1/head')
+            assert (gitlab.commit('pull/2/head') ==
+                    github.commit('refs/pull/2/head'))
+            assert sha != github.commit('refs/pull/2/head').hexsha
+            shutil.rmtree(self.g.repo_path())
+
+    def test_git_fetch_pulls(self):
+        self.g.args.workdir = self.d
+        self.g.github['git'] = self.d
+        self.g.github['repo'] = 'github'
+        self.g.gitlab['name'] = 'project'
+        self.g.args.fetch_chunk = 10
+
+        self.g.sh("""
+        mkdir github
+        cd github
+        git init
+        echo a > a ; git add a ; git commit -m "a" a
+        git update-ref refs/pull/1/head HEAD
+        git update-ref refs/pull/1/merge HEAD
+        echo b > b ; git add b ; git commit -m "b" b
+        git update-ref refs/pull/2/head HEAD
+        cd ..
+        git clone --bare github project
+        """, cwd=self.d)
+        github = git.Repo(self.d + '/github')
+        project = git.Repo(self.d + '/project')
+
+        def pulls():
+            result = {}
+            for n in ('1', '2'):
+                sha = github.commit('pull/' + n + '/head').hexsha
+                result[n] = {'state': 'open', 'head_sha': sha}
+            return result
+
+        #
+        # pull/2/merge does not exist and is ignored
+        #
+        assert 2 == self.g.git_fetch_pulls(pulls())
+        for ref in ('pull/1/head', 'pull/1/merge', 'pull/2/head'):
+            assert (project.commit('refs/heads/' + ref) ==
+                    github.commit('refs/' + ref))
+        with pytest.raises(gitdb.exc.BadName):
+            project.commit('refs/heads/pull/2/merge')
+
+        #
+        # nothing is fetched unless the head of a pull request moved
+        #
+        assert 0 == self.g.git_fetch_pulls(pulls())
+        self.g.sh("""
+        cd github
+        echo c > c ; git add c ; git commit -m "c" c
+        git update-ref refs/pull/2/head HEAD
+        """, cwd=self.d)
+        assert 1 == self.g.git_fetch_pulls(pulls())
+        assert (project.commit('refs/heads/pull/2/head') ==
+                github.commit('refs/pull/2/head'))
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.sync_pull')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.list_merge_requests')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.load_refs')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_push')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_fetch_pulls')
+    def test_mirror_pull(self, m_git_fetch_pulls, m_git_push, m_load_refs,
+                         m_list_merge_requests, m_sync_pull):
+        pull = {'number': 1, 'state': 'open', 'merged_at': None}
+        merge = {'iid': 10, 'source_branch': 'pull/1/head'}
+        m_git_fetch_pulls.return_value = 1
+        m_load_refs.return_value = {'refs/heads/pull/1/head': 'SHA'}
+        m_list_merge_requests.return_value = [merge]
+        assert self.g.mirror_pull(pull)
+        m_git_fetch_pulls.assert_called_with({'1': pull})
+        m_git_push.assert_called_with([
+            '+refs/heads/pull/1/head:refs/heads/pull/1/head'])
+        m_list_merge_requests.assert_called_with(
+            {'source_branch': 'pull/1/head'})
+        assert {'1': MergeRequest.from_api(merge)} == self.g.pull2merge
+        m_sync_pull.assert_called_with('1')
+
+        #
+        # nothing is pushed if the head did not move
+        #
+        m_git_push.reset_mock()
+        m_git_fetch_pulls.return_value = 0
+        m_list_merge_requests.return_value = []
+        assert self.g.mirror_pull(pull)
+        m_git_push.assert_not_called()
+        assert {} == self.g.pull2merge
+
+        #
+        # --ignore-closed mirrors open and merged pull requests only
+        #
+        self.g.args.ignore_closed = True
+        m_sync_pull.reset_mock()
+        assert self.g.mirror_pull(pull)
+        m_sync_pull.assert_called_with('1')
+        pull['state'] = 'closed'
+        pull['merged_at'] = '2016-01-01T00:00:00Z'
+        assert self.g.mirror_pull(pull)
+        pull['merged_at'] = None
+        m_sync_pull.reset_mock()
+        assert not self.g.mirror_pull(pull)
+        m_sync_pull.assert_not_called()
+
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_push')
+    @mock.patch('github2gitlab.main.GitHub2GitLab.git_fetch')
+    def test_mirror_ref(self, m_git_fetch, m_git_push, m_git):
+        ref = 'refs/heads/master'
+        assert self.g.mirror_ref(ref)
+        m_git_fetch.assert_called_with(['+' + ref + ':' + ref])
+        m_git_push.assert_called_with(['+' + ref + ':' + ref])
+        assert self.g.mirror_ref(ref, deleted=True)
+        m_git_push.assert_called_with([':' + ref])
+        assert ['update-ref', '-d', ref] == m_git.call_args[0][0]
+        m_git_fetch.reset_mock()
+        assert not self.g.mirror_ref('refs/heads/pull/1/head')
+        self.g.github['branches'] = ['stable']
+        assert not self.g.mirror_ref(ref)
+        m_git_fetch.assert_not_called()
+
 
 class TestGitHub2GitLabNoSetup(object):
 
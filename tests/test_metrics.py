@@ -0,0 +1,147 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import json
+import mock
+import os
+import requests
+import shutil
+import tempfile
+
+from github2gitlab.client import Client
+from github2gitlab.metrics import Metrics
+
+
+class TestMetrics(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def test_endpoint(self):
+        for (url, endpoint) in (
+                ('https://api.github.com/repos/user/repo/pulls',
+                 '/repos/:repo/pulls'),
+                ('https://api.github.com/repos/user/repo/pulls/12',
+                 '/repos/:repo/pulls/:id'),
+                ('https://api.github.com/graphql', '/graphql'),
+                ('http://gitlab/api/v4/projects/user%2Frepo/merge_requests/3',
+                 '/projects/:id/merge_requests/:id'),
+                ('http://gitlab/api/v4/projects/user%2Frepo/repository/'
+                 'branches/feature/x/unprotect',
+                 '/projects/:id/repository/branches/:branch/unprotect'),
+                ('http://gitlab/api/v4/user/keys', '/user/keys'),
+                ('http://gitlab/api/v4', '/')):
+            assert endpoint == Metrics.endpoint(url)
+
+    def test_report(self):
+        m = Metrics('user/repo')
+        with m.phase('sync'):
+            pass
+        m.request('github', 'GET', 'https://api.github.com/repos/u/r/pulls',
+                  200, 0.2, 100)
+        m.request('github', 'GET', 'https://api.github.com/repos/v/w/pulls',
+                  200, 20, 50)
+        m.request('gitlab', 'PUT', 'http://gitlab/api/v4/projects/1',
+                  'error', 0.01, 0)
+        m.page('github', 'https://api.github.com/repos/u/r/pulls')
+        m.cache('etag', 'hits')
+        m.cache('etag', 'hits')
+        m.rate_limit('github', 4999, 5000)
+        report = m.report()
+        assert ['sync'] == list(report['phases'].keys())
+        (github, gitlab) = report['requests']
+        assert 'error' == gitlab['status']
+        assert 1 == gitlab['buckets']['0.05']
+        assert 2 == github['count']
+        assert 150 == github['bytes']
+        # 20 seconds is beyond the last bucket
+        assert 1 == sum(github['buckets'].values())
+        assert 1 == github['buckets']['0.25']
+        assert [{'remote': 'github', 'endpoint': '/repos/:repo/pulls',
+                 'count': 1}] == report['pages']
+        assert {'etag': {'hits': 2}} == report['caches']
+        assert {'github': {'remaining': 4999, 'limit': 5000}} == \
+            report['rate_limits']
+
+    def test_textfile(self):
+        m = Metrics('user/repo')
+        m.request('github', 'GET', 'https://api.github.com/repos/u/r/pulls',
+                  200, 0.2, 100)
+        m.rate_limit('gitlab', None, None)
+        lines = m.textfile().splitlines()
+        labels = ('{endpoint="/repos/:repo/pulls",method="GET",'
+                  'remote="github",repo="user/repo",status="200"')
+        assert ('github2gitlab_api_requests_total' + labels + '} 1.0'
+                in lines)
+
+        def bucket(le, value):
+            return ('github2gitlab_api_request_duration_seconds_bucket' +
+                    labels.replace(',method', ',le="' + le + '",method') +
+                    '} ' + value)
+        assert bucket('0.1', '0.0') in lines
+        assert bucket('0.25', '1.0') in lines
+        assert bucket('+Inf', '1.0') in lines
+        assert '# TYPE github2gitlab_api_request_duration_seconds ' \
+            'histogram' in lines
+        assert not [line for line in lines if 'rate_limit{' in line]
+        assert '{a="\\"\\\\"}' == Metrics.labels(a='"\\', b=None)
+
+    def test_git(self):
+        m = Metrics('user/repo')
+        m.git('fetch', 1.5, 1024)
+        m.git('fetch', 0.5, 0)
+        m.git('ls-remote', 0.1, 0)
+        assert {'count': 2, 'seconds': 2.0, 'bytes': 1024} == \
+            m.report()['git']['fetch']
+        lines = m.textfile().splitlines()
+        assert ('github2gitlab_git_transfer_bytes_total'
+                '{repo="user/repo",subcommand="fetch"} 1024.0' in lines)
+        assert ('github2gitlab_git_commands_total'
+                '{repo="user/repo",subcommand="ls-remote"} 1.0' in lines)
+
+    def test_save(self):
+        m = Metrics('user/repo')
+        path = self.d + '/sub/github2gitlab.prom'
+        m.save(json_path=self.d + '/metrics.json', textfile_path=path)
+        with open(self.d + '/metrics.json') as f:
+            assert 'user/repo' == json.load(f)['repo']
+        with open(path) as f:
+            assert f.read().startswith("# HELP")
+        assert ['github2gitlab.prom'] == os.listdir(self.d + '/sub')
+
+    @mock.patch('requests.Session.get')
+    def test_client(self, m_get):
+        r = requests.Response()
+        r.status_code = 200
+        r.headers['X-RateLimit-Remaining'] = '10'
+        r._content = b'[]'
+        m_get.return_value = r
+        c = Client.github()
+        c.metrics = Metrics()
+        c.get('https://api.github.com/repos/u/r/pulls')
+        m_get.side_effect = requests.ConnectionError()
+        c.rate_limiter.max_retries = 0
+        try:
+            c.get('https://api.github.com/repos/u/r/pulls')
+        except requests.ConnectionError:
+            pass
+        report = c.metrics.report()
+        assert [('200', 1, 2), ('error', 1, 0)] == [
+            (r['status'], r['count'], r['bytes'])
+            for r in report['requests']]
+        assert 10 == report['rate_limits']['github']['remaining']
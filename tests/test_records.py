@@ -0,0 +1,59 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import pytest
+
+from github2gitlab.records import MergeRequest, PullRequest
+
+
+class TestRecords(object):
+
+    def test_pull_request(self):
+        pull = PullRequest.from_api({
+            'number': 1,
+            'title': 'TITLE',
+            'body': 'DESCRIPTION',
+            'state': 'open',
+            'merged_at': None,
+            'updated_at': 'DATE',
+            'base': {'ref': 'master', 'repo': {'id': 1}},
+            'head': {'sha': 'SHA', 'repo': {'id': 2}},
+            'user': {'login': 'user'},
+            '_links': {'self': {'href': 'http://'}},
+        }, body_max=4)
+        assert 'DESC' == pull['body']
+        assert 'master' == pull['base_ref']
+        assert 'SHA' == pull.head_sha
+        assert pull.get('user') is None
+        assert 'user' not in pull
+        with pytest.raises(KeyError):
+            pull['user']
+        with pytest.raises(AttributeError):
+            pull.user = {}
+        assert not hasattr(pull, '__dict__')
+
+    def test_merge_request(self):
+        merge = MergeRequest.from_api({
+            'id': 100,
+            'iid': 10,
+            'source_branch': 'pull/1/head',
+            'author': {'username': 'user'},
+        })
+        assert {'id': 100, 'iid': 10, 'source_branch': 'pull/1/head',
+                'target_branch': None, 'title': None, 'description': None,
+                'state': None, 'updated_at': None} == merge.as_dict()
+        assert merge == MergeRequest(id=100, iid=10,
+                                     source_branch='pull/1/head')
+        assert merge != MergeRequest(id=100)
@@ -0,0 +1,79 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import pytest
+import shutil
+import subprocess
+import tempfile
+import time
+
+from github2gitlab import runner
+
+
+class TestRunner(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def test_parse_progress(self):
+        assert {
+            'phase': 'Receiving objects',
+            'percent': 45,
+            'done': 450,
+            'total': 1000,
+            'bytes': int(1.2 * 1024 * 1024),
+        } == runner.parse_progress(
+            "Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s")
+        assert 0 == runner.parse_progress(
+            "remote: Counting objects: 100% (3/3), done.")['bytes']
+        assert runner.parse_progress("Everything up-to-date") is None
+
+    def test_run_capture(self):
+        assert "a\nb\n" == runner.run(['sh', '-c', 'echo a ; echo b >&2 ; '
+                                       'echo b'], capture=True)
+        assert runner.run(['echo', 'a']) is None
+        assert "x y" == runner.run(['cat'], input="x y", capture=True)
+        assert self.d + "\n" == runner.run(['pwd'], cwd=self.d,
+                                           capture=True)
+
+    def test_run_fail(self):
+        with pytest.raises(subprocess.CalledProcessError) as e:
+            runner.run(['sh', '-c', 'for i in 1 2 3 4 ; do echo $i >&2 ; '
+                        'done ; exit 3'], tail=2)
+        assert 3 == e.value.returncode
+        # only the last lines are kept
+        assert "3\n4" == e.value.output
+
+    def test_run_progress(self):
+        reports = []
+        # git reports its progress on stderr, lines ending with \\r
+        runner.run(['sh', '-c', 'printf "Receiving objects:  50%% (1/2), '
+                    '1.00 KiB\\rReceiving objects: 100%% (2/2), 2.00 KiB, '
+                    'done.\\nother\\n" >&2'],
+                   progress=reports.append)
+        assert [1024, 2048] == [r['bytes'] for r in reports]
+
+    def test_run_timeout(self):
+        start = time.time()
+        with pytest.raises(subprocess.TimeoutExpired):
+            # the child of sh is killed as well or the pipes stay open
+            runner.run(['sh', '-c', 'echo a ; sleep 30'], timeout=1)
+        assert time.time() - start < 10
+        # output keeps the command alive
+        runner.run(['sh', '-c', 'for i in 1 2 3 ; do echo $i ; '
+                    'sleep 0.5 ; done'], timeout=1)
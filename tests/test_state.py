@@ -0,0 +1,79 @@
+# -*- mode: python; coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+#
+import shutil
+import tempfile
+
+from github2gitlab.state import State
+
+
+class TestState(object):
+
+    def setup_method(self):
+        self.d = tempfile.mkdtemp()
+        self.path = self.d + '/state/user_repo.sqlite'
+
+    def teardown_method(self):
+        shutil.rmtree(self.d)
+
+    def test_meta(self):
+        state = State(self.path)
+        assert {} == state.get('sync', {})
+        state.set('sync', {'updated_at': 'DATE'})
+        state.close()
+        assert {'updated_at': 'DATE'} == State(self.path).get('sync')
+
+    def test_pulls(self):
+        state = State(self.path)
+        assert state.pull('1') is None
+        state.record('1', 100, 'PULL DATE', 'FINGERPRINT', 'MERGE DATE')
+        state.record(2, 200, None, 'FINGERPRINT', None)
+        state.commit()
+        state.close()
+        state = State(self.path)
+        assert {
+            'number': 1,
+            'iid': 100,
+            'pull_updated_at': 'PULL DATE',
+            'fingerprint': 'FINGERPRINT',
+            'merge_updated_at': 'MERGE DATE',
+        } == state.pull(1)
+        assert [1, 2] == [known['number'] for known in state.pulls()]
+        state.forget(2)
+        assert state.pull(2) is None
+
+    def test_check_rebuild(self):
+        state = State(self.path)
+        state.set('sync', {'updated_at': 'DATE'})
+        state.record(1, 100, None, 'FINGERPRINT', None)
+        state.commit()
+        assert [] == state.check()
+        state.rebuild()
+        assert [] == state.pulls()
+        assert state.get('sync') is None
+
+    def test_merges(self):
+        state = State(self.path)
+        assert [] == state.merges()
+        state.store_merges([
+            {'id': 100, 'iid': 1, 'title': 'ONE', 'author': 'IGNORED'},
+            {'id': 200, 'iid': 2, 'title': 'TWO'},
+        ])
+        state.store_merges([{'id': 200, 'iid': 2, 'title': 'UPDATED'}])
+        merges = dict([(merge['id'], merge) for merge in state.merges()])
+        assert 'author' not in merges[100]
+        assert 'UPDATED' == merges[200]['title']
+        state.store_merges([{'id': 300, 'iid': 3}], replace=True)
+        assert [300] == [merge['id'] for merge in state.merges()]